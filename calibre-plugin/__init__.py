@@ -28,22 +28,12 @@ PLUGIN_VERSION_TUPLE = (0, 0, 5)
 from calibre.customize import FileTypePlugin        # type: ignore
 __version__ = PLUGIN_VERSION = ".".join([str(x)for x in PLUGIN_VERSION_TUPLE])
 
-# Ton of libraries
+# Only cheap imports here. This module is loaded on every Calibre start
+# (and in every worker process), even if no LCPL file is ever imported.
+# Everything else (json, hashlib, http.client, dateutil, zipfile, ...) is
+# imported by the submodules, which are only loaded when they're needed.
 
-import json
 import os, sys
-import hashlib
-try:
-    # Python 3 
-    from urllib.request import Request, urlopen
-except: 
-    # Python 2
-    from urllib2 import Request, urlopen
-import dateutil.parser
-import datetime
-import traceback
-from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
-from contextlib import closing
 
 
 class LCPLInput(FileTypePlugin):
@@ -66,9 +56,24 @@ class LCPLInput(FileTypePlugin):
             if ("lcpl" not in BOOK_EXTENSIONS):
                 BOOK_EXTENSIONS.append("lcpl")
         except:
+            import traceback
             print("{0} v{1}: Couldn't add LCPL to book extension list:".format(PLUGIN_NAME, PLUGIN_VERSION))
             traceback.print_exc()
 
+        # Background prefetch for the auto-add folder. Only in the GUI process, 
+        # and only a few seconds after startup so it doesn't slow that down.
+        # It's off by default, so don't even load it unless it's enabled
+        # (turning it on later goes through save_settings).
+        if "calibre.gui2" in sys.modules and not os.environ.get("CALIBRE_WORKER"):
+            try:
+                import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+                if prefs.get_settings()["prefetch_auto_add"]:
+                    import calibre_plugins.lcplinput.prefetch as prefetch   # type: ignore
+                    prefetch.schedule_start(self)
+            except:
+                import traceback
+                traceback.print_exc()
+
     def is_customizable(self):
         return True
 
@@ -79,320 +84,518 @@ class LCPLInput(FileTypePlugin):
     def save_settings(self, config_widget):
         config_widget.save_settings()
 
-    def parseLCPLdownloadBook(self, lcpl_string):
-        # type : lcpl_string: str
+        # Start or stop the auto-add prefetcher if that setting changed
+        if "calibre.gui2" in sys.modules:
+            import calibre_plugins.lcplinput.prefetch as prefetch   # type: ignore
+            prefetch.apply_settings(self)
 
+    def getUserAgent(self, settings):
+        # Returns the User-Agent for downloads, and whether it's the custom one
+        if settings["use_custom_ua"] and settings["useragent"] != "":
+            return settings["useragent"], True
+        # Get default UA that matches the OS
+        return settings.get_system_ua(), False
+
+    def getPublicationCache(self, settings):
+        # Returns the cache.PublicationCache, or None if the cache is disabled
         import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
-        settings = prefs.LCPLInput_Prefs()
+        import calibre_plugins.lcplinput.cache as cache     # type: ignore
 
-        # This function is called by the run function when it encounters an LCP license file
-        try: 
-            license = json.loads(lcpl_string)
-            print("{0} v{1}: Found LCPL for book ID {2}".format(PLUGIN_NAME, PLUGIN_VERSION, license["id"]))
-        except: 
-            print("{0} v{1}: LCPL license file invalid".format(PLUGIN_NAME, PLUGIN_VERSION))
+        if settings["publication_cache_size_mb"] <= 0:
             return None
+        return cache.PublicationCache(prefs.get_plugin_cache_dir("publications"), settings["publication_cache_size_mb"] * 1024 * 1024)
 
-        lic_start = None
-        lic_end = None
+    def getFulfillmentIndex(self, settings):
+        # Returns the index.FulfillmentIndex, or None if it's disabled
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.index as index     # type: ignore
 
-        if ("rights" in license and "start" in license["rights"]):
-            lic_start = dateutil.parser.isoparse(license["rights"]["start"])
+        if not settings["fulfillment_index"]:
+            return None
+        return index.get_index(os.path.join(prefs.get_plugin_cache_dir(), "fulfillments.sqlite"))
 
-        if ("rights" in license and "end" in license["rights"]):
-            lic_end = dateutil.parser.isoparse(license["rights"]["end"])
+    def getFailureCache(self, settings):
+        # Returns the negcache.FailureCache, or None if it's disabled
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.negcache as negcache   # type: ignore
 
-        try: 
-            # Python 3
-            currenttime = datetime.datetime.now(datetime.timezone.utc)
-        except:
-            # Python 2
-            if lic_start is not None:
-                lic_start = lic_start.replace(tzinfo=None)
-            if lic_end is not None:
-                lic_end = lic_end.replace(tzinfo=None)
-            currenttime = datetime.datetime.utcnow()
-
-        is_in_license_range = True
-
-        if lic_start is not None: 
-            if lic_start > currenttime:
-                is_in_license_range = False
-        if lic_end is not None:
-            if lic_end < currenttime:
-                is_in_license_range = False
+        if not settings["failure_cache"]:
+            return None
+        return negcache.get_cache(os.path.join(prefs.get_plugin_cache_dir(), "failures.sqlite"))
 
-        if not is_in_license_range: 
-            print("{0} v{1}: WARNING: LCPL license expired (valid from {2} until {3})".format(PLUGIN_NAME, PLUGIN_VERSION, str(lic_start), str(lic_end)))
+    def reuseFulfillment(self, fulfillments, license, publication_key, outputname):
+        # Copies the output of an earlier fulfillment of this license - or of another
+        # license for the same publication - to outputname, with this license injected.
+        # Returns True on success.
+        import shutil
+        import calibre_plugins.lcplinput.lcpl as lcpl       # type: ignore
 
-            if settings["honor_license_time_limits"]:
-                return None
-            else: 
-                print("{0} v{1}: User decided to override, try downloading anyways ...".format(PLUGIN_NAME, PLUGIN_VERSION))
+        try: 
+            candidates = []
+            record = fulfillments.find_license(license.id)
+            if record is not None and record.publication_key == publication_key:
+                candidates.append(record)
+            candidates.extend(r for r in fulfillments.find_publication(publication_key) if r.license_id != license.id)
+
+            for record in candidates:
+                if not record.is_usable():
+                    # File is gone or was changed
+                    fulfillments.remove(record.license_id)
+                    continue
+                shutil.copyfile(record.path, outputname)
+                if lcpl.replace_license(outputname, license.raw):
+                    return True
+        except: 
+            import traceback
+            print("{0} v{1}: Fulfillment index lookup failed:".format(PLUGIN_NAME, PLUGIN_VERSION))
+            traceback.print_exc()
 
+        return False
 
-        dl_link = None
-        dl_size = 0
-        dl_sha256_hash = None
-        dl_is_buggy_template = False
-
-        for link in license["links"]: 
-            if (
-                (link["rel"] == "publication" and link["type"] == "application/epub+zip") or
-                (link["rel"] == "publication" and link["type"] == "application/pdf")
-            ):
-                dl_link = link["href"]
-                if "length" in link:
-                    dl_size = link["length"]
-                if "hash" in link:
-                    dl_sha256_hash = link["hash"].lower()
-
-                if link["type"] == "application/epub+zip":
-                    dl_file_name_ext = ".epub"
-                elif link["type"] == "application/pdf":
-                    dl_file_name_ext = ".pdf"
-                else:
-                    dl_file_name_ext = ".zip"
-
-                # Check for templating:
-                if ("templated" in link and ((link["templated"] is True) or (link["templated"].lower() == "true"))):
-                    # This is a templated URL. The license server is supposed to fix this, but you never know
-                    # TODO: Not sure if this should be a Bool or a String ...
-                    print("[ * ] Found templated URL - this is not supposed to happen. Will try to fix this ...")
-                    dl_is_buggy_template = True
-                
-                
-                break
-        
-        if dl_link is None: 
-            print("{0} v{1}: No download link found in LCPL".format(PLUGIN_NAME, PLUGIN_VERSION))
-            return None
-      
-        # Download book: 
+    def recordFailure(self, failures, license, url, error):
+        import calibre_plugins.lcplinput.negcache as negcache   # type: ignore
 
-        if settings["use_custom_ua"] and settings["useragent"] != "":
-            ua = settings["useragent"]
-            print("{0} v{1}: Downloading book from {2} with custom UA ...".format(PLUGIN_NAME, PLUGIN_VERSION, dl_link))
-        else:
-            # Get default UA that matches the OS
-            ua = settings.get_system_ua()                
-            print("{0} v{1}: Downloading book from {2} with default UA ...".format(PLUGIN_NAME, PLUGIN_VERSION, dl_link))
+        kind = negcache.classify(error)
+        if kind is None:
+            return
+        try: 
+            failures.record(license.id, url, kind[0], kind[1], str(error)[:200])
+        except: 
+            import traceback
+            print("{0} v{1}: Couldn't remember failed download:".format(PLUGIN_NAME, PLUGIN_VERSION))
+            traceback.print_exc()
 
-        outputname = self.temporary_file(dl_file_name_ext).name
+    def recordFulfillment(self, fulfillments, license, publication_key, outputname):
+        try: 
+            fulfillments.add(license.id, publication_key, license.publication.hash, outputname)
+        except: 
+            import traceback
+            print("{0} v{1}: Couldn't update fulfillment index:".format(PLUGIN_NAME, PLUGIN_VERSION))
+            traceback.print_exc()
 
-        
-        try:
-            req = Request(url=dl_link, headers={'User-Agent': ua})
-            handler = urlopen(req)
-            chunksize = 16 * 1024
-
-            ret_code = handler.getcode()
-
-            if ret_code != 200:
-                print("{0} v{1}: Download returned error {2}".format(PLUGIN_NAME, PLUGIN_VERSION, ret_code))
-                raise Exception("DL error") 
-
-            with open(outputname, "wb") as f:
-                while True:
-                    chunk = handler.read(chunksize)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-
-        except Exception as e:
-            if dl_is_buggy_template:
-                print("{0} v{1}: Downloading book failed, try templating ...".format(PLUGIN_NAME, PLUGIN_VERSION))
+    def downloadPublication(self, settings, license, ua, outputname, metrics=None, pubcache=None):
+        # Downloads the publication to outputname and checks it against the license.
+        # Returns None on failure, otherwise whether all content checks passed
+        # (the file is also returned if the user chose to ignore content errors).
+        # With a pubcache (cache.PublicationCache), a copy from an earlier download of 
+        # the same URL is revalidated with the server instead of downloading it again,
+        # and the new download is added to the cache.
+
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.cache as cache     # type: ignore
+        import calibre_plugins.lcplinput.download as download   # type: ignore
+        import calibre_plugins.lcplinput.diskspace as diskspace     # type: ignore
+        import time
+
+        publication = license.publication
+        dl_link = publication.href
+        dl_size = publication.length
+        dl_sha256_hash = publication.hash
+
+        # The download is streamed to disk once. Length and SHA256 hash are computed
+        # on the fly, and if the content is supposed to be checked we stop as soon
+        # as the server sends more data than the LCPL file said.
+        max_size = None
+        if dl_size > 0 and not settings["ignore_content_errors"]:
+            max_size = dl_size
+
+        # If an earlier attempt for this license died halfway, continue where it stopped.
+        partial = download.PartialDownload(prefs.get_plugin_cache_dir("partial"), license.id, dl_sha256_hash or dl_link)
+
+        # Templated links: the server may want the license ID filled in, or not. 
+        # Both variants are tried at the same time (see download.download_any_to_file).
+        urls = [dl_link]
+        if publication.templated:
+            dl_link2 = dl_link.replace("{license_id}", license.id)
+            if (dl_link2 != dl_link):
+                urls.append(dl_link2)
             else: 
-                print("{0} v{1}: Downloading book failed!".format(PLUGIN_NAME, PLUGIN_VERSION))
+                print("{0} v{1}: Templating enabled but not used.".format(PLUGIN_NAME, PLUGIN_VERSION))
+
+        # Did this download fail recently? Then don't wait for the same error again.
+        failures = self.getFailureCache(settings)
+        failure = None
+        if failures is not None:
+            try: 
+                failure = failures.get(license.id, dl_link)
+            except: 
+                failures = None
+            if failure is not None and failure.is_blocked() and partial.load() is None:
+                # (With a partial download to continue from, it's worth another try.)
+                print("{0} v{1}: Download of this book {2}".format(PLUGIN_NAME, PLUGIN_VERSION, failure.describe()))
+                if metrics is not None:
+                    metrics.add_count("known_failures")
                 return None
 
-            dl_link2 = dl_link.replace("{license_id}", license["id"])
-            if (dl_link2 != dl_link):
-                try:
-                    req = Request(url=dl_link2, headers={'User-Agent': ua})
-                    handler = urlopen(req)
-                    chunksize = 16 * 1024
+        validators = None
+        if pubcache is not None:
+            validators = pubcache.get_validators(dl_link)
 
-                    ret_code = handler.getcode()
+        # Files are always hashed when they may go into the cache
+        with_hash = dl_sha256_hash is not None or pubcache is not None
 
-                    if ret_code != 200:
-                        print("{0} v{1}: Download returned error {2}".format(PLUGIN_NAME, PLUGIN_VERSION, ret_code))
-                        raise Exception("DL error") 
+        # Fail before connecting if the disk is too full for the book. Running downloads
+        # (batch imports, prefetches) reserve their space, so they're taken into account.
+        try:
+            reservation = diskspace.reserve(os.path.dirname(os.path.abspath(outputname)), dl_size)
+        except diskspace.InsufficientSpace as e:
+            print("{0} v{1}: Can't download book: {2}".format(PLUGIN_NAME, PLUGIN_VERSION, e))
+            return None
 
-                    with open(outputname, "wb") as f:
-                        while True:
-                            chunk = handler.read(chunksize)
-                            if not chunk:
-                                break
-                            f.write(chunk)
+        used = 0
+        result = None
+        reused_key = None
+        with reservation:
+            while result is None:
+                try:
+                    used, result = download.download_any_to_file(urls, ua, outputname, max_size, with_hash, 
+                        partial, metrics, settings["download_segments"], publication.host, validators, reservation)
+
+                except download.NotModified:
+                    # Same file as last time. Check that our copy is still intact, 
+                    # the content checks below then compare it with the license.
+                    size = pubcache.fetch_verified(validators["key"], outputname, validators["sha256"])
+                    if size is None:
+                        print("{0} v{1}: Cached publication is damaged, downloading again ...".format(PLUGIN_NAME, PLUGIN_VERSION))
+                        validators = None
+                        continue
+                    print("{0} v{1}: Publication not modified on the server, using cached copy".format(PLUGIN_NAME, PLUGIN_VERSION))
+                    if metrics is not None:
+                        metrics.add_count("not_modified")
+                    result = download.StreamResult(size, validators["sha256"], validators.get("content_length"), 
+                        validators.get("url"), validators.get("etag"), validators.get("last_modified"))
+                    reused_key = validators["key"]
 
                 except Exception as e:
-                    print("{0} v{1}: Downloading book failed even with templating".format(PLUGIN_NAME, PLUGIN_VERSION))
+                    print("{0} v{1}: Downloading book failed: {2}".format(PLUGIN_NAME, PLUGIN_VERSION, e))
+                    if failures is not None:
+                        self.recordFailure(failures, license, dl_link, e)
                     return None
-            else: 
-                print("{0} v{1}: Templating enabled but not used.".format(PLUGIN_NAME, PLUGIN_VERSION))
-                return None
 
+        if failure is not None:
+            # Works again
+            try: 
+                failures.forget(license.id, dl_link)
+            except: 
+                pass
 
-        try: 
-            total_length = int(req.headers.get('content-length'))
-        except: 
-            total_length = None
+        if used > 0:
+            print("{0} v{1}: Downloaded book using the templated URL".format(PLUGIN_NAME, PLUGIN_VERSION))
 
         # Download done, check length: 
 
-        if (dl_size > 0 and os.path.getsize(outputname) != dl_size): 
-            print("{0} v{1}: Invalid file length (LCPL file said {2} but server sent {3})".format(PLUGIN_NAME, PLUGIN_VERSION, dl_size, os.path.getsize(outputname)))
+        content_ok = True
+
+        if (dl_size > 0 and result.size != dl_size): 
+            print("{0} v{1}: Invalid file length (LCPL file said {2} but server sent {3})".format(PLUGIN_NAME, PLUGIN_VERSION, dl_size, result.size))
+            content_ok = False
             if (not settings["ignore_content_errors"]): 
                 return None
 
-        if (total_length is not None and total_length > 0 and os.path.getsize(outputname) != total_length):
-            print("{0} v{1}: Invalid file length (server said {2} but actually sent {3})".format(PLUGIN_NAME, PLUGIN_VERSION, total_length, os.path.getsize(outputname)))
+        if (result.content_length is not None and result.size != result.content_length):
+            print("{0} v{1}: Invalid file length (server said {2} but actually sent {3})".format(PLUGIN_NAME, PLUGIN_VERSION, result.content_length, result.size))
+            content_ok = False
             if (not settings["ignore_content_errors"]): 
                 return None
 
         # Check hash
-        if (dl_sha256_hash is not None):
-            hash = hashlib.sha256()
-
-            with open(outputname, "rb") as f:
-                while True:
-                    data = f.read(8192)
-                    if not data: 
-                        break
-                    hash.update(data)
-            
-            actual_hash = hash.hexdigest().lower()
-
-            if (dl_sha256_hash != actual_hash):
-                print("{0} v{1}: File SHA256 hash invalid".format(PLUGIN_NAME, PLUGIN_VERSION))
-                if (not settings["ignore_content_errors"]): 
-                    return None
+        if (dl_sha256_hash is not None and dl_sha256_hash != result.sha256):
+            print("{0} v{1}: File SHA256 hash invalid".format(PLUGIN_NAME, PLUGIN_VERSION))
+            content_ok = False
+            if (not settings["ignore_content_errors"]): 
+                return None
+
+        # Only cache files that passed all checks. Without a hash in the license, 
+        # the cached copy is only useful if the server gave us something to revalidate it with.
+        cache_key = cache.get_cache_key(dl_sha256_hash, dl_link)
+        if (content_ok and pubcache is not None and cache_key != reused_key and result.sha256 is not None 
+                and (dl_sha256_hash or result.etag or result.last_modified)):
+            new_validators = None
+            if result.etag or result.last_modified:
+                new_validators = {"url": result.url, "etag": result.etag, "last_modified": result.last_modified,
+                    "content_length": result.content_length, "sha256": result.sha256, "size": result.size}
+            start = time.time()
+            pubcache.store(cache_key, outputname, dl_link, new_validators)
+            if metrics is not None:
+                metrics.add_time("cache_store", time.time() - start)
+
+        return content_ok
+
+    def parseLCPLdownloadBook(self, lcpl_string, license=None, metrics=None):
+        # type : lcpl_string: str
+
+        # This function is called by the run function when it encounters an LCP license file.
+        # license is the already parsed lcpl.LCPLicense, if the caller has one.
+        # metrics is the metrics.ImportMetrics for this import; if the caller doesn't
+        # pass one, a new one is created and finished here.
+
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.metrics as lcplmetrics     # type: ignore
+
+        if metrics is not None:
+            return self.fulfillLicense(lcpl_string, license, metrics)
+
+        metrics = lcplmetrics.ImportMetrics()
+        outputname = None
+        try:
+            outputname = self.fulfillLicense(lcpl_string, license, metrics)
+        finally:
+            metrics.finish("ok" if outputname is not None else "failed", prefs.get_settings()["metrics_file"])
+        return outputname
+
+    def fulfillLicense(self, lcpl_string, license, metrics):
+        # The actual work of parseLCPLdownloadBook.
+
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.cache as cache     # type: ignore
+        import calibre_plugins.lcplinput.lcpl as lcpl       # type: ignore
+        settings = prefs.get_settings()
+
+        if license is None:
+            with metrics.phase("parse"):
+                license = lcpl.parse_license(lcpl_string)
+
+        if license is None:
+            print("{0} v{1}: LCPL license file invalid".format(PLUGIN_NAME, PLUGIN_VERSION))
+            return None
+
+        print("{0} v{1}: Found LCPL for book ID {2}".format(PLUGIN_NAME, PLUGIN_VERSION, license.id))
+        metrics.set("license_id", license.id)
+
+        with metrics.phase("rights"):
+            is_in_license_range = license.is_in_rights_window()
+
+        if not is_in_license_range: 
+            print("{0} v{1}: WARNING: LCPL license expired (valid from {2} until {3})".format(PLUGIN_NAME, PLUGIN_VERSION, str(license.rights_start), str(license.rights_end)))
+
+            if settings["honor_license_time_limits"]:
+                return None
+            else: 
+                print("{0} v{1}: User decided to override, try downloading anyways ...".format(PLUGIN_NAME, PLUGIN_VERSION))
+
+        publication = license.publication
+
+        if publication is None: 
+            print("{0} v{1}: No download link found in LCPL".format(PLUGIN_NAME, PLUGIN_VERSION))
+            return None
+
+        metrics.set("host", publication.host)
+        metrics.set("declared_length", publication.length)
+
+        if publication.templated:
+            print("[ * ] Found templated URL - this is not supposed to happen. Will try to fix this ...")
+
+        dl_link = publication.href
+
+        # Download book: 
+
+        ua, custom_ua = self.getUserAgent(settings)
+        if custom_ua:
+            print("{0} v{1}: Downloading book from {2} with custom UA ...".format(PLUGIN_NAME, PLUGIN_VERSION, dl_link))
+        else:
+            print("{0} v{1}: Downloading book from {2} with default UA ...".format(PLUGIN_NAME, PLUGIN_VERSION, dl_link))
+
+        outputname = self.temporary_file(publication.extension).name
+        cache_key = cache.get_cache_key(publication.hash, dl_link)
+
+        # Did we fulfill this license (or another one for the same publication) before?
+        fulfillments = self.getFulfillmentIndex(settings)
+        if fulfillments is not None:
+            with metrics.phase("index_lookup"):
+                reused = self.reuseFulfillment(fulfillments, license, cache_key, outputname)
+            if reused:
+                print("{0} v{1}: Book was fulfilled before, reusing that file".format(PLUGIN_NAME, PLUGIN_VERSION))
+                metrics.add_count("index_hits")
+                self.recordFulfillment(fulfillments, license, cache_key, outputname)
+                return outputname
+
+        # The auto-add prefetcher may already have downloaded this book (or still be busy with it)
+        prefetched = False
+        if settings["prefetch_auto_add"]:
+            import calibre_plugins.lcplinput.prefetch as prefetch   # type: ignore
+            with metrics.phase("prefetch_wait"):
+                prefetched = prefetch.get_store().take(license, outputname)
+
+        # Check if we already downloaded this publication earlier
+        pubcache = self.getPublicationCache(settings)
+
+        # A cache entry for the publication hash can be used right away. Without a hash,
+        # the entry for the URL is revalidated with the server (in downloadPublication).
+        cache_hit = False
+        if not prefetched and pubcache is not None and publication.hash:
+            with metrics.phase("cache_lookup"):
+                cache_hit = pubcache.fetch(cache_key, outputname, publication.length)
+
+        if prefetched:
+            print("{0} v{1}: Book was already downloaded in the background".format(PLUGIN_NAME, PLUGIN_VERSION))
+            metrics.add_count("prefetched")
+        elif cache_hit:
+            print("{0} v{1}: Found publication in cache, skipping download".format(PLUGIN_NAME, PLUGIN_VERSION))
+            metrics.add_count("cache_hits")
+        else:
+            content_ok = self.downloadPublication(settings, license, ua, outputname, metrics, pubcache)
+            if content_ok is None:
+                return None
+            if not content_ok:
+                # Don't remember files that failed the content checks
+                fulfillments = None
 
         # Write book to file system: 
+        from zipfile import ZipFile
+        from contextlib import closing
         try: 
             # Inject license file
-            with closing(ZipFile(outputname, 'a')) as outfile: 
-                outfile.writestr("META-INF/license.lcpl", lcpl_string)
+            with metrics.phase("inject"):
+                with closing(ZipFile(outputname, 'a')) as outfile: 
+                    outfile.writestr("META-INF/license.lcpl", license.raw)
         except: 
             print("{0} v{1}: Error while writing output file".format(PLUGIN_NAME, PLUGIN_VERSION))
             return None
 
+        if fulfillments is not None:
+            self.recordFulfillment(fulfillments, license, cache_key, outputname)
+
         return outputname
     
 
-    def run(self, path_to_ebook):
-        # This code gets called by Calibre with a path to the new book file. 
-        # Check if it's actually a valid LCPL file.
+    def readLCPLfile(self, path_to_ebook):
+        # Returns an lcpl.LCPLicense if path_to_ebook is an LCPL license file, otherwise None.
+        # Large files and files that don't look like JSON are rejected without reading them completely.
+        import calibre_plugins.lcplinput.lcpl as lcpl       # type: ignore
 
-        print("{0} v{1}: Trying to parse file {2}".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook)))
+        return lcpl.read_license_file(path_to_ebook)
 
-        ftype = None
-        
-        # Check file type: 
-        with open(path_to_ebook, "rb") as bookfile:
-            dataSTR = bookfile.read().decode('latin-1')
+    def runFileTypePlugins(self, destination, metrics=None):
+        # Okay, looks like we turned the LCPL into a book (EPUB or PDF) successfully. 
+        # Lets now call all FileType plugins that are supposed to run on incoming EPUB or PDF files.
+
+        import traceback
 
-    
         try: 
-            json_str = json.loads(dataSTR)
-            if ("id" in json_str and "encryption" in json_str and "profile" in json_str["encryption"]): 
-                ftype = "LCPL"
-                print("{0} v{1}: Looks like this is a LCPL license file".format(PLUGIN_NAME, PLUGIN_VERSION))
-        except: 
-            pass
+            import calibre_plugins.lcplinput.dispatch as dispatch   # type: ignore
 
-        # Okay, once we're here, ftype is either "LCPL" or None.
+            table = dispatch.get_dispatch_table(self.name)
 
-        if ftype is None: 
-            print("{0} v{1}: Looks like this file isn't supported by {0}".format(PLUGIN_NAME, PLUGIN_VERSION))
-            return path_to_ebook
+            original_file_for_plugins = destination
 
-        elif ftype == "LCPL":
-            destination = self.parseLCPLdownloadBook(dataSTR)
+            oo, oe = sys.stdout, sys.stderr
 
-            if (destination is not None):
+            # The table only contains enabled FileTypePlugins that run on import,
+            # support the book's file type, and wouldn't run on the LCPL file anyways.
+            my_file_type = dispatch.get_file_type(destination)
+            plugins = table.get_plugins(my_file_type)
 
-                # Okay, looks like we turned the LCPL into a book (EPUB or PDF) successfully. 
-                # Lets now call all FileType plugins that are supposed to run on incoming EPUB or PDF files.
+            while plugins:
+                position, plugin = plugins.pop(0)
 
-                try: 
-                    from calibre.customize.ui import _initialized_plugins, is_disabled
-                    from calibre.customize import FileTypePlugin
+                print("{0} v{1}: Executing plugin {2} ...".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name))
 
-                    original_file_for_plugins = destination
+                plugin.original_path_to_file = original_file_for_plugins
+
+                try: 
+                    plugin_ret = None
+                    plugin_ret = dispatch.timed_run(table, plugin, destination, metrics)
+                except: 
+                    print("{0} v{1}: Running file type plugin failed with traceback:".format(PLUGIN_NAME, PLUGIN_VERSION))
+                    traceback.print_exc(file=oe)
 
-                    oo, oe = sys.stdout, sys.stderr
+                # Restore stdout and stderr, in case a plugin broke them.
+                sys.stdout, sys.stderr = oo, oe
 
-                    for plugin in _initialized_plugins:
 
-                        #print("{0} v{1}: Plugin '{2}' has prio {3}".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name, plugin.priority))
+                if plugin_ret is not None:
+                    # If the plugin returned a new path, update that.
+                    print("{0} v{1}: Plugin returned path '{2}', updating.".format(PLUGIN_NAME, PLUGIN_VERSION, plugin_ret))
+                    destination = plugin_ret
 
-                        # Check if this is a FileTypePlugin
-                        if not isinstance(plugin, FileTypePlugin):
-                            #print("{0} v{1}: Plugin '{2}' is no FileTypePlugin, skipping ...".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name))
-                            continue
+                    # If the file type changed, continue with the plugins for the new type.
+                    if dispatch.get_file_type(destination) != my_file_type:
+                        my_file_type = dispatch.get_file_type(destination)
+                        plugins = table.get_plugins(my_file_type, position)
+                else: 
+                    print("{0} v{1}: Plugin returned nothing - skipping".format(PLUGIN_NAME, PLUGIN_VERSION))
 
-                        # Check if it's disabled
-                        if is_disabled(plugin):
-                            #print("{0} v{1}: Plugin '{2}' is disabled, skipping ...".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name))
-                            continue
+        except: 
+            print("{0} v{1}: Error while executing other plugins".format(PLUGIN_NAME, PLUGIN_VERSION))
+            traceback.print_exc()
+            pass
 
-                        if plugin.name == self.name:
-                            #print("{0} v{1}: Plugin '{2}' is me - skipping".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name))
-                            continue
+        return destination
 
-                        # Check if it's supposed to run on import:
-                        if not plugin.on_import:
-                            #print("{0} v{1}: Plugin '{2}' isn't supposed to run during import, skipping ...".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name))
-                            continue
+    def planBatch(self, paths, order=None):
+        # Dry run for fulfillBatch: reads the LCPL files (no network access) and
+        # returns a planner.BatchPlan with the downloads in the order they would run.
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.planner as planner     # type: ignore
 
-                        # Check filetype
-                        # If neither the book file extension nor "*" is in the plugin,
-                        # don't execute it.
-                        my_file_type = os.path.splitext(destination)[-1].lower().replace('.', '')
-                        if (not my_file_type in plugin.file_types):
-                            #print("{0} v{1}: Plugin '{2}' doesn't support {3} files, skipping ...".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name, my_file_type))
-                            continue
+        settings = prefs.get_settings()
+        return planner.plan_batch(paths, settings["honor_license_time_limits"], order or settings["batch_order"],
+            self.getFailureCache(settings))
 
-                        if ("lcpl" in plugin.file_types or "*" in plugin.file_types):
-                            #print("{0} v{1}: Plugin '{2}' would run anyways, skipping ...".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name, my_file_type))
-                            continue
+    def fulfillBatch(self, paths, max_workers=None, max_per_host=None, run_plugins=False, order=None):
+        # Fulfills many LCPL files at once. Downloads run concurrently (limited globally
+        # and per content server), each one exactly like a single import would.
+        # Returns one batch.BatchResult per path, in the same order.
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.batch as batch     # type: ignore
+
+        settings = prefs.get_settings()
+        if max_workers is None:
+            max_workers = settings["batch_max_downloads"]
+        if max_per_host is None:
+            max_per_host = settings["batch_max_downloads_per_host"]
+        if order is None:
+            order = settings["batch_order"]
+
+        results = batch.fulfill_batch(self, paths, max_workers, max_per_host, settings["metrics_file"],
+            order, settings["honor_license_time_limits"], self.getFailureCache(settings))
+
+        if run_plugins:
+            # Other plugins don't expect to be called from multiple threads, 
+            # so run them one after another once all downloads are done.
+            for result in results:
+                if result.output is not None:
+                    result.output = self.runFileTypePlugins(result.output)
+
+        return results
+
+    def cli_main(self, args):
+        # Headless batch fulfillment: 
+        # calibre-debug -r "LCPL Input" -- [options] input [input ...] -o OUTPUT_DIR
+        # args[0] is the plugin name.
+        import calibre_plugins.lcplinput.cli as cli         # type: ignore
+        return cli.main(self, args[1:], 'calibre-debug -r "{0}" --'.format(self.name))
 
-                        print("{0} v{1}: Executing plugin {2} ...".format(PLUGIN_NAME, PLUGIN_VERSION, plugin.name))
+    def run(self, path_to_ebook):
+        # This code gets called by Calibre with a path to the new book file. 
+        # Check if it's actually a valid LCPL file.
 
-                        plugin.original_path_to_file = original_file_for_plugins
+        print("{0} v{1}: Trying to parse file {2}".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook)))
 
-                        try: 
-                            plugin_ret = None
-                            plugin_ret = plugin.run(destination)
-                        except: 
-                            print("{0} v{1}: Running file type plugin failed with traceback:".format(PLUGIN_NAME, PLUGIN_VERSION))
-                            traceback.print_exc(file=oe)
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.metrics as lcplmetrics     # type: ignore
 
-                        # Restore stdout and stderr, in case a plugin broke them.
-                        sys.stdout, sys.stderr = oo, oe
+        metrics = lcplmetrics.ImportMetrics(os.path.basename(path_to_ebook))
 
+        with metrics.phase("parse"):
+            license = self.readLCPLfile(path_to_ebook)
 
-                        if plugin_ret is not None:
-                            # If the plugin returned a new path, update that.
-                            print("{0} v{1}: Plugin returned path '{2}', updating.".format(PLUGIN_NAME, PLUGIN_VERSION, plugin_ret))
-                            destination = plugin_ret
-                        else: 
-                            print("{0} v{1}: Plugin returned nothing - skipping".format(PLUGIN_NAME, PLUGIN_VERSION))
+        if license is None: 
+            print("{0} v{1}: Looks like this file isn't supported by {0}".format(PLUGIN_NAME, PLUGIN_VERSION))
+            return path_to_ebook
 
-                            
+        print("{0} v{1}: Looks like this is a LCPL license file".format(PLUGIN_NAME, PLUGIN_VERSION))
 
-                except: 
-                    print("{0} v{1}: Error while executing other plugins".format(PLUGIN_NAME, PLUGIN_VERSION))
-                    traceback.print_exc()
-                    pass
+        destination = None
+        try:
+            destination = self.parseLCPLdownloadBook(license.raw, license, metrics)
 
+            if (destination is not None):
+                with metrics.phase("plugins"):
+                    destination = self.runFileTypePlugins(destination, metrics)
                 return destination
-
+        finally:
+            metrics.finish("ok" if destination is not None else "failed", prefs.get_settings()["metrics_file"])
 
         print("{0} v{1}: Failed, return original ...".format(PLUGIN_NAME, PLUGIN_VERSION))
         return path_to_ebook
-
-
-
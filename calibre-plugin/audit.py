@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Integrity audit of fulfilled books.
+# Every book this plugin produces is the publication from the content server with
+# the license appended as the last ZIP entry (META-INF/license.lcpl). For EPUB
+# files, that entry was written where the publication's ZIP directory started,
+# followed by a new directory; for PDF files, it's a small ZIP archive after the
+# end of the PDF. So the publication's bytes are:
+#   - PDF:  everything before the license entry,
+#   - EPUB: everything before the license entry, plus the ZIP directory without
+#           the license's record, plus a matching end record.
+# The audit reads the embedded license, rebuilds those bytes (through mmap,
+# without copying the file) and checks them against the license's length and
+# SHA256 hash. Files are checked in a pool of worker processes.
+#
+# calibre-debug -r "LCPL Input" -- audit [options] path [path ...]
+# (or tools/lcpl_fulfill.py audit ...)
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from calibre_plugins.lcplinput.__init__ import PLUGIN_NAME, PLUGIN_VERSION  # type: ignore
+
+
+LICENSE_NAME = b"META-INF/license.lcpl"
+
+BOOK_EXTENSIONS = (".epub", ".pdf")
+
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_EOCD_STRUCT = struct.Struct("<4s4H2LH")
+_CENTRAL_SIGNATURE = b"PK\x01\x02"
+_CENTRAL_STRUCT = struct.Struct("<4s4B4HL2L5H2L")
+_LOCAL_SIGNATURE = b"PK\x03\x04"
+_LOCAL_STRUCT = struct.Struct("<4s2B4HL2L2H")
+_ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+
+# The end record is at most this far from the end of the file (22 bytes + comment)
+_EOCD_SEARCH = 22 + 65535
+
+# Hash in slices of this size (hashlib releases the GIL for each of them)
+HASH_SLICE = 8 * 1024 * 1024
+
+# Results that mean the book has to be fulfilled again
+BAD_STATUSES = ("corrupted", "truncated")
+
+
+class _Damaged(Exception):
+    pass
+
+
+class _Unsupported(Exception):
+    # Valid file, but not something the audit can check (ZIP64, ...)
+    pass
+
+
+def find_books(inputs, recursive=True):
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            if recursive:
+                for root, dirs, files in os.walk(item):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name.lower().endswith(BOOK_EXTENSIONS):
+                            paths.append(os.path.join(root, name))
+            else:
+                for name in sorted(os.listdir(item)):
+                    if name.lower().endswith(BOOK_EXTENSIONS):
+                        paths.append(os.path.join(item, name))
+        else:
+            paths.append(item)
+    return paths
+
+
+def _read_directory(mm):
+    # Returns (end record offset, end record fields, concat, [(record start, record end, name, local header offset)]).
+    # concat is where the ZIP archive starts in the file (data in front of it, like a PDF).
+    size = len(mm)
+    eocd = mm.rfind(_EOCD_SIGNATURE, max(0, size - _EOCD_SEARCH))
+    if eocd < 0 or eocd + _EOCD_STRUCT.size > size:
+        raise _Damaged("ZIP directory missing")
+    fields = _EOCD_STRUCT.unpack(mm[eocd:eocd + _EOCD_STRUCT.size])
+    entries, cd_size, cd_offset = fields[4], fields[5], fields[6]
+    if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF or \
+            (eocd >= 20 and mm[eocd - 20:eocd - 16] == _ZIP64_LOCATOR_SIGNATURE):
+        raise _Unsupported("ZIP64 archives aren't supported")
+
+    cd_start = eocd - cd_size
+    concat = cd_start - cd_offset
+    if cd_start < 0 or concat < 0:
+        raise _Damaged("ZIP directory damaged")
+
+    records = []
+    pos = cd_start
+    while pos < eocd:
+        if mm[pos:pos + 4] != _CENTRAL_SIGNATURE:
+            raise _Damaged("ZIP directory damaged")
+        header = _CENTRAL_STRUCT.unpack(mm[pos:pos + _CENTRAL_STRUCT.size])
+        name_start = pos + _CENTRAL_STRUCT.size
+        name = mm[name_start:name_start + header[12]]
+        end = name_start + header[12] + header[13] + header[14]
+        records.append((pos, end, name, header[18] + concat))
+        pos = end
+    if pos != eocd or len(records) != entries:
+        raise _Damaged("ZIP directory damaged")
+    return eocd, fields, concat, records
+
+
+def _read_entry(mm, local_offset):
+    # Returns the (uncompressed) content of the ZIP entry at local_offset.
+    if local_offset + _LOCAL_STRUCT.size > len(mm):
+        raise _Damaged("License entry is cut off")
+    header = _LOCAL_STRUCT.unpack(mm[local_offset:local_offset + _LOCAL_STRUCT.size])
+    if header[0] != _LOCAL_SIGNATURE:
+        raise _Damaged("License entry damaged")
+    method, compressed_size = header[3], header[8]
+    start = local_offset + _LOCAL_STRUCT.size + header[10] + header[11]
+    if start + compressed_size > len(mm):
+        raise _Damaged("License entry is cut off")
+    data = mm[start:start + compressed_size]
+    if method == 8:
+        import zlib
+        data = zlib.decompress(data, -15)
+    elif method != 0:
+        raise _Damaged("License entry uses an unknown compression")
+    return data
+
+
+def _find_license_header(mm):
+    # Looks for the local header of an injected license entry, for files whose ZIP
+    # directory is gone (cut off). Returns its offset, or None.
+    end = len(mm)
+    while True:
+        pos = mm.rfind(LICENSE_NAME, 0, end)
+        if pos < _LOCAL_STRUCT.size:
+            return None
+        offset = pos - _LOCAL_STRUCT.size
+        if mm[offset:offset + 4] == _LOCAL_SIGNATURE and \
+                _LOCAL_STRUCT.unpack(mm[offset:pos])[10] == len(LICENSE_NAME):
+            return offset
+        end = pos + len(LICENSE_NAME) - 1
+
+
+def _get_publication_parts(mm, eocd, fields, concat, records, license_record):
+    # Returns the pieces that make up the original publication, as (data, start, end)
+    # ranges of the mmap or of small byte strings. (No memoryview: Python 2 can't
+    # create one of an mmap.)
+    license_offset = license_record[3]
+    if len(records) == 1:
+        # PDF (or a publication that was just the data in front of the archive)
+        return [(mm, 0, license_offset)]
+
+    # EPUB: the original directory started where the license entry is now
+    cd = b"".join(mm[start:end] for start, end, name, offset in records if (start, end) != license_record[:2])
+    comment = mm[eocd + _EOCD_STRUCT.size:eocd + _EOCD_STRUCT.size + fields[7]]
+    count = len(records) - 1
+    end_record = _EOCD_STRUCT.pack(_EOCD_SIGNATURE, fields[1], fields[2], count, count,
+        len(cd), license_offset - concat, len(comment)) + comment
+    return [(mm, 0, license_offset), (cd, 0, len(cd)), (end_record, 0, len(end_record))]
+
+
+def audit_file(path):
+    # Returns a dict describing the state of one book. status is one of
+    #   ok          matches its license
+    #   corrupted   different length or hash than the license says
+    #   truncated   shorter than the license says, or the end of the file (with the
+    #               ZIP directory) is missing
+    #   expired     content is fine, but the license isn't valid anymore (or not yet)
+    #   unchecked   license found, but the file can't be checked (ZIP64, ...)
+    #   no_license  not a book from this plugin
+    #   unreadable  the file can't be opened
+    import calibre_plugins.lcplinput.lcpl as lcpl       # type: ignore
+
+    result = {"path": path, "status": "unreadable", "license_id": None, "detail": None,
+        "size": None, "expected_size": None, "rights": None, "elapsed": 0.0}
+    start = time.time()
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                result["status"] = "no_license"
+                result["detail"] = "Empty file"
+                return result
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                _audit_mapped(mm, result, lcpl)
+            finally:
+                mm.close()
+    except _Damaged as e:
+        # The license entry itself is damaged
+        result["status"] = "corrupted"
+        result["detail"] = str(e)
+    except _Unsupported as e:
+        result["status"] = "unchecked"
+        result["detail"] = str(e)
+    except Exception as e:
+        result["status"] = "unreadable"
+        result["detail"] = "{0}: {1}".format(type(e).__name__, e)
+    finally:
+        result["elapsed"] = time.time() - start
+    return result
+
+
+def _audit_mapped(mm, result, lcpl):
+    try:
+        eocd, fields, concat, records = _read_directory(mm)
+    except _Damaged as e:
+        _audit_cut_off(mm, result, lcpl, str(e))
+        return
+
+    licenses = [record for record in records if record[2] == LICENSE_NAME]
+    if not licenses:
+        result["status"] = "no_license"
+        return
+    license_record = licenses[-1]
+    if license_record is not records[-1] or any(record[3] > license_record[3] for record in records):
+        # Not the layout this plugin writes
+        result["status"] = "unchecked"
+        result["detail"] = "License isn't the last ZIP entry"
+        return
+
+    license = lcpl.parse_license(_read_entry(mm, license_record[3]).decode("latin-1"))
+    if license is None or license.publication is None:
+        result["status"] = "unchecked"
+        result["detail"] = "Embedded license is invalid"
+        return
+    result["license_id"] = license.id
+    result["rights"] = license.get_rights_status()
+
+    publication = license.publication
+    parts = _get_publication_parts(mm, eocd, fields, concat, records, license_record)
+    size = sum(end - start for data, start, end in parts)
+    result["size"] = size
+    expected = publication.length if publication.length and publication.length > 0 else None
+    result["expected_size"] = expected
+
+    if expected is not None and size != expected:
+        result["status"] = "truncated" if size < expected else "corrupted"
+        result["detail"] = "Length is {0}, license says {1}".format(size, expected)
+        return
+
+    if publication.hash:
+        digest = hashlib.sha256()
+        for data, start, end in parts:
+            for pos in range(start, end, HASH_SLICE):
+                digest.update(data[pos:min(pos + HASH_SLICE, end)])
+        if digest.hexdigest().lower() != publication.hash:
+            result["status"] = "corrupted"
+            result["detail"] = "SHA256 hash doesn't match the license"
+            return
+    elif expected is None:
+        result["status"] = "unchecked"
+        result["detail"] = "License has neither length nor hash"
+        return
+
+    if result["rights"] is not None:
+        result["status"] = "expired"
+        result["detail"] = "License expired" if result["rights"] == "expired" else "License not valid yet"
+        return
+
+    result["status"] = "ok"
+
+
+def _audit_cut_off(mm, result, lcpl, error):
+    # No usable ZIP directory. If the injected license entry is still there, this
+    # is a book from this plugin that lost its end; otherwise it's some other
+    # (possibly broken) file. A file cut off before the license entry can't be
+    # told apart from a file that never had one.
+    offset = _find_license_header(mm)
+    if offset is None:
+        result["status"] = "no_license"
+        result["detail"] = error
+        return
+
+    result["status"] = "truncated"
+    result["detail"] = "End of the file is missing"
+    result["size"] = len(mm)
+    try:
+        license = lcpl.parse_license(_read_entry(mm, offset).decode("latin-1"))
+    except Exception:
+        # The license entry is cut off as well
+        return
+    if license is not None and license.publication is not None:
+        result["license_id"] = license.id
+        result["rights"] = license.get_rights_status()
+        if license.publication.length and license.publication.length > 0:
+            result["expected_size"] = license.publication.length
+
+
+def extract_license(path, directory):
+    # Writes the embedded license of path to directory, so the book can be fulfilled
+    # again. Returns the name of the LCPL file, or None.
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            try:
+                records = _read_directory(mm)[3]
+                licenses = [record[3] for record in records if record[2] == LICENSE_NAME]
+            except _Damaged:
+                # Cut off, but the license entry may still be complete
+                offset = _find_license_header(mm)
+                licenses = [offset] if offset is not None else []
+            if not licenses:
+                return None
+            data = _read_entry(mm, licenses[-1])
+        finally:
+            mm.close()
+
+    name = os.path.join(directory, os.path.splitext(os.path.basename(path))[0] + ".lcpl")
+    with open(name, "wb") as f:
+        f.write(data)
+    return name
+
+
+def build_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog,
+        description="Check fulfilled EPUB / PDF files against their embedded LCP licenses.")
+    parser.add_argument("inputs", nargs="+", help="books, or directories with books (like a Calibre library)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of parallel workers (default: number of CPUs)")
+    parser.add_argument("--no-recursive", action="store_true", help="don't look into subdirectories")
+    parser.add_argument("--threads", action="store_true", help="use threads instead of worker processes")
+    parser.add_argument("--report", help="write a JSON report with one entry per book to this file")
+    parser.add_argument("--extract-licenses", metavar="DIR",
+        help="write the licenses of corrupted / truncated books to DIR, ready to be fulfilled again")
+    parser.add_argument("-v", "--verbose", action="store_true", help="also list books that are fine")
+    return parser
+
+
+def main(argv, prog=None):
+    import calibre_plugins.lcplinput.cli as cli         # type: ignore
+
+    args = build_parser(prog).parse_args(argv)
+    paths = find_books(args.inputs, not args.no_recursive)
+    if not paths:
+        print("{0} v{1}: No books found".format(PLUGIN_NAME, PLUGIN_VERSION))
+        return 2
+
+    jobs = args.jobs
+    if jobs is None:
+        try:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        except:
+            jobs = 4
+    jobs = max(1, min(jobs, len(paths)))
+    use_processes = not args.threads and jobs > 1 and cli._process_pool_available()
+
+    print("{0} v{1}: Checking {2} files with {3} {4}".format(PLUGIN_NAME, PLUGIN_VERSION,
+        len(paths), jobs, "processes" if use_processes else "threads"))
+
+    results = []
+
+    def on_result(result):
+        results.append(result)
+        if result["status"] in ("ok", "no_license") and not args.verbose:
+            return
+        line = "{0:<11}{1}".format(result["status"], result["path"])
+        if result["detail"]:
+            line += " ({0})".format(result["detail"])
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+    start = time.time()
+    if use_processes:
+        cli._run_processes(audit_file, paths, jobs, on_result)
+    else:
+        # hashlib releases the GIL while hashing, so threads work in parallel too
+        cli._run_threads(audit_file, paths, jobs, on_result, "LCPLInput-audit")
+    wall = time.time() - start
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    checked = sum(result["size"] or 0 for result in results)
+    print("{0} v{1}: {2} books checked: {3}".format(PLUGIN_NAME, PLUGIN_VERSION,
+        len(results) - counts.get("no_license", 0),
+        ", ".join("{0} {1}".format(counts[status], status) for status in sorted(counts) if status != "no_license") or "none"))
+    print("{0} v{1}: {2:.1f} MB checked in {3:.1f} s ({4:.1f} MB/s)".format(PLUGIN_NAME, PLUGIN_VERSION,
+        checked / (1024.0 * 1024.0), wall, checked / (1024.0 * 1024.0) / wall if wall > 0 else 0.0))
+
+    bad = [result for result in results if result["status"] in BAD_STATUSES]
+    if args.extract_licenses and bad:
+        if not os.path.isdir(args.extract_licenses):
+            os.makedirs(args.extract_licenses)
+        extracted = 0
+        for result in bad:
+            try:
+                if extract_license(result["path"], args.extract_licenses) is not None:
+                    extracted += 1
+            except:
+                pass
+        print("{0} v{1}: Wrote {2} licenses to {3}".format(PLUGIN_NAME, PLUGIN_VERSION, extracted, args.extract_licenses))
+
+    if args.report:
+        order = dict((path, i) for i, path in enumerate(paths))
+        results.sort(key=lambda r: order.get(r["path"], 0))
+        with open(args.report, "w") as f:
+            json.dump({"counts": counts, "wall_s": wall, "files": results}, f, indent=2)
+
+    return 1 if bad else 0
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Batch fulfillment of many LCPL files.
+# Each license is handled exactly like a single import (readLCPLfile, then
+# parseLCPLdownloadBook with the parsed license), but several of them run
+# at the same time on worker threads. The number of concurrent downloads is
+# limited globally and per content server, so we don't hammer a single host.
+
+import os
+import threading
+import time
+
+from calibre_plugins.lcplinput.__init__ import PLUGIN_NAME, PLUGIN_VERSION  # type: ignore
+import calibre_plugins.lcplinput.metrics as lcplmetrics                     # type: ignore
+
+
+class BatchResult(object):
+    __slots__ = ("path", "license_id", "host", "output", "error", "elapsed")
+
+    def __init__(self, path):
+        self.path = path
+        self.license_id = None
+        self.host = None
+        self.output = None
+        self.error = None
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return "<BatchResult {0}: {1}>".format(self.path, self.output if self.output is not None else self.error)
+
+
+class _Job(object):
+    __slots__ = ("result", "license")
+
+    def __init__(self, result, license):
+        self.result = result
+        self.license = license
+
+
+class _Scheduler(object):
+    # Hands out jobs to the worker threads. A job is only handed out
+    # if its host is below the per-host limit; otherwise the next one is tried.
+
+    def __init__(self, jobs, max_per_host):
+        self.jobs = list(jobs)
+        self.max_per_host = max(1, max_per_host)
+        self.active = {}
+        self.cond = threading.Condition()
+
+    def take(self):
+        with self.cond:
+            while True:
+                if not self.jobs:
+                    return None
+                for i, job in enumerate(self.jobs):
+                    if self.active.get(job.result.host, 0) < self.max_per_host:
+                        del self.jobs[i]
+                        self.active[job.result.host] = self.active.get(job.result.host, 0) + 1
+                        return job
+                self.cond.wait()
+
+    def done(self, job):
+        with self.cond:
+            self.active[job.result.host] -= 1
+            self.cond.notify_all()
+
+
+def _worker(plugin, scheduler, metrics_file):
+    while True:
+        job = scheduler.take()
+        if job is None:
+            return
+        result = job.result
+        metrics = lcplmetrics.ImportMetrics(os.path.basename(result.path))
+        start = time.time()
+        try:
+            result.output = plugin.parseLCPLdownloadBook(job.license.raw, job.license, metrics)
+            if result.output is None:
+                result.error = "Fulfillment failed"
+        except Exception as e:
+            result.error = "{0}: {1}".format(type(e).__name__, e)
+        finally:
+            result.elapsed = time.time() - start
+            metrics.finish("ok" if result.output is not None else "failed", metrics_file)
+            scheduler.done(job)
+
+
+# Why a book from the plan isn't downloaded
+DROP_REASONS = {
+    "unreadable": "Can't read file",
+    "invalid": "Not an LCPL license file",
+    "no_publication": "No download link found in LCPL",
+    "expired": "LCPL license expired",
+    "not_yet_valid": "LCPL license not valid yet",
+    "known_failure": "Download failed recently, not trying again yet",
+}
+
+
+def fulfill_batch(plugin, paths, max_workers=4, max_per_host=2, metrics_file=None, order="shortest-first", honor_time_limits=True, failures=None):
+    # Returns a list of BatchResult, in the same order as paths.
+    # Downloads are started in the order given by the planner.
+    import calibre_plugins.lcplinput.planner as planner     # type: ignore
+
+    plan = planner.plan_batch(paths, honor_time_limits, order, failures)
+    results = dict((path, BatchResult(path)) for path in paths)
+
+    for planned in plan.dropped:
+        result = results[planned.path]
+        result.license_id = planned.license_id
+        result.error = DROP_REASONS.get(planned.status, planned.status)
+
+    jobs = []
+    for planned in plan.jobs:
+        result = results[planned.path]
+        result.license_id = planned.license_id
+        result.host = planned.host
+        jobs.append(_Job(result, planned.license))
+
+    if jobs:
+        scheduler = _Scheduler(jobs, max_per_host)
+        threads = []
+        for i in range(max(1, min(max_workers, len(jobs)))):
+            t = threading.Thread(target=_worker, args=(plugin, scheduler, metrics_file), name="LCPLInput-batch-{0}".format(i))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    results = [results[path] for path in paths]
+    failed = len([r for r in results if r.output is None])
+    print("{0} v{1}: Batch done, {2} of {3} licenses fulfilled".format(PLUGIN_NAME, PLUGIN_VERSION, len(results) - failed, len(results)))
+    print("{0} v{1}: Import metrics:\n{2}".format(PLUGIN_NAME, PLUGIN_VERSION, lcplmetrics.format_summary()))
+
+    return results
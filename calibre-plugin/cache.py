@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# On-disk cache for downloaded publications.
+# Entries are keyed by the SHA256 hash from the license's publication link
+# (or by the download URL if the license doesn't contain a hash), so importing
+# the same LCPL file again - or another license for the same book - doesn't
+# need any network access at all.
+# Only files that passed all content checks are stored. The cache has a size
+# limit; when it's exceeded, the least recently used entries are deleted.
+#
+# For every download URL we also keep the validators (ETag, Last-Modified,
+# Content-Length) of the response that produced the entry. Licenses without a
+# hash - or renewed licenses for the same URL - can then send a conditional
+# request and reuse the entry if the server answers "304 Not Modified".
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+# Counters for this Calibre process. Totals across runs are kept in stats.json.
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def get_cache_key(sha256_hash, href):
+    if sha256_hash:
+        return sha256_hash.lower()
+    return "url-" + hashlib.sha256(href.encode("utf-8")).hexdigest()
+
+
+def get_session_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+class PublicationCache(object):
+    def __init__(self, directory, max_size):
+        # type: (str, int) -> None
+        self.directory = directory
+        self.max_size = max_size
+        self.stats_path = os.path.join(directory, "stats.json")
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + ".pub")
+
+    def _validators_path(self, href):
+        return os.path.join(self.directory, get_cache_key(None, href) + ".validators.json")
+
+    def _count(self, name, amount=1):
+        with _stats_lock:
+            _stats[name] += amount
+            try:
+                with open(self.stats_path, "r") as f:
+                    totals = json.load(f)
+            except:
+                totals = {}
+            totals[name] = totals.get(name, 0) + amount
+            try:
+                with open(self.stats_path, "w") as f:
+                    json.dump(totals, f)
+            except:
+                pass
+
+    def get_stats(self):
+        # Returns the totals across all Calibre runs.
+        try:
+            with open(self.stats_path, "r") as f:
+                totals = json.load(f)
+        except:
+            totals = {}
+        for name in ("hits", "misses", "evictions"):
+            totals.setdefault(name, 0)
+        entries = self._list_entries()
+        totals["entries"] = len(entries)
+        totals["size"] = sum(size for _, size, _ in entries)
+        return totals
+
+    def contains(self, key):
+        return os.path.isfile(self._entry_path(key))
+
+    def fetch(self, key, outputname, expected_size=0):
+        # Copies a cached publication to outputname. Returns True on a cache hit.
+        # The copy is necessary (no hardlink) because the caller injects the
+        # license into the output file, which would modify the cached entry, too.
+        path = self._entry_path(key)
+        try:
+            if expected_size > 0 and os.path.getsize(path) != expected_size:
+                raise ValueError("Cached publication has the wrong size")
+            shutil.copyfile(path, outputname)
+            # Mark as recently used
+            os.utime(path, None)
+        except:
+            self._count("misses")
+            return False
+
+        self._count("hits")
+        return True
+
+    def fetch_verified(self, key, outputname, sha256):
+        # Like fetch, but the SHA256 hash of the entry is checked while copying.
+        # Returns the size on success. A damaged entry is deleted.
+        path = self._entry_path(key)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(path, "rb") as src, open(outputname, "wb") as dst:
+                while True:
+                    data = src.read(256 * 1024)
+                    if not data:
+                        break
+                    digest.update(data)
+                    dst.write(data)
+                    size += len(data)
+        except:
+            self._count("misses")
+            return None
+
+        if digest.hexdigest().lower() != sha256.lower():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._count("misses")
+            return None
+
+        os.utime(path, None)
+        self._count("hits")
+        return size
+
+    def get_validators(self, href):
+        # Returns the validators stored for href (a dict with "key", "url", "etag", 
+        # "last_modified", "content_length", "sha256", "size"), or None if there 
+        # are none or the cache entry they belong to is gone.
+        path = self._validators_path(href)
+        try:
+            with open(path, "r") as f:
+                validators = json.load(f)
+            if not os.path.isfile(self._entry_path(validators["key"])):
+                raise ValueError("Cache entry is gone")
+            return validators
+        except:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def _store_validators(self, href, validators):
+        try:
+            with open(self._validators_path(href), "w") as f:
+                json.dump(validators, f)
+        except:
+            pass
+
+    def store(self, key, filename, href=None, validators=None):
+        # Adds a (verified) publication to the cache, then enforces the size limit.
+        # validators (see get_validators) are stored for href, if given.
+        path = self._entry_path(key)
+        tmp_path = "{0}.{1}.tmp".format(path, threading.current_thread().ident)
+        try:
+            if os.path.getsize(filename) > self.max_size:
+                return False
+            shutil.copyfile(filename, tmp_path)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+
+        if href is not None and validators is not None:
+            validators = dict(validators, key=key)
+            self._store_validators(href, validators)
+
+        self.evict(keep=path)
+        return True
+
+    def _list_entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pub"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def evict(self, keep=None):
+        # Deletes least recently used entries until the cache fits into max_size.
+        entries = self._list_entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+
+        for path, size, _ in sorted(entries, key=lambda e: e[2]):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        if evicted > 0:
+            self._count("evictions", evicted)
+        return evicted
+
+    def clear(self):
+        for path, _, _ in self._list_entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        for name in os.listdir(self.directory):
+            if name.endswith(".validators.json"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Headless batch fulfillment for the LCPL Input plugin.
+# Turns a directory (or manifest) full of LCPL files into LCP-protected EPUB / PDF
+# files in an output directory, without going through Calibre's import.
+#
+# Inside Calibre:
+#   calibre-debug -r "LCPL Input" -- [options] input [input ...] -o OUTPUT_DIR
+# Standalone (with the Calibre shims from the tools directory):
+#   python3 tools/lcpl_fulfill.py [options] input [input ...] -o OUTPUT_DIR
+#
+# Every input is either an LCPL file, a directory with LCPL files or (with
+# --manifest) a text file listing one LCPL file per line. Books are fulfilled in
+# a pool of worker processes, in the order picked by the planner (planner.py;
+# --dry-run only prints that plan). A book is skipped if the output directory
+# already contains a finished file for the same license.
+#
+# With "audit" as the first argument, the given books (or a whole Calibre library)
+# are checked against their embedded licenses instead, see audit.py.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+from calibre_plugins.lcplinput.__init__ import PLUGIN_NAME, PLUGIN_VERSION  # type: ignore
+
+
+# Set in every worker process (and in the main process for the thread fallback)
+_worker_state = {}
+
+
+def read_manifest(path):
+    # One LCPL path per line, relative paths are relative to the manifest.
+    # Empty lines and lines starting with # are ignored.
+    base = os.path.dirname(os.path.abspath(path))
+    paths = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            paths.append(os.path.join(base, line))
+    return paths
+
+
+def collect_inputs(inputs, manifests, recursive=False):
+    # Returns a list of (LCPL path, output name). The output name is the file name
+    # without extension; for files found in subdirectories it keeps the path
+    # relative to the input directory, so a/same.lcpl and b/same.lcpl don't end
+    # up in the same output file.
+    paths = []
+    for manifest in manifests:
+        paths.extend((path, get_output_name(path)) for path in read_manifest(manifest))
+
+    for item in inputs:
+        if os.path.isdir(item):
+            if recursive:
+                for root, dirs, files in os.walk(item):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name.lower().endswith(".lcpl"):
+                            path = os.path.join(root, name)
+                            paths.append((path, os.path.splitext(os.path.relpath(path, item))[0]))
+            else:
+                for name in sorted(os.listdir(item)):
+                    if name.lower().endswith(".lcpl"):
+                        path = os.path.join(item, name)
+                        paths.append((path, get_output_name(path)))
+        else:
+            paths.append((item, get_output_name(item)))
+
+    # Drop duplicates, keep the order
+    seen = set()
+    unique = []
+    for path, name in paths:
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            unique.append((path, name))
+    return unique
+
+
+def get_output_name(lcpl_path):
+    return os.path.splitext(os.path.basename(lcpl_path))[0]
+
+
+def get_output_path(output_dir, name, license):
+    return os.path.join(output_dir, name + license.publication.extension)
+
+
+def find_collisions(jobs, names, output_dir):
+    # Returns {path: earlier path} for planned jobs whose output file is already used by
+    # an earlier job (same file name from different manifests / input directories).
+    owners = {}
+    collisions = {}
+    for planned in jobs:
+        output_path = get_output_path(output_dir, names[planned.path], planned.license)
+        key = os.path.normcase(os.path.abspath(output_path))
+        if key in owners:
+            collisions[planned.path] = owners[key]
+        else:
+            owners[key] = planned.path
+    return collisions
+
+
+def is_complete(output_path, license):
+    # Outputs are only ever moved into place once they are finished, so an existing
+    # file is complete - as long as it belongs to the same license.
+    if not os.path.isfile(output_path):
+        return False
+
+    from zipfile import ZipFile
+    from contextlib import closing
+    try:
+        with closing(ZipFile(output_path, 'r')) as zf:
+            injected = zf.read("META-INF/license.lcpl")
+    except:
+        return False
+
+    # Same encoding as ZipFile.writestr used when the license was injected
+    raw = license.raw
+    if not isinstance(raw, bytes):
+        raw = raw.encode("utf-8")
+    return injected == raw
+
+
+def _move_into_place(source, output_path):
+    # Copy (if needed) next to the final name, then rename, so a half-written
+    # output never looks complete.
+    directory = os.path.dirname(output_path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another worker was faster
+            if not os.path.isdir(directory):
+                raise
+    tmp_path = "{0}.{1}.tmp".format(output_path, os.getpid())
+    shutil.move(source, tmp_path)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    os.rename(tmp_path, output_path)
+
+
+def _update_index(plugin, license, output_path):
+    # The fulfillment index points to the temporary file, which is gone now
+    import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+
+    fulfillments = plugin.getFulfillmentIndex(prefs.get_settings())
+    if fulfillments is None:
+        return
+    try:
+        if fulfillments.find_license(license.id) is not None:
+            fulfillments.update_path(license.id, output_path)
+    except:
+        pass
+
+
+def fulfill_one(plugin, lcpl_path, output_dir, force=False, metrics_file=None, name=None, license=None):
+    # Returns a dict describing the result (so it can be sent back from a worker process).
+    # name is the output name from collect_inputs (default: the LCPL file name).
+    # license is the license the planner already read from lcpl_path, if any.
+    import calibre_plugins.lcplinput.metrics as lcplmetrics     # type: ignore
+
+    result = {"path": lcpl_path, "output": None, "status": "failed", "error": None, "size": 0, "elapsed": 0.0}
+    start = time.time()
+
+    if license is None:
+        try:
+            license = plugin.readLCPLfile(lcpl_path)
+        except Exception as e:
+            result["error"] = "Can't read file: {0}".format(e)
+            return result
+    if license is None or license.publication is None:
+        result["error"] = "Not an LCPL license file"
+        return result
+
+    output_path = get_output_path(output_dir, name or get_output_name(lcpl_path), license)
+    result["output"] = output_path
+
+    if not force and is_complete(output_path, license):
+        result["status"] = "skipped"
+        result["size"] = os.path.getsize(output_path)
+        return result
+
+    metrics = lcplmetrics.ImportMetrics(os.path.basename(lcpl_path))
+    outputname = None
+    try:
+        outputname = plugin.parseLCPLdownloadBook(license.raw, license, metrics)
+        if outputname is None:
+            result["error"] = "Fulfillment failed"
+        else:
+            _move_into_place(outputname, output_path)
+            result["status"] = "fulfilled"
+            result["size"] = os.path.getsize(output_path)
+            _update_index(plugin, license, output_path)
+    except Exception as e:
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+        if outputname is not None and os.path.exists(outputname):
+            try:
+                os.remove(outputname)
+            except OSError:
+                pass
+    finally:
+        metrics.finish("ok" if result["status"] == "fulfilled" else "failed", metrics_file)
+        result["elapsed"] = time.time() - start
+
+    return result
+
+
+def _init_worker(quiet, reserved, jobs):
+    import calibre_plugins.lcplinput.diskspace as diskspace     # type: ignore
+    import calibre_plugins.lcplinput.ratelimit as ratelimit     # type: ignore
+    import calibre_plugins.lcplinput.sqlitedb as sqlitedb     # type: ignore
+
+    # Idle HTTP connections and the SQLite connections of the fulfillment index
+    # and the failure list inherited from the parent belong to the parent
+    sqlitedb.reset_shared()
+    # Disk space reservations are shared by all workers
+    diskspace.set_shared_counter(reserved)
+    # Every worker gets an equal share of the download limits
+    ratelimit.set_share(1.0 / jobs)
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+
+
+def _run_task(task):
+    lcpl_path, output_dir, force, metrics_file, name = task
+    return fulfill_one(_worker_state["plugin"], lcpl_path, output_dir, force, metrics_file, name,
+        _worker_state["licenses"].get(lcpl_path))
+
+
+def _dropped_result(planned):
+    import calibre_plugins.lcplinput.batch as batch     # type: ignore
+
+    return {"path": planned.path, "output": None, "status": "failed", "size": 0, "elapsed": 0.0,
+        "error": batch.DROP_REASONS.get(planned.status, planned.status)}
+
+
+def _process_pool_available():
+    # Workers get the already loaded plugin by forking. Without fork (Windows, macOS
+    # defaults) the plugin package can't be re-imported in a fresh interpreter, so
+    # we use threads instead.
+    try:
+        import multiprocessing
+        if hasattr(multiprocessing, "get_all_start_methods"):
+            return "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin"
+        return hasattr(os, "fork")
+    except:
+        return False
+
+
+def _get_fork_context():
+    import multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        return multiprocessing.get_context("fork")
+    return multiprocessing
+
+
+def _run_processes(func, tasks, jobs, on_result, initializer=None, initargs=()):
+    # Runs func(task) for all tasks in a pool of forked worker processes and calls
+    # on_result (in this process) with every result, in the order they finish.
+    pool = _get_fork_context().Pool(jobs, initializer, initargs)
+    try:
+        for result in pool.imap_unordered(func, tasks):
+            on_result(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _run_threads(func, tasks, jobs, on_result, name="LCPLInput-cli"):
+    # Same as _run_processes, with threads. on_result is called with a lock held.
+    lock = threading.Lock()
+    pending = list(tasks)
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                task = pending.pop(0)
+            result = func(task)
+            with lock:
+                on_result(result)
+
+    threads = []
+    for i in range(max(1, min(jobs, len(tasks)))):
+        t = threading.Thread(target=worker, name="{0}-{1}".format(name, i))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+
+def summarize(results, wall):
+    import calibre_plugins.lcplinput.metrics as lcplmetrics     # type: ignore
+
+    fulfilled = [r for r in results if r["status"] == "fulfilled"]
+    downloaded = sum(r["size"] for r in fulfilled)
+    latencies = [r["elapsed"] for r in fulfilled]
+    return {
+        "files": len(results),
+        "fulfilled": len(fulfilled),
+        "skipped": len([r for r in results if r["status"] == "skipped"]),
+        "failed": len([r for r in results if r["status"] == "failed"]),
+        "bytes": downloaded,
+        "wall_s": wall,
+        "mb_per_s": downloaded / (1024.0 * 1024.0) / wall if wall > 0 else 0.0,
+        "latency_p50_s": lcplmetrics.percentile(latencies, 50) or 0.0,
+        "latency_p95_s": lcplmetrics.percentile(latencies, 95) or 0.0,
+    }
+
+
+def build_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog,
+        description="Fulfill LCPL license files into LCP-protected EPUB / PDF files.")
+    parser.add_argument("inputs", nargs="*", help="LCPL files or directories containing LCPL files")
+    parser.add_argument("-m", "--manifest", action="append", default=[],
+        help="text file listing one LCPL file per line (can be given more than once)")
+    parser.add_argument("-o", "--output-dir", required=True, help="where the finished books are written")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="number of parallel workers (default: number of CPUs, at least 4)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="also look for LCPL files in subdirectories")
+    parser.add_argument("--force", action="store_true", help="fulfill again even if the output already exists")
+    parser.add_argument("--clear-failures", action="store_true",
+        help="forget about earlier failed downloads, so all licenses are tried again")
+    parser.add_argument("--threads", action="store_true", help="use threads instead of worker processes")
+    parser.add_argument("--report", help="write a JSON report with one entry per file to this file")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the progress and the summary")
+    parser.add_argument("--order", choices=["shortest-first", "round-robin", "fifo"], default=None,
+        help="order in which the books are downloaded (default: from the plugin settings)")
+    parser.add_argument("--dry-run", action="store_true",
+        help="only read the LCPL files and print what would be downloaded, and how long it would take")
+    parser.add_argument("--bandwidth", type=float, default=None,
+        help="expected bandwidth in MB/s for the dry run's time estimate (default: from the plugin settings)")
+    return parser
+
+
+def main(plugin, argv, prog=None):
+    # plugin is an LCPLInput instance. Returns the exit code.
+    import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+
+    if argv and argv[0] == "audit":
+        import calibre_plugins.lcplinput.audit as audit     # type: ignore
+        return audit.main(argv[1:], (prog or os.path.basename(sys.argv[0])) + " audit")
+
+    args = build_parser(prog).parse_args(argv)
+
+    inputs = collect_inputs(args.inputs, args.manifest, args.recursive)
+    paths = [path for path, name in inputs]
+    names = dict(inputs)
+    if not paths:
+        print("{0} v{1}: No LCPL files found".format(PLUGIN_NAME, PLUGIN_VERSION))
+        return 2
+
+    jobs = args.jobs
+    if jobs is None:
+        try:
+            import multiprocessing
+            jobs = max(4, multiprocessing.cpu_count())
+        except:
+            jobs = 4
+    jobs = max(1, min(jobs, len(paths)))
+
+    settings = prefs.get_settings()
+    if args.clear_failures:
+        failures = plugin.getFailureCache(settings)
+        if failures is not None:
+            failures.clear()
+    plan = plugin.planBatch(paths, args.order)
+
+    # Only the first of several licenses with the same output file is fulfilled
+    collisions = find_collisions(plan.jobs, names, args.output_dir)
+    if collisions:
+        plan.jobs = [planned for planned in plan.jobs if planned.path not in collisions]
+
+    if args.dry_run:
+        return _dry_run(plan, args, jobs, settings, names, collisions)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    metrics_file = settings["metrics_file"]
+    tasks = [(planned.path, args.output_dir, args.force, metrics_file, names[planned.path]) for planned in plan.jobs]
+
+    use_processes = not args.threads and jobs > 1 and _process_pool_available()
+    print("{0} v{1}: Fulfilling {2} LCPL files with {3} {4}".format(PLUGIN_NAME, PLUGIN_VERSION,
+        len(tasks), jobs, "processes" if use_processes else "threads"))
+
+    _worker_state["plugin"] = plugin
+    # The planner already parsed the licenses. Forked workers inherit them,
+    # so they don't have to be sent along with the tasks.
+    _worker_state["licenses"] = dict((planned.path, planned.license) for planned in plan.jobs)
+    results = []
+
+    def on_result(result):
+        results.append(result)
+        if result["status"] == "failed":
+            line = "FAILED  {0}: {1}".format(result["path"], result["error"])
+        else:
+            line = "{0:<10}{1}".format(result["status"], result["output"])
+        sys.__stdout__.write("[{0}/{1}] {2}\n".format(len(results), len(paths), line))
+        sys.__stdout__.flush()
+
+    # Licenses the planner already rejected (expired, ...) aren't handed to the workers
+    for planned in plan.dropped:
+        on_result(_dropped_result(planned))
+    for path in paths:
+        if path in collisions:
+            on_result({"path": path, "output": None, "status": "failed", "size": 0, "elapsed": 0.0,
+                "error": "Same output file as {0}".format(collisions[path])})
+
+    start = time.time()
+    if args.quiet and not use_processes:
+        old_stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        if use_processes:
+            _run_processes(_run_task, tasks, jobs, on_result, _init_worker,
+                (args.quiet, _get_fork_context().Value("d", 0.0), jobs))
+        else:
+            _run_threads(_run_task, tasks, jobs, on_result)
+    finally:
+        if args.quiet and not use_processes:
+            sys.stdout.close()
+            sys.stdout = old_stdout
+    summary = summarize(results, time.time() - start)
+
+    print("{0} v{1}: {2} files: {3} fulfilled, {4} already complete, {5} failed".format(PLUGIN_NAME, PLUGIN_VERSION,
+        summary["files"], summary["fulfilled"], summary["skipped"], summary["failed"]))
+    print("{0} v{1}: {2:.1f} MB in {3:.1f} s ({4:.1f} MB/s), per book p50 {5:.2f} s, p95 {6:.2f} s".format(PLUGIN_NAME, PLUGIN_VERSION,
+        summary["bytes"] / (1024.0 * 1024.0), summary["wall_s"], summary["mb_per_s"], summary["latency_p50_s"], summary["latency_p95_s"]))
+
+    if args.report:
+        order = dict((path, i) for i, path in enumerate(paths))
+        results.sort(key=lambda r: order.get(r["path"], 0))
+        with open(args.report, "w") as f:
+            json.dump({"summary": summary, "files": results}, f, indent=2)
+
+    return 1 if summary["failed"] else 0
+
+
+def _dry_run(plan, args, jobs, settings, names, collisions):
+    import calibre_plugins.lcplinput.planner as planner     # type: ignore
+    import calibre_plugins.lcplinput.diskspace as diskspace     # type: ignore
+
+    if not args.force:
+        # Books that are already in the output directory won't be downloaded again
+        remaining = []
+        for planned in plan.jobs:
+            if is_complete(get_output_path(args.output_dir, names[planned.path], planned.license), planned.license):
+                planned.status = "complete"
+                plan.dropped.append(planned)
+            else:
+                remaining.append(planned)
+        plan.jobs = remaining
+
+    bandwidth = (args.bandwidth if args.bandwidth is not None else settings["batch_bandwidth_mb"]) * 1024 * 1024
+    if settings["max_download_rate_kb"] > 0:
+        bandwidth = min(bandwidth, settings["max_download_rate_kb"] * 1024)
+    planner.print_plan(plan, bandwidth, jobs)
+    for path in sorted(collisions):
+        print("{0} v{1}: {2} has the same output file as {3}, it won't be fulfilled".format(PLUGIN_NAME, PLUGIN_VERSION,
+            path, collisions[path]))
+
+    free = diskspace.get_free_space(args.output_dir if os.path.isdir(args.output_dir) else os.path.dirname(os.path.abspath(args.output_dir)))
+    if free is not None:
+        print("{0} v{1}: {2} free in the output directory{3}".format(PLUGIN_NAME, PLUGIN_VERSION, planner.format_size(free),
+            " - NOT ENOUGH" if free < plan.total_bytes else ""))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(plan.to_dict(bandwidth, jobs), f, indent=2)
+    return 0
@@ -28,6 +28,20 @@ class ConfigWidget(QWidget):
         self.templcplinputprefs['use_custom_ua'] = self.lcplinputprefs['use_custom_ua']
         self.templcplinputprefs['ignore_content_errors'] = self.lcplinputprefs['ignore_content_errors']
         self.templcplinputprefs['honor_license_time_limits'] = self.lcplinputprefs['honor_license_time_limits']
+        self.templcplinputprefs['publication_cache_size_mb'] = self.lcplinputprefs['publication_cache_size_mb']
+        self.templcplinputprefs['batch_max_downloads'] = self.lcplinputprefs['batch_max_downloads']
+        self.templcplinputprefs['batch_max_downloads_per_host'] = self.lcplinputprefs['batch_max_downloads_per_host']
+        self.templcplinputprefs['batch_order'] = self.lcplinputprefs['batch_order']
+        self.templcplinputprefs['batch_bandwidth_mb'] = self.lcplinputprefs['batch_bandwidth_mb']
+        self.templcplinputprefs['max_download_rate_kb'] = self.lcplinputprefs['max_download_rate_kb']
+        self.templcplinputprefs['max_host_download_rate_kb'] = self.lcplinputprefs['max_host_download_rate_kb']
+        self.templcplinputprefs['max_requests_per_minute'] = self.lcplinputprefs['max_requests_per_minute']
+        self.templcplinputprefs['metrics_file'] = self.lcplinputprefs['metrics_file']
+        self.templcplinputprefs['download_segments'] = self.lcplinputprefs['download_segments']
+        self.templcplinputprefs['prefetch_auto_add'] = self.lcplinputprefs['prefetch_auto_add']
+        self.templcplinputprefs['fulfillment_index'] = self.lcplinputprefs['fulfillment_index']
+        self.templcplinputprefs['failure_cache'] = self.lcplinputprefs['failure_cache']
+        self.templcplinputprefs['prefetch_max_downloads'] = self.lcplinputprefs['prefetch_max_downloads']
 
 
         # Start Qt Gui dialog layout
@@ -68,6 +82,163 @@ class ConfigWidget(QWidget):
         self.chkHonorTimeLimits.setChecked(self.templcplinputprefs['honor_license_time_limits'])
         other_group_box_layout.addWidget(self.chkHonorTimeLimits)
 
+        self.chkFulfillmentIndex = QtGui.QCheckBox(_("Remember fulfilled licenses"))
+        self.chkFulfillmentIndex.setToolTip(_("Default: True \n\nIf the same LCPL file (or another license for the same book) is imported again \nand the earlier output file still exists, that file is reused instead of downloading the book again."))
+        self.chkFulfillmentIndex.setChecked(self.templcplinputprefs['fulfillment_index'])
+        other_group_box_layout.addWidget(self.chkFulfillmentIndex)
+
+        failures_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(failures_layout)
+        self.chkFailureCache = QtGui.QCheckBox(_("Remember failed downloads"))
+        self.chkFailureCache.setToolTip(_("Default: True \n\nIf a download link is dead (or the server can't be reached), importing the same LCPL file again \nfails right away instead of trying again. The next attempt is allowed after a while (longer after every failure)."))
+        self.chkFailureCache.setChecked(self.templcplinputprefs['failure_cache'])
+        failures_layout.addWidget(self.chkFailureCache)
+        self.btnClearFailures = QtGui.QPushButton(_("Clear failed downloads"), self)
+        self.btnClearFailures.clicked.connect(self.clear_failures)
+        failures_layout.addWidget(self.btnClearFailures)
+
+        segments_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(segments_layout)
+        segments_layout.addWidget(QtGui.QLabel(_("Connections per download:")))
+        self.spinSegments = QtGui.QSpinBox(self)
+        self.spinSegments.setRange(1, 16)
+        self.spinSegments.setToolTip(_("Default: 4 \n\nLarge books are downloaded in several parts at the same time, if the server supports that. \nSet to 1 to always download over a single connection."))
+        self.spinSegments.setValue(self.templcplinputprefs['download_segments'])
+        segments_layout.addWidget(self.spinSegments)
+
+
+        cache_group_box = QGroupBox(_('Publication cache:'), self)
+        layout.addWidget(cache_group_box)
+        cache_group_box_layout = QVBoxLayout()
+        cache_group_box.setLayout(cache_group_box_layout)
+
+        cache_size_layout = QHBoxLayout()
+        cache_group_box_layout.addLayout(cache_size_layout)
+        cache_size_layout.addWidget(QtGui.QLabel(_("Maximum cache size (MB, 0 = disabled):")))
+        self.spinCacheSize = QtGui.QSpinBox(self)
+        self.spinCacheSize.setRange(0, 1024 * 1024)
+        self.spinCacheSize.setToolTip(_("Default: 1024 \n\nDownloaded books are kept in a local cache, so importing the same LCPL file again doesn't need to download the book again. \nWhen the cache is full, the books that haven't been used for the longest time are removed."))
+        self.spinCacheSize.setValue(self.templcplinputprefs['publication_cache_size_mb'])
+        cache_size_layout.addWidget(self.spinCacheSize)
+
+        self.lblCacheStats = QtGui.QLabel(self)
+        cache_group_box_layout.addWidget(self.lblCacheStats)
+
+        self.btnClearCache = QtGui.QPushButton(_("Clear cache"), self)
+        self.btnClearCache.clicked.connect(self.clear_cache)
+        cache_group_box_layout.addWidget(self.btnClearCache)
+
+        self.update_cache_stats()
+
+
+        batch_group_box = QGroupBox(_('Batch downloads:'), self)
+        layout.addWidget(batch_group_box)
+        batch_group_box_layout = QVBoxLayout()
+        batch_group_box.setLayout(batch_group_box_layout)
+
+        batch_max_layout = QHBoxLayout()
+        batch_group_box_layout.addLayout(batch_max_layout)
+        batch_max_layout.addWidget(QtGui.QLabel(_("Concurrent downloads:")))
+        self.spinBatchMax = QtGui.QSpinBox(self)
+        self.spinBatchMax.setRange(1, 64)
+        self.spinBatchMax.setToolTip(_("Default: 4 \n\nHow many books are downloaded at the same time when fulfilling many LCPL files at once."))
+        self.spinBatchMax.setValue(self.templcplinputprefs['batch_max_downloads'])
+        batch_max_layout.addWidget(self.spinBatchMax)
+
+        batch_host_layout = QHBoxLayout()
+        batch_group_box_layout.addLayout(batch_host_layout)
+        batch_host_layout.addWidget(QtGui.QLabel(_("Concurrent downloads per server:")))
+        self.spinBatchMaxPerHost = QtGui.QSpinBox(self)
+        self.spinBatchMaxPerHost.setRange(1, 64)
+        self.spinBatchMaxPerHost.setToolTip(_("Default: 2 \n\nHow many books are downloaded from the same server at the same time."))
+        self.spinBatchMaxPerHost.setValue(self.templcplinputprefs['batch_max_downloads_per_host'])
+        batch_host_layout.addWidget(self.spinBatchMaxPerHost)
+
+        batch_order_layout = QHBoxLayout()
+        batch_group_box_layout.addLayout(batch_order_layout)
+        batch_order_layout.addWidget(QtGui.QLabel(_("Download order:")))
+        self.cmbBatchOrder = QtGui.QComboBox(self)
+        self.cmbBatchOrder.addItem(_("Smallest books first"), "shortest-first")
+        self.cmbBatchOrder.addItem(_("Alternate between servers"), "round-robin")
+        self.cmbBatchOrder.addItem(_("As given"), "fifo")
+        self.cmbBatchOrder.setToolTip(_("Default: Smallest books first \n\nIn which order the books of a batch are downloaded. \nSmallest first means most books are done early, and a few large books don't hold up the rest."))
+        self.cmbBatchOrder.setCurrentIndex(max(0, self.cmbBatchOrder.findData(self.templcplinputprefs['batch_order'])))
+        batch_order_layout.addWidget(self.cmbBatchOrder)
+
+        batch_bandwidth_layout = QHBoxLayout()
+        batch_group_box_layout.addLayout(batch_bandwidth_layout)
+        batch_bandwidth_layout.addWidget(QtGui.QLabel(_("Expected bandwidth (MB/s):")))
+        self.spinBatchBandwidth = QtGui.QSpinBox(self)
+        self.spinBatchBandwidth.setRange(1, 10000)
+        self.spinBatchBandwidth.setToolTip(_("Default: 10 \n\nOnly used to estimate how long a batch will take (dry run)."))
+        self.spinBatchBandwidth.setValue(self.templcplinputprefs['batch_bandwidth_mb'])
+        batch_bandwidth_layout.addWidget(self.spinBatchBandwidth)
+
+
+        limits_group_box = QGroupBox(_('Download limits (0 = unlimited):'), self)
+        layout.addWidget(limits_group_box)
+        limits_group_box_layout = QVBoxLayout()
+        limits_group_box.setLayout(limits_group_box_layout)
+
+        rate_layout = QHBoxLayout()
+        limits_group_box_layout.addLayout(rate_layout)
+        rate_layout.addWidget(QtGui.QLabel(_("Total download rate (KB/s):")))
+        self.spinMaxRate = QtGui.QSpinBox(self)
+        self.spinMaxRate.setRange(0, 10000000)
+        self.spinMaxRate.setToolTip(_("Default: 0 \n\nLimits the bandwidth used by all downloads together."))
+        self.spinMaxRate.setValue(self.templcplinputprefs['max_download_rate_kb'])
+        rate_layout.addWidget(self.spinMaxRate)
+
+        host_rate_layout = QHBoxLayout()
+        limits_group_box_layout.addLayout(host_rate_layout)
+        host_rate_layout.addWidget(QtGui.QLabel(_("Download rate per server (KB/s):")))
+        self.spinMaxHostRate = QtGui.QSpinBox(self)
+        self.spinMaxHostRate.setRange(0, 10000000)
+        self.spinMaxHostRate.setToolTip(_("Default: 0 \n\nLimits the bandwidth used for downloads from the same server."))
+        self.spinMaxHostRate.setValue(self.templcplinputprefs['max_host_download_rate_kb'])
+        host_rate_layout.addWidget(self.spinMaxHostRate)
+
+        rpm_layout = QHBoxLayout()
+        limits_group_box_layout.addLayout(rpm_layout)
+        rpm_layout.addWidget(QtGui.QLabel(_("Requests per minute per server:")))
+        self.spinMaxRequests = QtGui.QSpinBox(self)
+        self.spinMaxRequests.setRange(0, 100000)
+        self.spinMaxRequests.setToolTip(_("Default: 0 \n\nSpaces out the requests to the same server. \nServers that answer \"too many requests\" are slowed down automatically."))
+        self.spinMaxRequests.setValue(self.templcplinputprefs['max_requests_per_minute'])
+        rpm_layout.addWidget(self.spinMaxRequests)
+
+
+        prefetch_group_box = QGroupBox(_('Auto-add folder:'), self)
+        layout.addWidget(prefetch_group_box)
+        prefetch_group_box_layout = QVBoxLayout()
+        prefetch_group_box.setLayout(prefetch_group_box_layout)
+
+        self.chkPrefetch = QtGui.QCheckBox(_("Download books in the background"))
+        self.chkPrefetch.setToolTip(_("Default: False \n\nIf enabled, books for LCPL files in Calibre's auto-add folder are downloaded as soon as the files show up, \nso importing them later is almost instant."))
+        self.chkPrefetch.setChecked(self.templcplinputprefs['prefetch_auto_add'])
+        prefetch_group_box_layout.addWidget(self.chkPrefetch)
+
+        prefetch_max_layout = QHBoxLayout()
+        prefetch_group_box_layout.addLayout(prefetch_max_layout)
+        prefetch_max_layout.addWidget(QtGui.QLabel(_("Concurrent background downloads:")))
+        self.spinPrefetchMax = QtGui.QSpinBox(self)
+        self.spinPrefetchMax.setRange(1, 16)
+        self.spinPrefetchMax.setToolTip(_("Default: 2 \n\nHow many books are downloaded in the background at the same time."))
+        self.spinPrefetchMax.setValue(self.templcplinputprefs['prefetch_max_downloads'])
+        prefetch_max_layout.addWidget(self.spinPrefetchMax)
+
+
+        metrics_group_box = QGroupBox(_('Import metrics:'), self)
+        layout.addWidget(metrics_group_box)
+        metrics_group_box_layout = QVBoxLayout()
+        metrics_group_box.setLayout(metrics_group_box_layout)
+
+        metrics_group_box_layout.addWidget(QtGui.QLabel(_("Metrics file (empty = disabled):")))
+        self.txtboxMetricsFile = QtGui.QLineEdit(self)
+        self.txtboxMetricsFile.setToolTip(_("Default: empty \n\nIf set, one JSON line with timings (parse, connect, transfer, hashing, plugins, ...) \nand byte counters is appended to this file for every imported LCPL file."))
+        self.txtboxMetricsFile.setText(self.templcplinputprefs['metrics_file'])
+        metrics_group_box_layout.addWidget(self.txtboxMetricsFile)
+
 
 
         self.resize(self.sizeHint())
@@ -75,13 +246,50 @@ class ConfigWidget(QWidget):
     def chkUAchanged(self):
         self.txtboxUA.setEnabled(self.chkDefaultUA.isChecked())
 
+    def get_publication_cache(self):
+        import calibre_plugins.lcplinput.cache as cache                         # type: ignore
+        return cache.PublicationCache(prefs.get_plugin_cache_dir("publications"), self.spinCacheSize.value() * 1024 * 1024)
+
+    def update_cache_stats(self):
+        try:
+            stats = self.get_publication_cache().get_stats()
+            self.lblCacheStats.setText(_("{0} books, {1:.1f} MB - {2} hits, {3} misses, {4} evictions").format(
+                stats["entries"], stats["size"] / (1024.0 * 1024.0), stats["hits"], stats["misses"], stats["evictions"]))
+        except:
+            self.lblCacheStats.setText(_("Cache statistics unavailable"))
+
+    def clear_cache(self):
+        self.get_publication_cache().clear()
+        self.update_cache_stats()
 
+    def clear_failures(self):
+        import calibre_plugins.lcplinput.negcache as negcache                   # type: ignore
+        import os
+        try:
+            negcache.get_cache(os.path.join(prefs.get_plugin_cache_dir(), "failures.sqlite")).clear()
+        except:
+            import traceback
+            traceback.print_exc()
 
     def save_settings(self):
         self.lcplinputprefs.set('useragent', self.txtboxUA.text())
         self.lcplinputprefs.set('use_custom_ua', self.chkDefaultUA.isChecked())
         self.lcplinputprefs.set('ignore_content_errors', self.chkIgnoreErrors.isChecked())
         self.lcplinputprefs.set('honor_license_time_limits', self.chkHonorTimeLimits.isChecked())
+        self.lcplinputprefs.set('publication_cache_size_mb', self.spinCacheSize.value())
+        self.lcplinputprefs.set('batch_max_downloads', self.spinBatchMax.value())
+        self.lcplinputprefs.set('batch_max_downloads_per_host', self.spinBatchMaxPerHost.value())
+        self.lcplinputprefs.set('batch_order', self.cmbBatchOrder.itemData(self.cmbBatchOrder.currentIndex()))
+        self.lcplinputprefs.set('batch_bandwidth_mb', self.spinBatchBandwidth.value())
+        self.lcplinputprefs.set('max_download_rate_kb', self.spinMaxRate.value())
+        self.lcplinputprefs.set('max_host_download_rate_kb', self.spinMaxHostRate.value())
+        self.lcplinputprefs.set('max_requests_per_minute', self.spinMaxRequests.value())
+        self.lcplinputprefs.set('metrics_file', self.txtboxMetricsFile.text().strip())
+        self.lcplinputprefs.set('download_segments', self.spinSegments.value())
+        self.lcplinputprefs.set('prefetch_auto_add', self.chkPrefetch.isChecked())
+        self.lcplinputprefs.set('fulfillment_index', self.chkFulfillmentIndex.isChecked())
+        self.lcplinputprefs.set('failure_cache', self.chkFailureCache.isChecked())
+        self.lcplinputprefs.set('prefetch_max_downloads', self.spinPrefetchMax.value())
 
         if (self.txtboxUA.text() == ""):
             self.lcplinputprefs.set('use_custom_ua', False)
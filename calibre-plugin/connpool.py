@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Keep-alive HTTP connection pool for the LCPL Input plugin.
+# urlopen opens a new TCP (and TLS) connection for every request. Most licenses
+# point to a handful of LCP content servers, so we keep idle connections around,
+# keyed by scheme / host / port, and reuse them for the next download.
+
+import threading
+import time
+
+try:
+    # Python 3
+    import http.client as httplib
+    from urllib.parse import urlparse, urljoin
+    from urllib.request import Request, urlopen, getproxies, proxy_bypass
+    from urllib.error import HTTPError
+except:
+    # Python 2
+    import httplib
+    from urlparse import urlparse, urljoin
+    from urllib2 import Request, urlopen, HTTPError
+    from urllib import getproxies, proxy_bypass
+
+try:
+    import ssl
+except:
+    ssl = None
+
+
+# Socket timeout in seconds for connecting and for every read
+DEFAULT_TIMEOUT = 60
+
+# Idle connections older than this are closed instead of reused
+IDLE_TIMEOUT = 30
+
+# Maximum number of idle connections kept in the pool (over all hosts)
+MAX_POOL_SIZE = 16
+
+MAX_REDIRECTS = 10
+
+
+class PooledResponse(object):
+    # Wraps an http.client response so it looks like what urlopen returns.
+    # Closing it hands the connection back to the pool if the body has been
+    # read completely; otherwise the connection is closed.
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.headers = response.msg
+        self.status = response.status
+        # Time spent on DNS + TCP / TLS connect (0 for a reused connection)
+        # and from sending the request until the response headers arrived.
+        self.connect_time = 0.0
+        self.ttfb = 0.0
+        # Python 2's httplib responses can't do readinto, so only offer it if the response can
+        if hasattr(response, "readinto"):
+            self.readinto = response.readinto
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.response.close()
+        if reusable:
+            self.pool._put(self.key, conn)
+        else:
+            conn.close()
+
+
+class ConnectionPool(object):
+    def __init__(self, max_size=MAX_POOL_SIZE, idle_timeout=IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}      # key -> list of (connection, time it was returned)
+        self.idle_count = 0
+
+    def _get(self, key):
+        # Returns (connection, reused)
+        now = time.time()
+        stale = []
+        conn = None
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while conns:
+                candidate, returned = conns.pop()
+                self.idle_count -= 1
+                if now - returned <= self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        for c in stale:
+            c.close()
+
+        if conn is not None:
+            return conn, True
+
+        scheme, host, port = key
+        if scheme == "https":
+            context = ssl.create_default_context() if ssl is not None and hasattr(ssl, "create_default_context") else None
+            if context is not None:
+                conn = httplib.HTTPSConnection(host, port, timeout=self.timeout, context=context)
+            else:
+                conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _put(self, key, conn):
+        with self.lock:
+            if self.idle_count < self.max_size:
+                self.idle.setdefault(key, []).append((conn, time.time()))
+                self.idle_count += 1
+                return
+        conn.close()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+            self.idle_count = 0
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def _request_once(self, method, url, headers):
+        parsed = urlparse(url)
+        scheme = parsed.scheme.lower()
+        if scheme not in ("http", "https"):
+            raise ValueError("Unsupported URL scheme: {0}".format(scheme))
+        port = parsed.port or (443 if scheme == "https" else 80)
+        key = (scheme, parsed.hostname, port)
+
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+
+        conn, reused = self._get(key)
+        connect_time = 0.0
+        try:
+            if not reused:
+                start = time.time()
+                conn.connect()
+                connect_time = time.time() - start
+            start = time.time()
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+        except Exception:
+            conn.close()
+            if not reused:
+                raise
+            # The server closed the idle connection in the meantime. Try again on a fresh one.
+            conn, reused = self._get_fresh(key)
+            try:
+                start = time.time()
+                conn.connect()
+                connect_time = time.time() - start
+                start = time.time()
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+
+        pooled = PooledResponse(self, key, conn, response, url)
+        pooled.connect_time = connect_time
+        pooled.ttfb = time.time() - start
+        return pooled
+
+    def _get_fresh(self, key):
+        # Drop all idle connections to that host, they're likely dead as well.
+        with self.lock:
+            conns = self.idle.pop(key, [])
+            self.idle_count -= len(conns)
+        for c, _ in conns:
+            c.close()
+        return self._get(key)
+
+    def open(self, url, headers, method="GET"):
+        # Sends a request and returns the response (for any status code).
+        # Redirects are followed.
+
+        if _uses_proxy(url):
+            # http.client doesn't know about proxies, let urllib handle that.
+            try:
+                return urlopen(Request(url=url, headers=headers))
+            except HTTPError as e:
+                return e
+
+        connect_time = ttfb = 0.0
+        for i in range(MAX_REDIRECTS + 1):
+            response = self._request_once(method, url, headers)
+            connect_time += response.connect_time
+            ttfb += response.ttfb
+            response.connect_time = connect_time
+            response.ttfb = ttfb
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.headers.get("location")
+                if location:
+                    # Read the (usually tiny) redirect body so the connection can be reused.
+                    try:
+                        response.read()
+                    except:
+                        pass
+                    response.close()
+                    url = urljoin(url, location)
+                    continue
+            return response
+
+        raise IOError("Too many redirects")
+
+
+def _uses_proxy(url):
+    try:
+        proxies = getproxies()
+        parsed = urlparse(url)
+        return parsed.scheme.lower() in proxies and not proxy_bypass(parsed.hostname)
+    except:
+        return False
+
+
+def get_pool():
+    # The pool shared by all downloads in this process
+    import calibre_plugins.lcplinput.sqlitedb as sqlitedb     # type: ignore
+    return sqlitedb.get_shared(ConnectionPool)
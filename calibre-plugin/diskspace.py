@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Free space checks for downloads.
+# Before a download connects, the space it needs (the length from the LCPL file,
+# later the Content-Length) is reserved on the file system of its output file.
+# A reservation only succeeds if the free space minus everything the other
+# running downloads have reserved is large enough, so a full disk is noticed
+# before the transfer instead of after gigabytes of it.
+#
+# Once the output file is preallocated (posix_fallocate), the file system itself
+# accounts for the space and the reservation is dropped. Without preallocation
+# (Windows, macOS) the reservation is kept until the download is done.
+
+import os
+import threading
+
+
+# Always leave this much free (license injection, temporary files of other programs, ...)
+FREE_SPACE_MARGIN = 32 * 1024 * 1024
+
+# Smaller files aren't preallocated
+PREALLOCATE_MIN_SIZE = 1024 * 1024
+
+
+class InsufficientSpace(EnvironmentError):
+    pass
+
+
+_lock = threading.Lock()
+_reserved = {}      # device -> reserved bytes
+
+# Worker processes of the headless batch fulfillment share one counter
+# (a multiprocessing.Value) instead, see set_shared_counter.
+_shared = None
+
+
+def set_shared_counter(counter):
+    global _shared
+    _shared = counter
+
+
+def get_free_space(directory):
+    # Returns the free bytes on the file system of directory, or None if unknown.
+    try:
+        import shutil
+        return shutil.disk_usage(directory).free
+    except AttributeError:
+        pass
+    except OSError:
+        return None
+    try:
+        st = os.statvfs(directory)
+        return st.f_bavail * st.f_frsize
+    except:
+        return None
+
+
+def _get_device(directory):
+    try:
+        return os.stat(directory).st_dev
+    except OSError:
+        return directory
+
+
+def _format_mb(size):
+    return "{0:.1f} MB".format(size / (1024.0 * 1024.0))
+
+
+def _add(directory, device, size):
+    # Reserves size more bytes, raises InsufficientSpace if they're not there.
+    free = get_free_space(directory)
+    with _lock:
+        if _shared is not None:
+            with _shared.get_lock():
+                _check(directory, free, _shared.value, size)
+                _shared.value += size
+        else:
+            reserved = _reserved.get(device, 0)
+            _check(directory, free, reserved, size)
+            _reserved[device] = reserved + size
+
+
+def _check(directory, free, reserved, size):
+    if free is None:
+        return
+    if free - reserved - FREE_SPACE_MARGIN < size:
+        message = "Not enough disk space in {0}: need {1} (plus {2} to keep free), {3} free".format(
+            directory, _format_mb(size), _format_mb(FREE_SPACE_MARGIN), _format_mb(free))
+        if reserved:
+            message += " ({0} of that reserved by other downloads)".format(_format_mb(reserved))
+        raise InsufficientSpace(message)
+
+
+def _remove(device, size):
+    with _lock:
+        if _shared is not None:
+            with _shared.get_lock():
+                _shared.value = max(0, _shared.value - size)
+        else:
+            left = _reserved.get(device, 0) - size
+            if left > 0:
+                _reserved[device] = left
+            else:
+                _reserved.pop(device, None)
+
+
+class Reservation(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.device = _get_device(directory)
+        self.size = 0
+        self.settled = False
+
+    def ensure(self, size):
+        # Makes sure at least size bytes are reserved. Raises InsufficientSpace.
+        if self.settled or not size or size <= self.size:
+            return
+        _add(self.directory, self.device, size - self.size)
+        self.size = size
+
+    def settle(self):
+        # The space is allocated on disk now, so it's no longer reserved here.
+        self.release()
+        self.settled = True
+
+    def release(self):
+        if self.size:
+            _remove(self.device, self.size)
+            self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
+
+
+def reserve(directory, size):
+    # Returns a Reservation for size bytes (0 if the size isn't known yet).
+    reservation = Reservation(directory)
+    reservation.ensure(size)
+    return reservation
+
+
+def preallocate(f, size, reservation=None):
+    # Allocates the file f (opened for writing) up to size bytes, so it isn't
+    # fragmented and can't run out of space halfway. This extends the file to
+    # size, the caller has to truncate it if less gets written.
+    # Returns False if preallocation isn't available here.
+    if size < PREALLOCATE_MIN_SIZE or not hasattr(os, "posix_fallocate"):
+        return False
+
+    f.flush()
+    start = f.tell()
+    if size <= start:
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), start, size - start)
+    except OSError as e:
+        import errno
+        if e.errno == errno.ENOSPC:
+            raise InsufficientSpace("Not enough disk space for {0}".format(_format_mb(size)))
+        # Not supported by this file system
+        return False
+
+    if reservation is not None:
+        reservation.settle()
+    return True
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Dispatch table for the FileTypePlugins that run on the fulfilled book.
+# Which plugins are eligible only changes when plugins are (un)installed or
+# enabled / disabled, so instead of checking every installed plugin for every
+# imported book, the list is built once per output file type and reused
+# until the plugin set or the disabled state changes.
+
+import os
+import threading
+import time
+
+
+class PluginDispatchTable(object):
+    def __init__(self, own_name):
+        self.own_name = own_name
+        self.lock = threading.Lock()
+        self.signature = None
+        self.eligible = []      # (position, plugin), ordered by priority
+        self.by_type = {}       # file type -> list of (position, plugin)
+        self.timings = {}       # plugin name -> [number of runs, total seconds]
+
+    def _get_signature(self, plugins):
+        # Something that changes whenever the plugin list or the disabled state changes.
+        try:
+            from calibre.customize.ui import config      # type: ignore
+            return (id(plugins), len(plugins), frozenset(config['disabled_plugins']), frozenset(config['enabled_plugins']))
+        except:
+            from calibre.customize.ui import is_disabled  # type: ignore
+            return (id(plugins), tuple((id(plugin), is_disabled(plugin)) for plugin in plugins))
+
+    def _rebuild(self, plugins):
+        from calibre.customize.ui import is_disabled      # type: ignore
+        from calibre.customize import FileTypePlugin      # type: ignore
+
+        eligible = []
+        for plugin in plugins:
+            # Check if this is a FileTypePlugin
+            if not isinstance(plugin, FileTypePlugin):
+                continue
+
+            # Check if it's disabled
+            if is_disabled(plugin):
+                continue
+
+            if plugin.name == self.own_name:
+                continue
+
+            # Check if it's supposed to run on import:
+            if not plugin.on_import:
+                continue
+
+            # If the plugin runs on LCPL files (or on all files), Calibre calls it anyways.
+            if ("lcpl" in plugin.file_types or "*" in plugin.file_types):
+                continue
+
+            eligible.append(plugin)
+
+        # Calibre keeps the list sorted by priority already, but make sure (stable sort).
+        eligible.sort(key=lambda plugin: -plugin.priority)
+
+        self.eligible = list(enumerate(eligible))
+        self.by_type = {}
+
+    def get_plugins(self, file_type, after=-1):
+        # Returns the (position, plugin) entries that should run on a book of the
+        # given file type, in priority order. Only plugins after position "after" are returned.
+        import calibre.customize.ui as ui                 # type: ignore
+
+        plugins = ui._initialized_plugins
+        signature = self._get_signature(plugins)
+
+        with self.lock:
+            if signature != self.signature:
+                self._rebuild(plugins)
+                self.signature = signature
+
+            entries = self.by_type.get(file_type)
+            if entries is None:
+                # If the book file extension isn't in the plugin, don't execute it.
+                entries = [(pos, plugin) for pos, plugin in self.eligible if file_type in plugin.file_types]
+                self.by_type[file_type] = entries
+
+        return [entry for entry in entries if entry[0] > after]
+
+    def record_time(self, plugin, elapsed):
+        with self.lock:
+            timing = self.timings.setdefault(plugin.name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+
+    def get_timings(self):
+        # Returns {plugin name: (runs, total seconds)}
+        with self.lock:
+            return dict((name, tuple(timing)) for name, timing in self.timings.items())
+
+
+_table_lock = threading.Lock()
+_tables = {}
+
+
+def get_dispatch_table(own_name):
+    with _table_lock:
+        table = _tables.get(own_name)
+        if table is None:
+            table = _tables[own_name] = PluginDispatchTable(own_name)
+        return table
+
+
+def get_file_type(path):
+    return os.path.splitext(path)[-1].lower().replace('.', '')
+
+
+def timed_run(table, plugin, path, metrics=None):
+    # Runs plugin on path and records how long that took.
+    start = time.time()
+    try:
+        return plugin.run(path)
+    finally:
+        elapsed = time.time() - start
+        table.record_time(plugin, elapsed)
+        if metrics is not None:
+            metrics.add_time("plugin:" + plugin.name, elapsed)
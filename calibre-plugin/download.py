@@ -0,0 +1,793 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Download helpers for the LCPL Input plugin.
+# The publication is streamed to disk exactly once; the SHA256 digest
+# and the byte count are updated while the chunks arrive, so there's
+# no need to read the (potentially huge) file back in afterwards.
+#
+# If a download dies halfway, the data received so far is kept in the
+# plugin cache directory (see PartialDownload) so the next attempt - or
+# the next import of the same LCPL file - can continue with a Range request.
+#
+# Large publications on servers that support Range requests are fetched in
+# several byte ranges at once (see SegmentedDownload), because a single
+# connection to a far-away server is often limited well below the link speed.
+#
+# The space a download needs is reserved (see diskspace.py) before any data
+# arrives, and large output files are preallocated.
+#
+# Requests and transferred bytes go through the limits in ratelimit.py.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from calibre_plugins.lcplinput.__init__ import PLUGIN_NAME, PLUGIN_VERSION  # type: ignore
+import calibre_plugins.lcplinput.connpool as connpool                       # type: ignore
+import calibre_plugins.lcplinput.diskspace as diskspace                     # type: ignore
+import calibre_plugins.lcplinput.ratelimit as ratelimit                     # type: ignore
+
+
+CHUNK_SIZE = 16 * 1024
+
+# Hashing pipeline (see stream_to_file): size and number of the buffers
+# between the network reader and the hashing / writing thread.
+PIPELINE_BUFFER_SIZE = 256 * 1024
+PIPELINE_DEPTH = 4
+
+# How often a broken transfer is retried (with a Range request) before giving up.
+DOWNLOAD_RETRIES = 3
+
+# Segmented downloads: each segment is at least this big, so small files
+# are always downloaded in one piece.
+SEGMENT_MIN_SIZE = 4 * 1024 * 1024
+
+# Batch imports run downloads on several threads. Two of them must never
+# work on the same partial download at the same time.
+_partial_locks_lock = threading.Lock()
+_partial_locks = {}
+
+# For licenses with several candidate URLs (templated links): which candidate
+# (index into the list) worked last time, per content server.
+_preferred_candidate_lock = threading.Lock()
+_preferred_candidate = {}
+
+
+class DownloadError(Exception):
+    # Errors that must not be retried (HTTP 4xx, content errors, ...)
+    # status is the HTTP status code, if the server refused the download.
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class ServerError(IOError):
+    # HTTP 5xx (or 503 after all retries): trouble on the server, worth another try.
+    def __init__(self, message, status):
+        IOError.__init__(self, message)
+        self.status = status
+
+
+class NotModified(DownloadError):
+    # A conditional request got HTTP 304, the local copy is still current.
+    # Not really an error, but nothing to retry either.
+    pass
+
+
+class StreamResult(object):
+    __slots__ = ("size", "sha256", "content_length", "url", "etag", "last_modified")
+
+    def __init__(self, size, sha256, content_length, url=None, etag=None, last_modified=None):
+        self.size = size
+        self.sha256 = sha256
+        self.content_length = content_length
+        # Validators of the response, for conditional requests later on
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+def get_content_length(handler):
+    # Returns the Content-Length the server announced, or None.
+    try:
+        length = int(handler.headers.get('content-length'))
+        if length > 0:
+            return length
+    except:
+        pass
+    return None
+
+
+def get_range_start_and_total(handler):
+    # Parses "Content-Range: bytes 100-199/200" into (100, 200).
+    # The total may be None if the server sent "*".
+    try:
+        unit, rng = handler.headers.get('content-range').strip().split(" ", 1)
+        if unit.lower() != "bytes":
+            return None, None
+        span, total = rng.split("/", 1)
+        start = int(span.split("-", 1)[0])
+        total = None if total.strip() == "*" else int(total)
+        return start, total
+    except:
+        return None, None
+
+
+def hash_file(path, digest, size=None):
+    # Feeds the first size bytes (or the whole file) into digest.
+    with open(path, "rb") as f:
+        remaining = size
+        while remaining is None or remaining > 0:
+            data = f.read(CHUNK_SIZE * 4 if remaining is None else min(CHUNK_SIZE * 4, remaining))
+            if not data:
+                break
+            digest.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return digest
+
+
+class PartialDownload(object):
+    # A partially downloaded publication, persisted between attempts and imports.
+    # The key is built from the license ID and the publication hash (or URL),
+    # so a different license or a different publication never picks up the data.
+    # Next to the data file, a small JSON checkpoint holds the byte offset and
+    # the validators (ETag / Last-Modified) of the response that produced it.
+
+    def __init__(self, directory, license_id, publication_key):
+        key = hashlib.sha256("{0}\n{1}".format(license_id, publication_key).encode("utf-8")).hexdigest()[:32]
+        self.data_path = os.path.join(directory, key + ".part")
+        self.state_path = os.path.join(directory, key + ".json")
+
+        with _partial_locks_lock:
+            self.lock = _partial_locks.setdefault(self.data_path, threading.Lock())
+
+    def load(self):
+        # Returns the checkpoint if there's usable data, otherwise None
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+            if os.path.getsize(self.data_path) != state["offset"] or state["offset"] <= 0:
+                raise ValueError("Partial download doesn't match checkpoint")
+            return state
+        except:
+            self.discard()
+            return None
+
+    def restore_to(self, outputname):
+        # Moves the persisted data into place. Returns the checkpoint, or None.
+        state = self.load()
+        if state is None:
+            return None
+        try:
+            shutil.move(self.data_path, outputname)
+        except:
+            self.discard()
+            return None
+        return state
+
+    def save_from(self, outputname, offset, url, etag, last_modified):
+        try:
+            shutil.move(outputname, self.data_path)
+            with open(self.state_path, "w") as f:
+                json.dump({"offset": offset, "url": url, "etag": etag, "last_modified": last_modified}, f)
+            return True
+        except:
+            self.discard()
+            return False
+
+    def discard(self):
+        for path in (self.data_path, self.state_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def open_url(url, ua, offset=0, validator=None, metrics=None, end=None, conditional=None):
+    # end is the last byte (inclusive) of a range request, None for "until the end".
+    # conditional is a dict with the "etag" and / or "last_modified" of a copy we 
+    # already have; if the server says it's unchanged, NotModified is raised.
+    headers = {'User-Agent': ua}
+    ranged = offset > 0 or end is not None
+    if ranged:
+        headers['Range'] = "bytes={0}-{1}".format(offset, "" if end is None else end)
+        if validator:
+            # Only continue if the file on the server is still the same.
+            headers['If-Range'] = validator
+    elif conditional:
+        if conditional.get("etag"):
+            headers['If-None-Match'] = conditional["etag"]
+        if conditional.get("last_modified"):
+            headers['If-Modified-Since'] = conditional["last_modified"]
+
+    limiter = ratelimit.get_limiter()
+    host = ratelimit.get_host(url)
+    throttled = 0
+    while True:
+        waited = limiter.before_request(host)
+        handler = connpool.get_pool().open(url, headers)
+
+        if metrics is not None:
+            metrics.add_count("requests")
+            metrics.add_time("pacing", waited)
+            metrics.add_time("connect", getattr(handler, "connect_time", 0.0))
+            metrics.add_time("ttfb", getattr(handler, "ttfb", 0.0))
+
+        ret_code = handler.getcode()
+        if ret_code not in (429, 503):
+            break
+
+        # The server wants us to slow down
+        delay = limiter.throttled(host, handler.headers.get('retry-after'))
+        handler.close()
+        if metrics is not None:
+            metrics.add_count("throttled")
+        throttled += 1
+        if throttled > ratelimit.THROTTLE_RETRIES or delay > ratelimit.MAX_RETRY_AFTER:
+            if ret_code == 429:
+                raise DownloadError("Download returned error 429 (too many requests)", 429)
+            raise ServerError("Download returned error {0}".format(ret_code), ret_code)
+        print("{0} v{1}: {2} is busy (error {3}), trying again in {4:.0f} seconds ...".format(PLUGIN_NAME, PLUGIN_VERSION, host, ret_code, delay))
+
+    if ret_code < 400:
+        limiter.request_ok(host)
+    if ret_code == 200 or (ret_code == 206 and ranged):
+        return handler
+
+    handler.close()
+
+    if ret_code == 304 and conditional:
+        raise NotModified("Not modified")
+    if ret_code == 416 and offset > 0 and end is None:
+        # Our partial data is longer than the file on the server, start over.
+        return open_url(url, ua, metrics=metrics)
+    if ret_code >= 500:
+        # Server trouble, worth another try
+        raise ServerError("Download returned error {0}".format(ret_code), ret_code)
+    raise DownloadError("Download returned error {0}".format(ret_code), ret_code)
+
+
+class _HashWriter(object):
+    # Consumer side of stream_to_file: a worker thread that hashes and writes the
+    # buffers the network reader filled. Buffers go back and forth between a
+    # "free" and a "filled" queue, so nothing is allocated per chunk and at most
+    # PIPELINE_DEPTH buffers are in use.
+
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        for i in range(PIPELINE_DEPTH):
+            self.free.put(bytearray(PIPELINE_BUFFER_SIZE))
+        self.error = None
+        self.hash_time = 0.0
+        self.thread = threading.Thread(target=self._run, name="LCPLInput-hash")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.filled.get()
+            if item is None:
+                return
+            buf, length = item
+            try:
+                if self.error is None:
+                    data = memoryview(buf)[:length]
+                    start = time.time()
+                    self.digest.update(data)
+                    self.hash_time += time.time() - start
+                    self.f.write(data)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.free.put(buf)
+
+    def get_buffer(self):
+        buf = self.free.get()
+        if self.error is not None:
+            self.free.put(buf)
+            raise self.error
+        return buf
+
+    def close(self):
+        # Waits until everything queued so far is hashed and written.
+        self.filled.put(None)
+        self.thread.join()
+
+
+def stream_to_file(handler, f, digest, size, max_size=None, metrics=None, pacer=None):
+    # Appends the response body to the file object f, updating digest on the way.
+    # Returns the new total size. f.tell() is kept up to date so the caller can
+    # checkpoint a broken transfer.
+    # If max_size is set, the download is aborted as soon as the server
+    # sends more data than that.
+    # pacer (a ratelimit.Pacer) limits the transfer rate.
+    #
+    # With a digest, hashing and writing run on a worker thread (_HashWriter), so
+    # the socket is read again while the previous chunk is still being hashed.
+
+    if digest is None:
+        while True:
+            chunk = handler.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if pacer is not None:
+                pacer.consume(len(chunk))
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise DownloadError("Server sent more than the expected {0} bytes".format(max_size))
+            f.write(chunk)
+        return size
+
+    readinto = getattr(handler, "readinto", None)
+    writer = _HashWriter(f, digest)
+    try:
+        while True:
+            buf = writer.get_buffer()
+            if readinto is not None:
+                length = readinto(buf)
+            else:
+                # Python 2 responses can't do readinto
+                data = handler.read(len(buf))
+                length = len(data)
+                buf[:length] = data
+            if not length:
+                writer.free.put(buf)
+                break
+            if pacer is not None:
+                pacer.consume(length)
+            size += length
+            if max_size is not None and size > max_size:
+                writer.free.put(buf)
+                raise DownloadError("Server sent more than the expected {0} bytes".format(max_size))
+            writer.filled.put((buf, length))
+    finally:
+        # Everything that arrived is written before the caller looks at f.tell()
+        writer.close()
+        if metrics is not None:
+            metrics.add_time("hash", writer.hash_time)
+
+    if writer.error is not None:
+        raise writer.error
+    return size
+
+
+def get_segment_count(length, segments):
+    # How many segments a download of length bytes should use (1 = single stream)
+    if not length or segments <= 1:
+        return 1
+    return max(1, min(segments, length // SEGMENT_MIN_SIZE))
+
+
+class _Segment(object):
+    __slots__ = ("start", "end", "pos", "done", "error")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end          # exclusive; None means "until the end of the file"
+        self.pos = start
+        self.done = False
+        self.error = None
+
+
+class SegmentedDownload(object):
+    # Downloads one file as several byte ranges in parallel, each one on its own
+    # connection, written into a preallocated file at its own position.
+    # The response to the initial (full) GET is reused for the first segment.
+    # Broken segments are retried from where they stopped. Hashing is done in one
+    # pass over the finished file by the caller.
+
+    def __init__(self, url, ua, outputname, length, count, validator=None, max_size=None, metrics=None, exact_length=True, reservation=None):
+        self.url = url
+        self.ua = ua
+        self.outputname = outputname
+        self.validator = validator
+        self.max_size = max_size
+        self.metrics = metrics
+        self.aborted = False
+
+        segment_size = length // count
+        self.segments = []
+        for i in range(count):
+            start = i * segment_size
+            if i < count - 1:
+                end = start + segment_size
+            else:
+                # Without a Content-Length (the length is from the LCPL file),
+                # read the last segment until the server stops.
+                end = length if exact_length else None
+            self.segments.append(_Segment(start, end))
+
+        self.length = length
+        self.reservation = reservation
+        self.pacer = ratelimit.get_limiter().get_pacer(ratelimit.get_host(url))
+
+    def run(self, first_handler):
+        # Returns the size of the downloaded file, raises if a segment failed for good.
+        with open(self.outputname, "wb") as f:
+            diskspace.preallocate(f, self.length, self.reservation)
+            f.truncate(self.length)
+
+        start = time.time()
+        threads = []
+        try:
+            for i, segment in enumerate(self.segments[1:]):
+                t = threading.Thread(target=self._fetch, args=(segment, None), name="LCPLInput-segment-{0}".format(i + 1))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+            self._fetch(self.segments[0], first_handler)
+        finally:
+            for t in threads:
+                t.join()
+            if self.metrics is not None:
+                self.metrics.add_time("transfer", time.time() - start)
+                self.metrics.add_count("bytes_downloaded", sum(s.pos - s.start for s in self.segments))
+                self.metrics.add_count("segments", len(self.segments))
+
+        errors = [s.error for s in self.segments if s.error is not None]
+        for error in errors:
+            if isinstance(error, DownloadError):
+                raise error
+        if errors:
+            raise errors[0]
+
+        return self.segments[-1].pos
+
+    def get_contiguous_size(self):
+        # Number of bytes from the start of the file that are complete
+        size = 0
+        for segment in self.segments:
+            size = segment.pos
+            if not segment.done:
+                break
+        return size
+
+    def truncate_to_contiguous(self):
+        # After a failure: cut the file back to its complete prefix so it can be
+        # continued with a normal range request. Returns the new size.
+        size = self.get_contiguous_size()
+        try:
+            with open(self.outputname, "r+b") as f:
+                f.truncate(size)
+        except:
+            return 0
+        return size
+
+    def _fetch(self, segment, handler):
+        attempt = 0
+        while not self.aborted:
+            attempt += 1
+            try:
+                if handler is None:
+                    last = segment.end - 1 if segment.end is not None else None
+                    handler = open_url(self.url, self.ua, segment.pos, self.validator, self.metrics, last)
+                    if handler.getcode() != 206 or get_range_start_and_total(handler)[0] != segment.pos:
+                        # Most likely the file changed on the server (If-Range didn't match)
+                        raise IOError("Server didn't return the requested range")
+
+                with open(self.outputname, "r+b") as f:
+                    f.seek(segment.pos)
+                    while segment.end is None or segment.pos < segment.end:
+                        if self.aborted:
+                            return
+                        want = CHUNK_SIZE if segment.end is None else min(CHUNK_SIZE, segment.end - segment.pos)
+                        chunk = handler.read(want)
+                        if not chunk:
+                            break
+                        if self.max_size is not None and segment.pos + len(chunk) > self.max_size:
+                            raise DownloadError("Server sent more than the expected {0} bytes".format(self.max_size))
+                        if self.pacer is not None:
+                            self.pacer.consume(len(chunk))
+                        f.write(chunk)
+                        segment.pos += len(chunk)
+
+                if segment.end is not None and segment.pos < segment.end:
+                    raise IOError("Connection closed at byte {0} of segment {1}-{2}".format(segment.pos, segment.start, segment.end))
+
+                segment.done = True
+                return
+
+            except DownloadError as e:
+                segment.error = e
+                self.aborted = True
+                return
+            except Exception as e:
+                if attempt > DOWNLOAD_RETRIES:
+                    segment.error = e
+                    return
+                if self.metrics is not None:
+                    self.metrics.add_count("retries")
+                time.sleep(attempt)
+            finally:
+                if handler is not None:
+                    handler.close()
+                    handler = None
+
+
+def download_to_file(url, ua, outputname, max_size=None, with_hash=True, partial=None, metrics=None, segments=1, handler=None, validators=None, reservation=None):
+    # Downloads url to outputname. Broken transfers are retried with Range requests
+    # if the server supports that. If partial is a PartialDownload, data from a
+    # previous attempt is picked up, and data from a failed attempt is kept there.
+    # metrics (a metrics.ImportMetrics) gets the connect / ttfb / transfer / hash times.
+    # With segments > 1, large files are downloaded in that many parallel ranges.
+    # handler can be an already opened (200) response for url to start with.
+    # validators (see open_url's conditional) turn the request into a conditional one,
+    # NotModified is raised if the server says the copy we have is current.
+    # reservation (a diskspace.Reservation) is grown to the Content-Length once that's known;
+    # diskspace.InsufficientSpace is raised if the disk is too full for the file.
+
+    if partial is None:
+        return _download_to_file(url, ua, outputname, max_size, with_hash, None, metrics, segments, handler, validators, reservation)
+
+    with partial.lock:
+        return _download_to_file(url, ua, outputname, max_size, with_hash, partial, metrics, segments, handler, validators, reservation)
+
+
+def _download_to_file(url, ua, outputname, max_size, with_hash, partial, metrics, segments, first_handler, validators, reservation):
+    offset = 0
+    etag = None
+    last_modified = None
+    accepts_ranges = False
+
+    if partial is not None:
+        state = partial.restore_to(outputname)
+        if state is not None:
+            offset = state["offset"]
+            etag = state.get("etag")
+            last_modified = state.get("last_modified")
+            accepts_ranges = True
+
+    digest = None
+    digest_offset = 0
+    attempt = 0
+
+    try:
+        while True:
+            attempt += 1
+            try:
+                handler = None
+                if first_handler is not None:
+                    if offset == 0:
+                        handler = first_handler
+                    else:
+                        # We're continuing an earlier download instead
+                        first_handler.close()
+                    first_handler = None
+
+                if handler is None:
+                    if offset > 0 and (etag or last_modified):
+                        handler = open_url(url, ua, offset, etag or last_modified, metrics)
+                    else:
+                        handler = open_url(url, ua, metrics=metrics, conditional=validators)
+                        offset = 0
+
+                try:
+                    if handler.getcode() == 206:
+                        start, total = get_range_start_and_total(handler)
+                        new_etag = handler.headers.get('etag')
+                        if start != offset or (etag and new_etag and new_etag != etag):
+                            # Not what we asked for, start over.
+                            handler.close()
+                            etag = last_modified = None
+                            offset = 0
+                            continue
+                        content_length = total
+                    else:
+                        offset = 0
+                        content_length = get_content_length(handler)
+                        etag = handler.headers.get('etag')
+                        last_modified = handler.headers.get('last-modified')
+                        accepts_ranges = (handler.headers.get('accept-ranges') or "").lower() == "bytes"
+
+                    if reservation is not None and content_length:
+                        reservation.ensure(content_length - offset)
+
+                    # The length is either what the server said, or (if checking content) what the LCPL file said.
+                    segment_count = 1
+                    if handler.getcode() == 200 and accepts_ranges:
+                        segment_count = get_segment_count(content_length or max_size, segments)
+
+                    if segment_count > 1:
+                        segmented = SegmentedDownload(url, ua, outputname, content_length or max_size, segment_count,
+                            etag or last_modified, max_size, metrics, content_length is not None, reservation)
+                        try:
+                            size = segmented.run(handler)
+                        except:
+                            offset = segmented.truncate_to_contiguous()
+                            digest = None
+                            raise
+
+                        offset = size
+                        digest = None
+                        if with_hash:
+                            start = time.time()
+                            digest = hash_file(outputname, hashlib.sha256())
+                            if metrics is not None:
+                                metrics.add_time("hash", time.time() - start)
+                    else:
+                        if with_hash and (digest is None or digest_offset != offset):
+                            # Either the first attempt, or we're continuing a download from an
+                            # earlier import. In the latter case we don't have the digest state
+                            # anymore, so re-hash the bytes we already have (local disk only).
+                            digest = hashlib.sha256()
+                            if offset > 0:
+                                start = time.time()
+                                hash_file(outputname, digest, offset)
+                                if metrics is not None:
+                                    metrics.add_time("hash", time.time() - start)
+                                    metrics.add_count("bytes_resumed", offset)
+                            digest_offset = offset
+
+                        with open(outputname, "r+b" if offset > 0 else "wb") as f:
+                            f.seek(offset)
+                            f.truncate()
+                            start = time.time()
+                            try:
+                                if content_length:
+                                    diskspace.preallocate(f, content_length, reservation)
+                                size = stream_to_file(handler, f, digest, offset, max_size, metrics,
+                                    ratelimit.get_limiter().get_pacer(ratelimit.get_host(url)))
+                            finally:
+                                if metrics is not None:
+                                    metrics.add_time("transfer", time.time() - start)
+                                    metrics.add_count("bytes_downloaded", f.tell() - offset)
+                                offset = f.tell()
+                                digest_offset = offset
+                                # Cut off the preallocated rest if less arrived
+                                f.truncate()
+                finally:
+                    handler.close()
+
+                if content_length is not None and size < content_length:
+                    # The connection was closed before the server sent everything it announced.
+                    raise IOError("Connection closed after {0} of {1} bytes".format(size, content_length))
+
+                result = StreamResult(size, digest.hexdigest().lower() if digest is not None else None, content_length,
+                    url, etag, last_modified)
+                break
+
+            except (DownloadError, diskspace.InsufficientSpace):
+                raise
+            except Exception as e:
+                if attempt > DOWNLOAD_RETRIES or not accepts_ranges:
+                    raise
+                print("{0} v{1}: Download interrupted at byte {2} ({3}), retrying ...".format(PLUGIN_NAME, PLUGIN_VERSION, offset, e))
+                if metrics is not None:
+                    metrics.add_count("retries")
+                time.sleep(attempt)
+
+    except DownloadError:
+        # Content is bad or the server refused, don't keep anything.
+        if partial is not None:
+            partial.discard()
+        raise
+    except BaseException as e:
+        if partial is not None and offset > 0 and accepts_ranges:
+            if partial.save_from(outputname, offset, url, etag, last_modified):
+                # The next attempt continues from here, so this isn't a failure
+                # worth remembering (see negcache.classify).
+                e.resumable = True
+        raise
+
+    if partial is not None:
+        partial.discard()
+
+    return result
+
+
+class _Race(object):
+    __slots__ = ("lock", "cond", "winner", "errors", "pending", "not_modified")
+
+    def __init__(self, count):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.winner = None
+        self.errors = []
+        self.pending = count
+        self.not_modified = None
+
+
+def _race_one(race, index, url, ua, metrics, conditional):
+    try:
+        handler = open_url(url, ua, metrics=metrics, conditional=conditional)
+    except Exception as e:
+        with race.lock:
+            race.errors.append(e)
+            if isinstance(e, NotModified):
+                race.not_modified = e
+            race.pending -= 1
+            race.cond.notify_all()
+        return
+
+    with race.lock:
+        race.pending -= 1
+        if race.winner is None:
+            race.winner = (index, handler)
+            race.cond.notify_all()
+            return
+    # Too late, somebody else already won
+    handler.close()
+
+
+def race_urls(urls, ua, metrics=None, conditional=None):
+    # Sends a GET to all urls at the same time. Returns (index, handler) for the first
+    # one that answers with 200; the other responses are closed as soon as they
+    # arrive. Raises one of the errors if all of them fail, or NotModified as soon
+    # as one of them says so (for conditional requests).
+    race = _Race(len(urls))
+    for i, url in enumerate(urls):
+        t = threading.Thread(target=_race_one, args=(race, i, url, ua, metrics, conditional), name="LCPLInput-race-{0}".format(i))
+        t.daemon = True
+        t.start()
+
+    with race.lock:
+        while race.winner is None and race.not_modified is None and race.pending > 0:
+            race.cond.wait()
+        if race.winner is not None:
+            return race.winner
+        if race.not_modified is not None:
+            raise race.not_modified
+        for error in race.errors:
+            if not isinstance(error, DownloadError):
+                raise error
+        raise race.errors[0]
+
+
+def download_any_to_file(urls, ua, outputname, max_size=None, with_hash=True, partial=None, metrics=None, segments=1, host=None, validators=None, reservation=None):
+    # Like download_to_file, but urls is a list of candidate URLs for the same file
+    # (like a templated link with and without the license ID filled in).
+    # If a candidate already worked for this host before, that one is tried first.
+    # Otherwise all candidates are raced, and the first one that answers is used.
+    # Returns (index of the URL that was used, StreamResult).
+
+    if len(urls) == 1:
+        return 0, download_to_file(urls[0], ua, outputname, max_size, with_hash, partial, metrics, segments, None, validators, reservation)
+
+    # Continue an interrupted download with the URL that produced it
+    state = partial.load() if partial is not None else None
+    if state is not None and state.get("url") in urls:
+        index = urls.index(state["url"])
+        return index, download_to_file(urls[index], ua, outputname, max_size, with_hash, partial, metrics, segments, None, None, reservation)
+
+    candidates = list(range(len(urls)))
+    with _preferred_candidate_lock:
+        preferred = _preferred_candidate.get(host)
+    if preferred is not None and preferred < len(urls):
+        try:
+            return preferred, download_to_file(urls[preferred], ua, outputname, max_size, with_hash, partial, metrics, segments, None, validators, reservation)
+        except (NotModified, diskspace.InsufficientSpace):
+            raise
+        except Exception as e:
+            print("{0} v{1}: Download from {2} failed ({3}), trying other URLs ...".format(PLUGIN_NAME, PLUGIN_VERSION, urls[preferred], e))
+            with _preferred_candidate_lock:
+                _preferred_candidate.pop(host, None)
+            candidates.remove(preferred)
+
+    start = time.time()
+    try:
+        winner, handler = race_urls([urls[i] for i in candidates], ua, metrics, validators)
+    finally:
+        if metrics is not None:
+            metrics.add_time("race", time.time() - start)
+    index = candidates[winner]
+
+    with _preferred_candidate_lock:
+        _preferred_candidate[host] = index
+
+    return index, download_to_file(urls[index], ua, outputname, max_size, with_hash, partial, metrics, segments, handler, None, reservation)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Persistent index of fulfilled licenses (SQLite).
+# For every fulfillment it records the license ID, the publication (the cache
+# key: its SHA256 hash, or its URL) and the output file (path, size, mtime).
+# Importing the same LCPL file again - or another license for the same
+# publication - can then be answered from the local file before any network
+# access. Lookups go through the primary key / an index, so they take the same
+# few page reads no matter how many licenses the index holds.
+#
+# Only the headless batch fulfillment (cli.py) produces durable output files.
+# In the GUI, the recorded file is Calibre's temporary file, which is deleted
+# when Calibre exits; its record is dropped on the next lookup. Repeat imports
+# across restarts are answered by the publication cache there instead.
+
+import os
+import time
+
+import calibre_plugins.lcplinput.sqlitedb as sqlitedb     # type: ignore
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fulfillments (
+    license_id TEXT PRIMARY KEY,
+    publication_key TEXT NOT NULL,
+    sha256 TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    path TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fulfillments_publication ON fulfillments (publication_key);
+"""
+
+# How many records for the same publication are looked at
+MAX_PUBLICATION_RECORDS = 5
+
+
+class FulfillmentRecord(object):
+    __slots__ = ("license_id", "publication_key", "sha256", "size", "mtime", "path", "created")
+
+    def __init__(self, row):
+        (self.license_id, self.publication_key, self.sha256, self.size,
+            self.mtime, self.path, self.created) = row
+
+    def is_usable(self):
+        # True if the output file is still there, unchanged.
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_size == self.size and abs(st.st_mtime - self.mtime) < 0.001
+
+
+class FulfillmentIndex(sqlitedb.SQLiteStore):
+    SCHEMA = SCHEMA
+
+    def find_license(self, license_id):
+        row = self._connect().execute("SELECT license_id, publication_key, sha256, size, mtime, path, created "
+            "FROM fulfillments WHERE license_id = ?", (license_id,)).fetchone()
+        return FulfillmentRecord(row) if row is not None else None
+
+    def find_publication(self, publication_key):
+        # Most recent first
+        rows = self._connect().execute("SELECT license_id, publication_key, sha256, size, mtime, path, created "
+            "FROM fulfillments WHERE publication_key = ? ORDER BY created DESC LIMIT ?",
+            (publication_key, MAX_PUBLICATION_RECORDS)).fetchall()
+        return [FulfillmentRecord(row) for row in rows]
+
+    def add(self, license_id, publication_key, sha256, path):
+        st = os.stat(path)
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO fulfillments (license_id, publication_key, sha256, size, mtime, path, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (license_id, publication_key, sha256, st.st_size, st.st_mtime, path, time.time()))
+
+    def update_path(self, license_id, path):
+        # The output file was moved (headless batch fulfillment)
+        st = os.stat(path)
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE fulfillments SET path = ?, size = ?, mtime = ? WHERE license_id = ?",
+                (path, st.st_size, st.st_mtime, license_id))
+
+    def remove(self, license_id):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM fulfillments WHERE license_id = ?", (license_id,))
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM fulfillments").fetchone()[0]
+
+
+def get_index(path):
+    return sqlitedb.get_shared(FulfillmentIndex, path)
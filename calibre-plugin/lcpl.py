@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Parsed representation of an LCPL license file.
+# The file is parsed once (in LCPLInput.run or the batch code) and the
+# resulting LCPLicense object is handed to all later stages, so nobody
+# needs to call json.loads or walk the "links" list again.
+
+import json
+import os
+
+try:
+    # Python 3
+    from urllib.parse import urlparse
+except:
+    # Python 2
+    from urlparse import urlparse
+
+
+# LCPL files are tiny (a few KB). Anything larger than this isn't a license
+# and is rejected without reading / decoding it.
+MAX_LCPL_SIZE = 1024 * 1024
+
+# Number of bytes looked at before deciding whether to parse a file at all.
+SNIFF_SIZE = 64
+
+PUBLICATION_TYPES = {
+    "application/epub+zip": ".epub",
+    "application/pdf": ".pdf",
+}
+
+
+class PublicationLink(object):
+    __slots__ = ("href", "type", "length", "hash", "templated", "extension")
+
+    def __init__(self, link):
+        self.href = link["href"]
+        self.type = link["type"]
+        self.extension = PUBLICATION_TYPES.get(self.type, ".zip")
+        self.length = link.get("length", 0)
+        self.hash = link["hash"].lower() if "hash" in link else None
+
+        # This is a templated URL. The license server is supposed to fix this, but you never know
+        # Not sure if this should be a Bool or a String, so accept both.
+        templated = link.get("templated", False)
+        self.templated = templated is True or str(templated).lower() == "true"
+
+    @property
+    def host(self):
+        try:
+            return urlparse(self.href).netloc.lower()
+        except:
+            return ""
+
+
+class LCPLicense(object):
+    __slots__ = ("id", "profile", "rights_start", "rights_end", "publication", "raw")
+
+    def __init__(self, raw, data):
+        # raw is the license file content as a string, data the parsed JSON.
+        import dateutil.parser
+
+        self.raw = raw
+        self.id = data["id"]
+        self.profile = data["encryption"]["profile"]
+
+        rights = data.get("rights", {})
+        self.rights_start = dateutil.parser.isoparse(rights["start"]) if "start" in rights else None
+        self.rights_end = dateutil.parser.isoparse(rights["end"]) if "end" in rights else None
+
+        self.publication = None
+        for link in data.get("links", []):
+            if link.get("rel") == "publication" and link.get("type") in PUBLICATION_TYPES:
+                self.publication = PublicationLink(link)
+                break
+
+    def is_in_rights_window(self):
+        return self.get_rights_status() is None
+
+    def get_rights_status(self):
+        # Returns None if the license is valid right now, 
+        # otherwise "not_yet_valid" or "expired".
+        import datetime
+
+        lic_start = self.rights_start
+        lic_end = self.rights_end
+
+        try:
+            # Python 3
+            currenttime = datetime.datetime.now(datetime.timezone.utc)
+        except:
+            # Python 2
+            if lic_start is not None:
+                lic_start = lic_start.replace(tzinfo=None)
+            if lic_end is not None:
+                lic_end = lic_end.replace(tzinfo=None)
+            currenttime = datetime.datetime.utcnow()
+
+        if lic_start is not None and lic_start > currenttime:
+            return "not_yet_valid"
+        if lic_end is not None and lic_end < currenttime:
+            return "expired"
+        return None
+
+
+def parse_license(lcpl_string):
+    # Returns an LCPLicense, or None if lcpl_string isn't a valid LCPL license.
+    try:
+        return LCPLicense(lcpl_string, json.loads(lcpl_string))
+    except:
+        return None
+
+
+def sniff_lcpl(prefix, size):
+    # Cheap check on the first bytes of a file: an LCPL file is a small JSON object.
+    if size > MAX_LCPL_SIZE:
+        return False
+    if prefix.startswith(b"\xef\xbb\xbf"):
+        prefix = prefix[3:]
+    return prefix.lstrip()[:1] == b"{"
+
+
+def read_license_file(path):
+    # Returns an LCPLicense if path is an LCPL license file, otherwise None.
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        prefix = f.read(SNIFF_SIZE)
+        if not sniff_lcpl(prefix, size):
+            return None
+        data = prefix + f.read()
+
+    return parse_license(data.decode('latin-1'))
+
+
+LICENSE_PATH = "META-INF/license.lcpl"
+
+
+def replace_license(filename, raw):
+    # filename is a fulfilled publication, with a license injected as its last ZIP entry.
+    # Replaces that license with raw (by writing the new entry over the old one).
+    # Returns False if the file doesn't look like that.
+    from zipfile import ZipFile
+    from contextlib import closing
+
+    try:
+        with open(filename, "r+b") as f:
+            with closing(ZipFile(f, 'a')) as zf:
+                infos = zf.infolist()
+                if not infos or infos[-1].filename != LICENSE_PATH:
+                    return False
+                last = infos[-1]
+                if any(info.header_offset > last.header_offset for info in infos):
+                    return False
+                if len([info for info in infos if info.filename == LICENSE_PATH]) != 1:
+                    return False
+
+                zf.filelist.remove(last)
+                del zf.NameToInfo[last.filename]
+                zf.start_dir = last.header_offset
+                zf.fp.seek(last.header_offset)
+                zf.writestr(LICENSE_PATH, raw)
+            # The new entry may be shorter than the old one
+            f.truncate()
+    except:
+        return False
+    return check_license_entry(filename, raw, [info.filename for info in infos])
+
+
+def check_license_entry(filename, raw, names):
+    # Reads filename back after replace_license: it must still be a readable ZIP
+    # archive with the same entries (names), ending in the license entry with
+    # raw in it (in the encoding ZipFile.writestr used).
+    from zipfile import ZipFile
+    from contextlib import closing
+
+    if not isinstance(raw, bytes):
+        raw = raw.encode("utf-8")
+    try:
+        with closing(ZipFile(filename, 'r')) as zf:
+            if [info.filename for info in zf.infolist()] != names:
+                return False
+            # read() checks the CRC, too
+            return zf.read(LICENSE_PATH) == raw
+    except:
+        return False
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Per-import timing and byte counters.
+# Every LCPL import gets an ImportMetrics object that is handed through all
+# stages (parse, rights check, cache lookup, connect, time-to-first-byte,
+# transfer, hashing, license injection, downstream plugins). At the end, the
+# record is appended as one JSON line to the metrics file (if one is set in
+# the settings) and added to an in-process summary.
+
+import collections
+import json
+import threading
+import time
+
+
+# How many finished records the in-process summary keeps
+SUMMARY_SIZE = 10000
+
+_summary_lock = threading.Lock()
+_summary = collections.deque(maxlen=SUMMARY_SIZE)
+_file_lock = threading.Lock()
+
+
+class _Phase(object):
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.add_time(self.name, time.time() - self.start)
+        return False
+
+
+class ImportMetrics(object):
+    def __init__(self, source=None):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.record = {
+            "source": source,
+            "license_id": None,
+            "host": None,
+            "started": self.started,
+            "phases": {},
+            "counters": {},
+            "result": None,
+        }
+        self.finished = False
+
+    def phase(self, name):
+        # with metrics.phase("inject"): ...
+        return _Phase(self, name)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            phases = self.record["phases"]
+            phases[name] = phases.get(name, 0.0) + seconds
+
+    def add_count(self, name, amount=1):
+        # Byte counters ("bytes_downloaded", ...) and event counters ("requests", "retries", ...)
+        with self.lock:
+            counters = self.record["counters"]
+            counters[name] = counters.get(name, 0) + amount
+
+    def set(self, key, value):
+        with self.lock:
+            self.record[key] = value
+
+    def finish(self, result, metrics_file=None):
+        # result: "ok" or "failed"
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            self.record["result"] = result
+            self.record["total"] = time.time() - self.started
+            record = dict(self.record)
+
+        with _summary_lock:
+            _summary.append(record)
+
+        if metrics_file:
+            line = json.dumps(record, sort_keys=True)
+            with _file_lock:
+                try:
+                    with open(metrics_file, "a") as f:
+                        f.write(line + "\n")
+                except:
+                    pass
+
+
+def percentile(values, pct):
+    # Linear interpolation between the closest ranks, None without values.
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def get_summary():
+    # Counts, p50/p95 per phase and download throughput over the recent imports.
+    with _summary_lock:
+        records = list(_summary)
+
+    results = {}
+    phases = {}
+    downloaded = 0
+    transfer_time = 0.0
+    for record in records:
+        results[record["result"]] = results.get(record["result"], 0) + 1
+        for name, seconds in record["phases"].items():
+            phases.setdefault(name, []).append(seconds)
+        downloaded += record["counters"].get("bytes_downloaded", 0)
+        transfer_time += record["phases"].get("transfer", 0.0)
+
+    return {
+        "imports": len(records),
+        "results": results,
+        "phases": dict((name, {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+        }) for name, values in phases.items()),
+        "bytes_downloaded": downloaded,
+        "bytes_per_second": downloaded / transfer_time if transfer_time > 0 else None,
+    }
+
+
+def format_summary(summary=None):
+    if summary is None:
+        summary = get_summary()
+    lines = ["{0} imports ({1})".format(summary["imports"],
+        ", ".join("{0}: {1}".format(k, v) for k, v in sorted(summary["results"].items(), key=lambda kv: str(kv[0]))))]
+    for name, stats in sorted(summary["phases"].items()):
+        lines.append("  {0:<24} n={1:<6} p50={2:.3f}s p95={3:.3f}s".format(name, stats["count"], stats["p50"], stats["p95"]))
+    if summary["bytes_per_second"] is not None:
+        lines.append("  downloaded {0:.1f} MB at {1:.1f} MB/s".format(
+            summary["bytes_downloaded"] / 1048576.0, summary["bytes_per_second"] / 1048576.0))
+    return "\n".join(lines)
+
+
+def reset_summary():
+    with _summary_lock:
+        _summary.clear()
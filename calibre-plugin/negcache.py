@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Persistent list of failed downloads (SQLite), keyed by license ID and URL.
+# When a download fails because the server refused it (4xx) or couldn't be
+# reached at all (timeouts, connection errors, 5xx after all retries), that is
+# recorded with the status code and time. Importing the same license again
+# (auto-add retries, re-imports, batches) is then refused right away instead
+# of waiting for the same timeouts again - until the record's backoff is over.
+# Each further failure doubles the backoff, a successful download removes the
+# record. The list can be cleared in the plugin settings (or with the CLI's
+# --clear-failures).
+
+import time
+
+import calibre_plugins.lcplinput.sqlitedb as sqlitedb     # type: ignore
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS failures (
+    license_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    status INTEGER,
+    message TEXT,
+    failures INTEGER NOT NULL,
+    last_failed REAL NOT NULL,
+    retry_at REAL NOT NULL,
+    PRIMARY KEY (license_id, url)
+);
+"""
+
+# Backoff per kind of failure: (first, maximum) in seconds
+RETRY_DELAYS = {
+    "gone": (24 * 3600, 30 * 24 * 3600),        # 404 / 410, the link is dead
+    "refused": (3600, 7 * 24 * 3600),           # other 4xx (401, 403, ...)
+    "network": (300, 6 * 3600),                 # unreachable, timeouts, 5xx
+}
+
+
+# errno values of failed connections (Python 2 reports them as plain socket.error)
+_NETWORK_ERRNOS = ("ECONNRESET", "ECONNREFUSED", "ECONNABORTED", "ETIMEDOUT", "EHOSTUNREACH",
+    "EHOSTDOWN", "ENETUNREACH", "ENETDOWN", "EPIPE")
+
+
+def _is_network_error(error):
+    # Connections that broke off in the middle of a transfer don't count: the
+    # server was reachable, and the next import resumes the partial download.
+    import errno
+    import socket
+    try:
+        # Python 3
+        from http.client import HTTPException, IncompleteRead
+        from urllib.error import URLError
+    except ImportError:
+        # Python 2
+        from httplib import HTTPException, IncompleteRead
+        from urllib2 import URLError
+
+    if isinstance(error, IncompleteRead):
+        return False
+    types = [socket.timeout, socket.gaierror, socket.herror, HTTPException, URLError]
+    try:
+        types.append(ConnectionError)
+    except NameError:
+        # Python 2
+        pass
+    if isinstance(error, tuple(types)):
+        return True
+    if isinstance(error, EnvironmentError) and error.errno is not None:
+        return error.errno in [getattr(errno, name) for name in _NETWORK_ERRNOS if hasattr(errno, name)]
+    return False
+
+
+def classify(error):
+    # Returns (kind, status) for an exception from a download, or None if
+    # the failure isn't worth remembering (content errors, local problems
+    # like a full disk, transfers that broke off but can be resumed, ...).
+    if getattr(error, "resumable", False):
+        return None
+    status = getattr(error, "status", None)
+    if status is not None:
+        if status in (404, 410):
+            return "gone", status
+        if status == 429:
+            # Handled by the rate limiter, the link itself is fine
+            return None
+        if 400 <= status < 500:
+            return "refused", status
+        if status >= 500:
+            # download.ServerError
+            return "network", status
+        return None
+
+    if _is_network_error(error):
+        # Unreachable, timeouts, connection resets
+        return "network", None
+    return None
+
+
+class FailureRecord(object):
+    __slots__ = ("license_id", "url", "kind", "status", "message", "failures", "last_failed", "retry_at")
+
+    def __init__(self, row):
+        (self.license_id, self.url, self.kind, self.status, self.message,
+            self.failures, self.last_failed, self.retry_at) = row
+
+    def is_blocked(self):
+        return self.retry_at > time.time()
+
+    def describe(self):
+        text = "failed {0} time{1}".format(self.failures, "" if self.failures == 1 else "s")
+        if self.status is not None:
+            text += " with error {0}".format(self.status)
+        elif self.message:
+            text += " ({0})".format(self.message)
+        return text + ", next try after {0}".format(time.strftime("%Y-%m-%d %H:%M", time.localtime(self.retry_at)))
+
+
+class FailureCache(sqlitedb.SQLiteStore):
+    SCHEMA = SCHEMA
+
+    def get(self, license_id, url):
+        row = self._connect().execute("SELECT license_id, url, kind, status, message, failures, last_failed, retry_at "
+            "FROM failures WHERE license_id = ? AND url = ?", (license_id, url)).fetchone()
+        return FailureRecord(row) if row is not None else None
+
+    def record(self, license_id, url, kind, status=None, message=None):
+        # Returns the new FailureRecord.
+        previous = self.get(license_id, url)
+        failures = previous.failures + 1 if previous is not None and previous.kind == kind else 1
+        first, maximum = RETRY_DELAYS[kind]
+        now = time.time()
+        retry_at = now + min(maximum, first * 2 ** min(failures - 1, 20))
+        row = (license_id, url, kind, status, message, failures, now, retry_at)
+
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO failures (license_id, url, kind, status, message, failures, last_failed, retry_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+        return FailureRecord(row)
+
+    def forget(self, license_id, url):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM failures WHERE license_id = ? AND url = ?", (license_id, url))
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM failures")
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM failures WHERE retry_at > ?", (time.time(),)).fetchone()[0]
+
+
+def get_cache(path):
+    return sqlitedb.get_shared(FailureCache, path)
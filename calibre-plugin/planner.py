@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Planning pass for batches of LCPL files.
+# Looks only at the LCPL files themselves (no network): drops licenses that
+# are expired or not valid yet (with the same rights check as a single import),
+# picks the publication link, adds up the declared lengths and orders the
+# downloads. Licenses whose download failed recently (see negcache.py) are
+# dropped as well. Ordering policies:
+#   shortest-first  small books first - lowest mean time until a book is done,
+#                   and a few huge books can't hold up all the small ones
+#   round-robin     alternate between content servers (shortest first per server)
+#   fifo            in the order the files were given
+
+import collections
+
+from calibre_plugins.lcplinput.__init__ import PLUGIN_NAME, PLUGIN_VERSION  # type: ignore
+
+
+ORDER_POLICIES = ("shortest-first", "round-robin", "fifo")
+
+
+class PlannedJob(object):
+    __slots__ = ("path", "license", "license_id", "host", "length", "status")
+
+    # status is None if the book can be downloaded, otherwise one of
+    # "unreadable", "invalid", "no_publication", "expired", "not_yet_valid",
+    # "known_failure".
+
+    def __init__(self, path):
+        self.path = path
+        self.license = None
+        self.license_id = None
+        self.host = ""
+        self.length = 0
+        self.status = None
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "license_id": self.license_id,
+            "host": self.host,
+            "length": self.length,
+            "status": self.status or "ok",
+        }
+
+
+class BatchPlan(object):
+    def __init__(self, jobs, dropped, policy):
+        self.jobs = jobs            # PlannedJobs to download, in download order
+        self.dropped = dropped      # PlannedJobs that won't be downloaded
+        self.policy = policy
+
+    @property
+    def total_bytes(self):
+        return sum(job.length for job in self.jobs)
+
+    @property
+    def unknown_length(self):
+        # Number of books without a declared length
+        return len([job for job in self.jobs if not job.length])
+
+    def get_lengths(self):
+        # Declared lengths, in download order. Books without one are
+        # assumed to be as large as the median of the others.
+        return _fill_unknown([job.length for job in self.jobs])
+
+    def estimate(self, bandwidth, workers=1):
+        # Returns (total seconds, mean seconds until a book is done) for a download at
+        # bandwidth bytes/s, shared equally between up to workers parallel downloads.
+        return simulate(self.get_lengths(), bandwidth, workers)
+
+    def to_dict(self, bandwidth=None, workers=1):
+        data = {
+            "policy": self.policy,
+            "books": len(self.jobs),
+            "dropped": len(self.dropped),
+            "bytes": self.total_bytes,
+            "unknown_length": self.unknown_length,
+            "jobs": [job.to_dict() for job in self.jobs],
+            "dropped_jobs": [job.to_dict() for job in self.dropped],
+        }
+        if bandwidth:
+            data["bandwidth"] = bandwidth
+            data["workers"] = workers
+            data["estimated_s"], data["mean_completion_s"] = self.estimate(bandwidth, workers)
+        return data
+
+
+def _get_length(publication):
+    try:
+        return max(0, int(publication.length))
+    except:
+        return 0
+
+
+def _fill_unknown(lengths):
+    known = sorted(length for length in lengths if length)
+    if not known:
+        return list(lengths)
+    median = known[len(known) // 2]
+    return [length or median for length in lengths]
+
+
+def check_license(job, honor_time_limits=True, failures=None):
+    # Fills in job from its LCPL file. Returns False if it can't be downloaded.
+    # failures is the negcache.FailureCache, if enabled.
+    import calibre_plugins.lcplinput.lcpl as lcpl       # type: ignore
+
+    try:
+        license = lcpl.read_license_file(job.path)
+    except:
+        job.status = "unreadable"
+        return False
+    if license is None:
+        job.status = "invalid"
+        return False
+
+    job.license = license
+    job.license_id = license.id
+
+    rights_status = license.get_rights_status()
+    if rights_status is not None and honor_time_limits:
+        job.status = rights_status
+        return False
+
+    publication = license.publication
+    if publication is None:
+        job.status = "no_publication"
+        return False
+
+    job.host = publication.host
+    job.length = _get_length(publication)
+
+    if failures is not None:
+        try:
+            failure = failures.get(license.id, publication.href)
+        except:
+            failure = None
+        if failure is not None and failure.is_blocked():
+            job.status = "known_failure"
+            return False
+    return True
+
+
+def order_jobs(jobs, policy):
+    if policy == "fifo":
+        return list(jobs)
+
+    lengths = _fill_unknown([job.length for job in jobs])
+    by_size = [job for _, _, job in sorted(zip(lengths, range(len(jobs)), jobs), key=lambda t: (t[0], t[1]))]
+    if policy == "shortest-first":
+        return by_size
+
+    # round-robin
+    by_host = collections.OrderedDict()
+    for job in by_size:
+        by_host.setdefault(job.host, collections.deque()).append(job)
+    ordered = []
+    while by_host:
+        for host in list(by_host):
+            queue = by_host[host]
+            ordered.append(queue.popleft())
+            if not queue:
+                del by_host[host]
+    return ordered
+
+
+def plan_batch(paths, honor_time_limits=True, policy="shortest-first", failures=None):
+    if policy not in ORDER_POLICIES:
+        raise ValueError("Unknown order policy {0}".format(policy))
+
+    jobs = []
+    dropped = []
+    for path in paths:
+        job = PlannedJob(path)
+        if check_license(job, honor_time_limits, failures):
+            jobs.append(job)
+        else:
+            dropped.append(job)
+
+    return BatchPlan(order_jobs(jobs, policy), dropped, policy)
+
+
+def simulate(lengths, bandwidth, workers=1):
+    # Downloads lengths (in that order) with up to workers at a time, sharing
+    # bandwidth equally. Returns (total seconds, mean completion seconds).
+    if not lengths or bandwidth <= 0:
+        return (0.0, 0.0)
+
+    pending = collections.deque(lengths)
+    active = []
+    now = 0.0
+    completions = []
+    workers = max(1, workers)
+    while pending or active:
+        while pending and len(active) < workers:
+            active.append(float(pending.popleft()))
+        smallest = min(active)
+        now += smallest * len(active) / bandwidth
+        remaining = []
+        for left in active:
+            left -= smallest
+            if left > 0.5:
+                remaining.append(left)
+            else:
+                completions.append(now)
+        active = remaining
+
+    return (now, sum(completions) / len(completions))
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return "{0:.1f} {1}".format(size, unit) if unit != "B" else "{0} B".format(size)
+        size /= 1024.0
+
+
+def format_duration(seconds):
+    if seconds < 10:
+        return "{0:.1f} s".format(seconds)
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "{0} s".format(seconds)
+    if seconds < 3600:
+        return "{0} min {1} s".format(seconds // 60, seconds % 60)
+    return "{0} h {1} min".format(seconds // 3600, (seconds % 3600) // 60)
+
+
+def print_plan(plan, bandwidth=None, workers=1):
+    print("{0} v{1}: Download plan ({2}):".format(PLUGIN_NAME, PLUGIN_VERSION, plan.policy))
+    for job in plan.jobs:
+        print("  {0:>10}  {1:<30}  {2}".format(format_size(job.length) if job.length else "?", job.host, job.path))
+    for job in plan.dropped:
+        print("  {0:>10}  {1:<30}  {2}".format(job.status, job.host, job.path))
+
+    counts = collections.Counter(job.status for job in plan.dropped)
+    print("{0} v{1}: {2} books to download{3}".format(PLUGIN_NAME, PLUGIN_VERSION, len(plan.jobs),
+        "".join(", {0} {1}".format(count, status.replace("_", " ")) for status, count in sorted(counts.items()))))
+
+    line = "{0} v{1}: {2} in total".format(PLUGIN_NAME, PLUGIN_VERSION, format_size(plan.total_bytes))
+    if plan.unknown_length:
+        line += " ({0} books without a declared length)".format(plan.unknown_length)
+    if bandwidth:
+        total, mean = plan.estimate(bandwidth, workers)
+        line += ", about {0} at {1}/s (a book is done after {2} on average)".format(
+            format_duration(total), format_size(bandwidth), format_duration(mean))
+    print(line)
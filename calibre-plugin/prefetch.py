@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Background prefetch for Calibre's auto-add folder.
+# Calibre only hands an LCPL file from the auto-add folder to LCPLInput.run when it
+# gets around to importing it, and then the whole download blocks the import.
+# If enabled, a watcher thread in the GUI process looks for new LCPL files in that
+# folder and starts downloading the publications right away (a few at a time).
+#
+# Finished, verified downloads are left in the plugin cache directory (see
+# PrefetchStore), where run() picks them up - no matter which process it runs in.
+# If the prefetch for a book is still running, run() waits for it instead of
+# downloading the same book a second time.
+
+import collections
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from calibre_plugins.lcplinput.__init__ import PLUGIN_NAME, PLUGIN_VERSION  # type: ignore
+
+
+# How often the auto-add folder is checked for new files
+POLL_INTERVAL = 2.0
+
+# A file has to be unchanged for this long before we read it (Calibre or the
+# user might still be writing it)
+SETTLE_TIME = 1.0
+
+# Wait this long after Calibre's start before starting the watcher
+STARTUP_DELAY = 10.0
+
+# Running prefetches refresh their in-flight marker regularly. A marker that's
+# older than this belongs to a prefetch that died (Calibre crashed, ...).
+INFLIGHT_TIMEOUT = 30.0
+
+# Prefetched books that are never imported are deleted after this long
+MAX_AGE = 24 * 3600
+
+
+def get_prefetch_key(license):
+    data = "{0}\n{1}\n{2}".format(license.id, license.publication.href, license.publication.hash or "")
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+class PrefetchStore(object):
+    # The files shared between the prefetcher and run(), per book:
+    #   <key>.inflight    a prefetch is running
+    #   <key><extension>  the downloaded, verified publication (without the license)
+    #   <key>.taken       run() didn't find anything and downloads the book itself
+    #                     (so the prefetcher doesn't start it anymore)
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _is_inflight(self, key):
+        try:
+            return time.time() - os.path.getmtime(self._path(key, ".inflight")) < INFLIGHT_TIMEOUT
+        except OSError:
+            return False
+
+    def _touch(self, path):
+        try:
+            with open(path, "a"):
+                pass
+            os.utime(path, None)
+        except:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def take(self, license, outputname):
+        # Called by run(). Returns True if outputname now contains the prefetched publication.
+        key = get_prefetch_key(license)
+        ready = self._path(key, license.publication.extension)
+
+        while True:
+            # Rename first, so only one caller can ever get the file
+            claimed = "{0}.{1}.{2}.claimed".format(ready, os.getpid(), threading.current_thread().ident)
+            try:
+                os.rename(ready, claimed)
+            except OSError:
+                claimed = None
+
+            if claimed is not None:
+                try:
+                    if os.path.exists(outputname):
+                        os.remove(outputname)
+                    shutil.move(claimed, outputname)
+                    self._remove(self._path(key, ".inflight"))
+                    return True
+                except:
+                    self._remove(claimed)
+                    break
+
+            if not self._is_inflight(key):
+                break
+            time.sleep(0.2)
+
+        self._touch(self._path(key, ".taken"))
+        return False
+
+    def begin(self, key, extension):
+        # Called by the prefetcher. Returns False if the book doesn't need to be prefetched.
+        if os.path.exists(self._path(key, ".taken")) or os.path.exists(self._path(key, extension)):
+            return False
+        if self._is_inflight(key):
+            return False
+        self._touch(self._path(key, ".inflight"))
+        return True
+
+    def heartbeat(self, key):
+        self._touch(self._path(key, ".inflight"))
+
+    def finish(self, key, extension, filename):
+        # filename is the verified download, or None if the prefetch failed.
+        if filename is not None:
+            ready = self._path(key, extension)
+            tmp = ready + ".tmp"
+            try:
+                shutil.move(filename, tmp)
+                os.rename(tmp, ready)
+            except:
+                self._remove(tmp)
+        self._remove(self._path(key, ".inflight"))
+
+    def cleanup(self):
+        # Deletes old leftovers
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            if name.endswith(".inflight"):
+                if age > INFLIGHT_TIMEOUT:
+                    self._remove(path)
+            elif age > MAX_AGE:
+                self._remove(path)
+
+
+def get_store():
+    import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+    return PrefetchStore(prefs.get_plugin_cache_dir("prefetch"))
+
+
+def get_auto_add_dir():
+    try:
+        from calibre.gui2 import gprefs      # type: ignore
+        path = gprefs.get("auto_add_path", None)
+    except:
+        return None
+    if path and os.path.isdir(path):
+        return path
+    return None
+
+
+class Prefetcher(object):
+    def __init__(self, plugin, store, workers=2):
+        self.plugin = plugin
+        self.store = store
+        self.workers = max(1, workers)
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.seen = {}          # path -> (size, mtime) of LCPL files we already looked at
+        self.running = set()    # keys of the prefetches in progress
+        self.stopped = False
+        self.active = 0         # worker threads that are running
+        self.threads = []
+
+    def start(self):
+        t = threading.Thread(target=self._watch, name="LCPLInput-prefetch-watch")
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+        with self.cond:
+            self._add_workers()
+
+    def _add_workers(self):
+        # Called with self.cond held
+        while self.active < self.workers:
+            t = threading.Thread(target=self._work, name="LCPLInput-prefetch-{0}".format(len(self.threads)))
+            t.daemon = True
+            self.active += 1
+            t.start()
+            self.threads.append(t)
+
+    def set_workers(self, workers):
+        # Changes the number of parallel downloads without interrupting the running
+        # ones. Surplus workers exit once they're done with their current book.
+        with self.cond:
+            self.workers = max(1, workers)
+            if not self.stopped:
+                self._add_workers()
+            self.cond.notify_all()
+
+    def stop(self):
+        # Running downloads finish, queued ones are dropped.
+        with self.cond:
+            self.stopped = True
+            self.queue.clear()
+            self.cond.notify_all()
+
+    def _watch(self):
+        last_cleanup = 0
+        while True:
+            with self.cond:
+                running = list(self.running)
+                stopped = self.stopped
+            if stopped and not running:
+                return
+
+            # Keep the markers of running downloads fresh (even after stop(),
+            # until they're done), so nobody starts the same book again
+            for key in running:
+                self.store.heartbeat(key)
+            if stopped:
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            try:
+                directory = get_auto_add_dir()
+                if directory is not None:
+                    self._poll(directory)
+                if time.time() - last_cleanup > 600:
+                    self.store.cleanup()
+                    last_cleanup = time.time()
+            except:
+                import traceback
+                traceback.print_exc()
+
+            with self.cond:
+                if not self.stopped:
+                    self.cond.wait(POLL_INTERVAL)
+
+    def _poll(self, directory):
+        import calibre_plugins.lcplinput.lcpl as lcpl       # type: ignore
+
+        now = time.time()
+        present = set()
+        for name in os.listdir(directory):
+            if not name.lower().endswith(".lcpl"):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            present.add(path)
+            if now - st.st_mtime < SETTLE_TIME or self.seen.get(path) == (st.st_size, st.st_mtime):
+                continue
+            self.seen[path] = (st.st_size, st.st_mtime)
+
+            license = lcpl.read_license_file(path)
+            if license is None or license.publication is None:
+                continue
+
+            print("{0} v{1}: Prefetching book for {2}".format(PLUGIN_NAME, PLUGIN_VERSION, name))
+            with self.cond:
+                self.queue.append((name, license))
+                self.cond.notify()
+
+        # Calibre removes the files once they're imported
+        for path in list(self.seen):
+            if path not in present:
+                del self.seen[path]
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped and self.active <= self.workers:
+                    self.cond.wait()
+                if self.stopped or self.active > self.workers:
+                    self.active -= 1
+                    return
+                name, license = self.queue.popleft()
+
+            key = get_prefetch_key(license)
+            extension = license.publication.extension
+            if not self.store.begin(key, extension):
+                continue
+
+            with self.cond:
+                self.running.add(key)
+            filename = None
+            try:
+                filename = self._download(name, license)
+            except:
+                import traceback
+                traceback.print_exc()
+            finally:
+                self.store.finish(key, extension, filename)
+                with self.cond:
+                    self.running.discard(key)
+
+    def _download(self, name, license):
+        # Returns the name of the verified download, or None.
+        import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+        import calibre_plugins.lcplinput.cache as cache     # type: ignore
+        import calibre_plugins.lcplinput.metrics as lcplmetrics     # type: ignore
+
+        settings = prefs.get_settings()
+        if settings["honor_license_time_limits"] and not license.is_in_rights_window():
+            return None
+
+        publication = license.publication
+        pubcache = self.plugin.getPublicationCache(settings)
+        if pubcache is not None and publication.hash and pubcache.contains(cache.get_cache_key(publication.hash, publication.href)):
+            # The import will find it in the cache anyway
+            return None
+
+        ua, _ = self.plugin.getUserAgent(settings)
+        outputname = self.plugin.temporary_file(publication.extension).name
+        metrics = lcplmetrics.ImportMetrics("prefetch:" + name)
+        metrics.set("license_id", license.id)
+        metrics.set("host", publication.host)
+
+        content_ok = None
+        try:
+            content_ok = self.plugin.downloadPublication(settings, license, ua, outputname, metrics, pubcache)
+        finally:
+            metrics.finish("ok" if content_ok else "failed", settings["metrics_file"])
+
+        if not content_ok:
+            try:
+                os.remove(outputname)
+            except OSError:
+                pass
+            return None
+        return outputname
+
+
+_prefetcher_lock = threading.Lock()
+_prefetcher = None
+
+
+def start(plugin, workers):
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is not None:
+            return _prefetcher
+        _prefetcher = Prefetcher(plugin, get_store(), workers)
+        _prefetcher.start()
+        print("{0} v{1}: Watching the auto-add folder for LCPL files".format(PLUGIN_NAME, PLUGIN_VERSION))
+        return _prefetcher
+
+
+def stop():
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is not None:
+            _prefetcher.stop()
+            _prefetcher = None
+
+
+def apply_settings(plugin):
+    # Starts or stops the prefetcher according to the settings.
+    import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+    settings = prefs.get_settings()
+    if settings["prefetch_auto_add"]:
+        with _prefetcher_lock:
+            current = _prefetcher
+        if current is not None:
+            current.set_workers(settings["prefetch_max_downloads"])
+        else:
+            start(plugin, settings["prefetch_max_downloads"])
+    else:
+        stop()
+
+
+def schedule_start(plugin):
+    # Called from LCPLInput.initialize
+    t = threading.Timer(STARTUP_DELAY, apply_settings, (plugin,))
+    t.daemon = True
+    t.start()
@@ -5,6 +5,8 @@
 
 # Standard Python modules.
 import os
+import threading
+import time
 import traceback
 
 from calibre.utils.config import JSONConfig             # type: ignore
@@ -12,6 +14,25 @@ from calibre_plugins.lcplinput.__init__ import PLUGIN_NAME  # type: ignore
 from calibre.constants import isosx, islinux            # type: ignore
 
 
+def get_plugin_cache_dir(*subdirs):
+    # Directory for data the plugin keeps between runs (partial downloads etc.)
+    # Everything in here can be deleted at any time.
+    try:
+        from calibre.constants import cache_dir             # type: ignore
+        base = cache_dir()
+    except:
+        import tempfile
+        base = tempfile.gettempdir()
+
+    path = os.path.join(base, PLUGIN_NAME.strip().lower().replace(' ', '_'), *subdirs)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
 class LCPLInput_Prefs():
     def __init__(self):
         JSON_PATH = os.path.join("plugins", PLUGIN_NAME.strip().lower().replace(' ', '_') + '.json')
@@ -51,6 +72,51 @@ class LCPLInput_Prefs():
         # you are using a nonstandard client, so you might get banned ...
         self.lcplinputprefs.defaults['honor_license_time_limits'] = True
 
+        # Downloaded publications are kept in a local cache (keyed by their SHA256 hash)
+        # so importing the same LCPL file again doesn't download the book again.
+        # This is the maximum size of that cache in MB, 0 disables the cache.
+        self.lcplinputprefs.defaults['publication_cache_size_mb'] = 1024
+
+        # When fulfilling many LCPL files at once (batch mode), this many downloads run
+        # at the same time, but no more than batch_max_downloads_per_host from the same server.
+        self.lcplinputprefs.defaults['batch_max_downloads'] = 4
+        self.lcplinputprefs.defaults['batch_max_downloads_per_host'] = 2
+
+        # Order in which batch downloads are started: "shortest-first" (small books
+        # first), "round-robin" (alternate between servers) or "fifo".
+        # The batch dry run estimates the download time at batch_bandwidth_mb MB/s.
+        self.lcplinputprefs.defaults['batch_order'] = "shortest-first"
+        self.lcplinputprefs.defaults['batch_bandwidth_mb'] = 10
+
+        # Large publications (at least 8 MB) are downloaded over this many parallel
+        # connections if the server supports Range requests. 1 disables that.
+        self.lcplinputprefs.defaults['download_segments'] = 4
+
+        # Download limits, 0 = unlimited: total download rate and download rate per
+        # content server (in KB/s), and requests per minute per content server.
+        self.lcplinputprefs.defaults['max_download_rate_kb'] = 0
+        self.lcplinputprefs.defaults['max_host_download_rate_kb'] = 0
+        self.lcplinputprefs.defaults['max_requests_per_minute'] = 0
+
+        # If enabled, LCPL files that show up in Calibre's auto-add folder are
+        # downloaded in the background right away (with this many downloads at 
+        # the same time), so the import itself doesn't have to wait for them.
+        self.lcplinputprefs.defaults['prefetch_auto_add'] = False
+        self.lcplinputprefs.defaults['prefetch_max_downloads'] = 2
+
+        # Fulfilled licenses are remembered (license ID, publication, output file) 
+        # so importing the same LCPL file again - or another license for the same
+        # book - reuses the earlier output file, as long as it still exists.
+        self.lcplinputprefs.defaults['fulfillment_index'] = True
+
+        # Downloads that failed (dead link, server unreachable) are remembered, and 
+        # the same license isn't tried again until a backoff time is over.
+        self.lcplinputprefs.defaults['failure_cache'] = True
+
+        # If set, a JSON record with per-phase timings and byte counters is
+        # appended to this file for every import (one line per import).
+        self.lcplinputprefs.defaults['metrics_file'] = ""
+
 
     def __getitem__(self,kind = None):
         if kind is not None:
@@ -62,9 +128,11 @@ class LCPLInput_Prefs():
 
     def set(self, kind, value):
         self.lcplinputprefs[kind] = value
+        invalidate_settings()
 
     def writeprefs(self,value = True):
         self.lcplinputprefs['configured'] = value
+        invalidate_settings()
 
     def addnamedvaluetoprefs(self, prefkind, keyname, keyvalue):
         try:
@@ -94,3 +162,64 @@ class LCPLInput_Prefs():
             traceback.print_exc()
         return False
 
+
+class LCPLInput_PrefsSnapshot():
+    # Read-only copy of all settings, see get_settings()
+
+    def __init__(self, prefs):
+        config = prefs.lcplinputprefs
+        self.values = {}
+        for kind in set(config.defaults) | set(config):
+            self.values[kind] = config[kind]
+        self.system_ua = prefs.get_system_ua()
+        self.file_path = getattr(config, "file_path", None)
+
+    def __getitem__(self, kind):
+        return self.values[kind]
+
+    def get_system_ua(self):
+        return self.system_ua
+
+
+# Creating an LCPLInput_Prefs object reads the JSON file from disk, which adds up
+# in batch imports. The plugin code uses this cached snapshot instead. It is dropped
+# when the settings are changed through LCPLInput_Prefs, and reloaded when the file
+# on disk changed (checked at most every SETTINGS_CHECK_INTERVAL seconds).
+SETTINGS_CHECK_INTERVAL = 1.0
+
+_settings_lock = threading.Lock()
+_settings = None
+_settings_mtime = None
+_settings_checked = 0
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except:
+        return None
+
+
+def get_settings():
+    global _settings, _settings_mtime, _settings_checked
+
+    with _settings_lock:
+        now = time.time()
+        if _settings is not None and now - _settings_checked < SETTINGS_CHECK_INTERVAL:
+            return _settings
+
+        if _settings is not None and _settings.file_path is not None:
+            _settings_checked = now
+            if _get_mtime(_settings.file_path) == _settings_mtime:
+                return _settings
+
+        _settings = LCPLInput_PrefsSnapshot(LCPLInput_Prefs())
+        _settings_mtime = _get_mtime(_settings.file_path) if _settings.file_path is not None else None
+        _settings_checked = now
+        return _settings
+
+
+def invalidate_settings():
+    global _settings
+    with _settings_lock:
+        _settings = None
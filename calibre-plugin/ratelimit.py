@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Bandwidth limits and request pacing for downloads.
+# All downloads in a process share one RateLimiter with token buckets for
+#   - the total download rate (bytes/s),
+#   - the download rate per content server (bytes/s),
+#   - the number of requests per minute per content server.
+# A server that answers with 429 / 503 is left alone for as long as its
+# Retry-After header says (or an increasing backoff without one), and its
+# request rate (if limited) is halved for a while.
+#
+# The limits come from the plugin settings; 0 means unlimited. Without any
+# limits set, downloads don't go through the buckets at all.
+
+import threading
+import time
+
+try:
+    # Python 3
+    from urllib.parse import urlparse
+except:
+    # Python 2
+    from urlparse import urlparse
+
+
+# How often a request that got 429 / 503 is repeated (after waiting)
+THROTTLE_RETRIES = 3
+
+# Don't wait longer than this for a server that asks us to come back later
+MAX_RETRY_AFTER = 300
+
+# Backoff for 429 / 503 without Retry-After: 2, 4, 8, ... seconds
+BACKOFF_START = 2.0
+
+# Byte buckets hold this many seconds worth of data, request buckets this many requests
+BYTE_BURST_SECONDS = 0.5
+REQUEST_BURST = 2
+
+
+def get_host(url):
+    try:
+        return urlparse(url).netloc.lower()
+    except:
+        return ""
+
+
+def parse_retry_after(value):
+    # Returns the delay in seconds, or None. Retry-After is either a number
+    # of seconds or an HTTP date.
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_tz, mktime_tz
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, mktime_tz(parsed) - time.time())
+    except:
+        return None
+
+
+class TokenBucket(object):
+    # rate tokens per second, up to burst tokens saved up. consume() may take the
+    # balance below zero; the caller then sleeps until that debt is paid off, so
+    # several threads sharing a bucket get the rate in total.
+
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time.time()
+
+    def set_rate(self, rate, burst):
+        with self.lock:
+            self._refill()
+            self.rate = float(rate)
+            self.burst = float(burst)
+            self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, amount):
+        # Returns how long the caller slept.
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class _Host(object):
+    __slots__ = ("bytes", "requests", "paused_until", "slowdown", "backoff")
+
+    def __init__(self):
+        self.bytes = None
+        self.requests = None
+        self.paused_until = 0.0
+        self.slowdown = 1.0     # factor for the request rate, < 1 after throttling
+        self.backoff = BACKOFF_START
+
+
+class Pacer(object):
+    # Byte pacing for one download; see RateLimiter.get_pacer.
+    __slots__ = ("buckets",)
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def consume(self, amount):
+        waited = 0.0
+        for bucket in self.buckets:
+            waited += bucket.consume(amount)
+        return waited
+
+
+class RateLimiter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.total_rate = 0
+        self.host_rate = 0
+        self.requests_per_minute = 0
+        self.total = None
+
+    def configure(self, total_rate, host_rate, requests_per_minute):
+        # Rates in bytes/s, 0 = unlimited.
+        with self.lock:
+            if (total_rate, host_rate, requests_per_minute) == (self.total_rate, self.host_rate, self.requests_per_minute):
+                return
+            self.total_rate = total_rate
+            self.host_rate = host_rate
+            self.requests_per_minute = requests_per_minute
+
+            if total_rate > 0:
+                if self.total is None:
+                    self.total = TokenBucket(total_rate, self._byte_burst(total_rate))
+                else:
+                    self.total.set_rate(total_rate, self._byte_burst(total_rate))
+            else:
+                self.total = None
+            for host in self.hosts.values():
+                self._configure_host(host)
+
+    def _byte_burst(self, rate):
+        return max(64 * 1024, rate * BYTE_BURST_SECONDS)
+
+    def _configure_host(self, host):
+        if self.host_rate > 0:
+            if host.bytes is None:
+                host.bytes = TokenBucket(self.host_rate, self._byte_burst(self.host_rate))
+            else:
+                host.bytes.set_rate(self.host_rate, self._byte_burst(self.host_rate))
+        else:
+            host.bytes = None
+
+        if self.requests_per_minute > 0:
+            rate = self.requests_per_minute / 60.0 * host.slowdown
+            if host.requests is None:
+                host.requests = TokenBucket(rate, REQUEST_BURST)
+            else:
+                host.requests.set_rate(rate, REQUEST_BURST)
+        else:
+            host.requests = None
+
+    def _get_host(self, name):
+        host = self.hosts.get(name)
+        if host is None:
+            host = self.hosts[name] = _Host()
+            self._configure_host(host)
+        return host
+
+    def get_pacer(self, name):
+        # Returns a Pacer for a download from host name, or None if there are no byte limits.
+        with self.lock:
+            host = self._get_host(name)
+            buckets = [bucket for bucket in (self.total, host.bytes) if bucket is not None]
+        return Pacer(buckets) if buckets else None
+
+    def before_request(self, name):
+        # Waits until a request to host name may be sent. Returns the time waited.
+        with self.lock:
+            host = self._get_host(name)
+            wait = host.paused_until - time.time()
+            requests = host.requests
+        waited = 0.0
+        if wait > 0:
+            time.sleep(wait)
+            waited += wait
+        if requests is not None:
+            waited += requests.consume(1)
+        return waited
+
+    def request_ok(self, name):
+        with self.lock:
+            host = self._get_host(name)
+            host.backoff = BACKOFF_START
+            if host.slowdown < 1.0:
+                # Slowly back to the configured rate
+                host.slowdown = min(1.0, host.slowdown * 1.1)
+                self._configure_host(host)
+
+    def throttled(self, name, retry_after):
+        # The host answered 429 / 503. retry_after is its Retry-After header (or None).
+        # Returns how long requests to it are paused.
+        delay = parse_retry_after(retry_after)
+        with self.lock:
+            host = self._get_host(name)
+            now = time.time()
+            # Parallel requests that ran into the same throttling count once
+            already_paused = host.paused_until > now
+            if delay is None:
+                delay = host.backoff
+                if not already_paused:
+                    host.backoff = min(MAX_RETRY_AFTER, host.backoff * 2)
+            host.paused_until = max(host.paused_until, now + min(delay, MAX_RETRY_AFTER))
+            if host.requests is not None and not already_paused:
+                host.slowdown = max(0.05, host.slowdown / 2)
+                self._configure_host(host)
+        return delay
+
+
+_limiter = RateLimiter()
+
+# Worker processes of the headless batch fulfillment each get a share of the limits
+_share = 1.0
+
+
+def set_share(share):
+    global _share
+    _share = share
+
+
+def get_limiter():
+    # Returns the RateLimiter, configured from the current settings.
+    import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+
+    settings = prefs.get_settings()
+    _limiter.configure(int(settings["max_download_rate_kb"] * 1024 * _share),
+        int(settings["max_host_download_rate_kb"] * 1024 * _share),
+        settings["max_requests_per_minute"] * _share)
+    return _limiter
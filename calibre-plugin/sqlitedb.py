@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Shared base for the plugin's small SQLite databases (fulfillment index,
+# failed downloads). Connections can't be shared between threads, so every
+# thread gets its own. They can't be used across fork() either, so every process
+# keeps its own registry of shared objects (get_shared), which forked worker
+# processes drop with reset_shared.
+
+import sqlite3
+import threading
+
+
+class SQLiteStore(object):
+    # Subclasses set SCHEMA (CREATE ... IF NOT EXISTS statements).
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connect(self):
+        # One connection per thread (batch downloads run on several threads)
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            try:
+                # Several processes (headless batch fulfillment) may write at the same time
+                conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError:
+                pass
+            conn.executescript(self.SCHEMA)
+            self.local.conn = conn
+        return conn
+
+
+
+_shared_lock = threading.Lock()
+_shared = {}
+
+
+def get_shared(cls, *args):
+    # One instance of cls per process and arguments (the stores, keyed by their
+    # path, and the connection pool)
+    key = (cls,) + args
+    with _shared_lock:
+        obj = _shared.get(key)
+        if obj is None:
+            obj = _shared[key] = cls(*args)
+        return obj
+
+
+def reset_shared():
+    # For forked worker processes: forget the inherited objects (their SQLite and
+    # HTTP connections belong to the parent process) without closing anything.
+    global _shared, _shared_lock
+    _shared_lock = threading.Lock()
+    _shared = {}
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Throughput benchmark for the LCPL Input plugin, outside of Calibre.
+#
+# Starts the local LCP content server stand-in (lcp_test_server.py) with
+# synthetic publications, writes matching LCPL files, and fulfills them
+#   - serially, through LCPLInput.run() (like Calibre's import does), and
+#   - as a batch, through LCPLInput.fulfillBatch().
+# For each mode it reports MB/s, per-book latency percentiles and peak RSS.
+# The publication cache is disabled so every book is really downloaded.
+#
+# Example:
+#   python3 tools/bench_fulfill.py --sizes 1M,10M,100M --count 5 --latency 0.05 --bandwidth 20M
+#
+# Synthetic publications are kept in --work-dir and reused across runs;
+# large sizes (up to 2G) take a while to create the first time.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS_DIR)
+
+import calibre_shims        # noqa: E402
+import lcp_test_server      # noqa: E402
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    if sys.platform == "darwin":
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+def summarize(mode, latencies, total_bytes, wall, failures):
+    import calibre_plugins.lcplinput.metrics as lcplmetrics     # type: ignore
+
+    return {
+        "mode": mode,
+        "books": len(latencies) + failures,
+        "failures": failures,
+        "total_mb": total_bytes / (1024.0 * 1024.0),
+        "wall_s": wall,
+        "mb_per_s": (total_bytes / (1024.0 * 1024.0)) / wall if wall > 0 else 0.0,
+        "latency_p50_s": lcplmetrics.percentile(latencies, 50) or 0.0,
+        "latency_p95_s": lcplmetrics.percentile(latencies, 95) or 0.0,
+        "latency_p99_s": lcplmetrics.percentile(latencies, 99) or 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def remove_output(path):
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def run_serial(plugin, lcpl_paths, sizes, quiet):
+    latencies = []
+    total = 0
+    failures = 0
+    start = time.time()
+    for path in lcpl_paths:
+        t0 = time.time()
+        with _maybe_quiet(quiet):
+            output = plugin.run(path)
+        if output == path:
+            failures += 1
+            continue
+        latencies.append(time.time() - t0)
+        total += sizes[path]
+        remove_output(output)
+    return summarize("serial", latencies, total, time.time() - start, failures)
+
+
+def run_batch(plugin, lcpl_paths, sizes, workers, per_host, quiet):
+    start = time.time()
+    with _maybe_quiet(quiet):
+        results = plugin.fulfillBatch(lcpl_paths, workers, per_host)
+    wall = time.time() - start
+    latencies = [r.elapsed for r in results if r.output is not None]
+    total = sum(sizes[r.path] for r in results if r.output is not None)
+    for r in results:
+        remove_output(r.output)
+    return summarize("batch", latencies, total, wall, len([r for r in results if r.output is None]))
+
+
+@contextlib.contextmanager
+def _maybe_quiet(quiet):
+    if not quiet:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def print_report(report):
+    print("{mode:>7}: {books} books ({failures} failed), {total_mb:.1f} MB in {wall_s:.2f} s = {mb_per_s:.1f} MB/s".format(**report))
+    print("         latency p50 {latency_p50_s:.3f} s, p95 {latency_p95_s:.3f} s, p99 {latency_p99_s:.3f} s".format(**report))
+    if report["peak_rss_mb"] is not None:
+        print("         peak RSS so far {0:.1f} MB".format(report["peak_rss_mb"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark LCPL fulfillment against a local content server.")
+    parser.add_argument("--sizes", default="1M,10M", help="comma separated publication sizes, e.g. 1M,100M,2G (default: 1M,10M)")
+    parser.add_argument("--count", type=int, default=5, help="licenses per size (default: 5)")
+    parser.add_argument("--kind", choices=sorted(lcp_test_server.CONTENT_TYPES), default="epub")
+    parser.add_argument("--mode", choices=["serial", "batch", "both"], default="both")
+    parser.add_argument("--workers", type=int, default=4, help="batch mode: concurrent downloads (default: 4)")
+    parser.add_argument("--per-host", type=int, default=4, help="batch mode: concurrent downloads per host (default: 4)")
+    parser.add_argument("--segments", type=int, default=None, help="parallel connections per download (default: plugin setting)")
+    parser.add_argument("--work-dir", default=os.path.join(TOOLS_DIR, ".bench"), help="where publications and temp files go")
+    parser.add_argument("--json", action="store_true", help="print the reports as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the plugin's output")
+    lcp_test_server.add_server_arguments(parser)
+    args = parser.parse_args(argv)
+
+    run_dir = os.path.join(args.work_dir, "run")
+    shutil.rmtree(run_dir, ignore_errors=True)
+    plugin_module = calibre_shims.install(run_dir)
+    plugin = plugin_module.LCPLInput(calibre_shims.PLUGIN_DIR)
+
+    # Make sure we measure downloads, not the cache
+    import calibre_plugins.lcplinput.prefs as prefs     # type: ignore
+    prefs.LCPLInput_Prefs().set("publication_cache_size_mb", 0)
+    if args.segments is not None:
+        prefs.LCPLInput_Prefs().set("download_segments", args.segments)
+
+    server = lcp_test_server.start_server(os.path.join(args.work_dir, "publications"),
+        lcp_test_server.options_from_arguments(args))
+
+    lcpl_dir = os.path.join(run_dir, "lcpl")
+    os.makedirs(lcpl_dir)
+    lcpl_paths = []
+    sizes = {}
+    for size_text in args.sizes.split(","):
+        size = lcp_test_server.parse_size(size_text)
+        pub = server.add_publication("bench-{0}".format(size_text.strip()), size, args.kind)
+        for i in range(args.count):
+            license_id = "bench-{0}-{1}".format(size_text.strip(), i)
+            path = os.path.join(lcpl_dir, license_id + ".lcpl")
+            with open(path, "w") as f:
+                f.write(pub.make_lcpl(server.url_for(pub), license_id))
+            lcpl_paths.append(path)
+            sizes[path] = pub.size
+
+    reports = []
+    if args.mode in ("serial", "both"):
+        reports.append(run_serial(plugin, lcpl_paths, sizes, not args.verbose))
+    if args.mode in ("batch", "both"):
+        reports.append(run_batch(plugin, lcpl_paths, sizes, args.workers, args.per_host, not args.verbose))
+
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps({"reports": reports, "server": server.stats}, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
+        print("server: {0}".format(", ".join("{0}={1}".format(k, v) for k, v in sorted(server.stats.items()))))
+
+    shutil.rmtree(run_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures what loading the LCPL Input plugin costs at Calibre startup.
+#
+# Every measurement runs in a fresh interpreter. It reports the time and the
+# number of newly imported modules for
+#   - "startup": loading the plugin module and calling initialize(), which
+#     is what every Calibre start (and every worker process) pays, and
+#   - "first use": loading everything an LCPL import needs on top of that,
+#     which used to be part of the startup cost before the imports were lazy.
+#
+# To compare against an older version of the plugin, point --plugin-dir
+# at its calibre-plugin directory (e.g. from "git worktree add").
+#
+# Usage: python3 tools/bench_startup.py [--runs N] [--plugin-dir DIR] [--json]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = r"""
+import json, sys, time
+sys.path.insert(0, {tools_dir!r})
+import calibre_shims
+calibre_shims.install_calibre()
+plugin_dir = {plugin_dir!r}
+
+before = set(sys.modules)
+start = time.perf_counter()
+plugin_module = calibre_shims.load_plugin(plugin_dir)
+plugin = plugin_module.LCPLInput(plugin_dir)
+plugin.initialize()
+startup_time = time.perf_counter() - start
+startup_modules = sorted(set(sys.modules) - before)
+
+before = set(sys.modules)
+start = time.perf_counter()
+import importlib, os
+for name in sorted(os.listdir(plugin_dir)):
+    if name.endswith(".py") and name not in ("__init__.py", "config.py"):
+        importlib.import_module("calibre_plugins.lcplinput." + name[:-3])
+import dateutil.parser, zipfile, traceback
+first_use_time = time.perf_counter() - start
+first_use_modules = sorted(set(sys.modules) - before)
+
+print(json.dumps({{
+    "startup_time": startup_time, "startup_modules": startup_modules,
+    "first_use_time": first_use_time, "first_use_modules": first_use_modules,
+}}))
+"""
+
+
+def measure_once(plugin_dir):
+    out = subprocess.check_output([sys.executable, "-c", CHILD.format(tools_dir=TOOLS_DIR, plugin_dir=plugin_dir)])
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the startup cost of the LCPL Input plugin.")
+    parser.add_argument("--runs", type=int, default=10, help="number of fresh interpreters to measure (default: 10)")
+    parser.add_argument("--plugin-dir", default=None, help="calibre-plugin directory to measure (default: this checkout)")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, TOOLS_DIR)
+    import calibre_shims
+    plugin_dir = os.path.abspath(args.plugin_dir or calibre_shims.PLUGIN_DIR)
+
+    runs = [measure_once(plugin_dir) for _ in range(args.runs)]
+    last = runs[-1]
+
+    result = {
+        "runs": args.runs,
+        "startup_ms": median([r["startup_time"] for r in runs]) * 1000.0,
+        "startup_module_count": len(last["startup_modules"]),
+        "first_use_ms": median([r["first_use_time"] for r in runs]) * 1000.0,
+        "first_use_module_count": len(last["first_use_modules"]),
+        "startup_modules": last["startup_modules"],
+    }
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return 0
+
+    print("Plugin startup (module load + initialize), median of {0} runs:".format(args.runs))
+    print("  {0:8.2f} ms, {1} modules imported".format(result["startup_ms"], result["startup_module_count"]))
+    print("    " + ", ".join(result["startup_modules"]))
+    print("Deferred to the first LCPL import:")
+    print("  {0:8.2f} ms, {1} modules imported".format(result["first_use_ms"], result["first_use_module_count"]))
+    print("Startup cost with eager imports would be about {0:.2f} ms / {1} modules.".format(
+        result["startup_ms"] + result["first_use_ms"], result["startup_module_count"] + result["first_use_module_count"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
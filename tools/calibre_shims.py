@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Minimal stand-ins for the parts of Calibre the LCPL Input plugin uses,
+# so the plugin code can be loaded and run outside of Calibre
+# (benchmarks, headless fulfillment on a server, ...).
+#
+# Usage:
+#   import calibre_shims
+#   plugin_module = calibre_shims.install()
+#   plugin = plugin_module.LCPLInput(calibre_shims.PLUGIN_DIR)
+#
+# Do not use this when running inside Calibre (calibre-debug), the
+# real modules are available there.
+
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import types
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "calibre-plugin")
+PLUGIN_PACKAGE = "calibre_plugins.lcplinput"
+
+_installed = None
+
+
+class _Plugin(object):
+    # calibre.customize.Plugin
+    name = "Trivial Plugin"
+    priority = 1
+    file_types = set()
+    on_import = False
+
+    def __init__(self, plugin_path):
+        self.plugin_path = plugin_path
+
+    def temporary_file(self, suffix):
+        return tempfile.NamedTemporaryFile(suffix=suffix, dir=_state["tmp_dir"], delete=False)
+
+
+class _FileTypePlugin(_Plugin):
+    pass
+
+
+class _JSONConfig(dict):
+    # calibre.utils.config.JSONConfig: a dict backed by a JSON file, with defaults.
+
+    def __init__(self, rel_path):
+        dict.__init__(self)
+        self.defaults = {}
+        if not rel_path.endswith(".json"):
+            rel_path += ".json"
+        self.file_path = os.path.join(_state["config_dir"], rel_path)
+        self.refresh()
+
+    def refresh(self):
+        self.clear()
+        try:
+            with open(self.file_path, "r") as f:
+                self.update(json.load(f))
+        except (IOError, OSError, ValueError):
+            pass
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            return self.defaults[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return self.defaults.get(key, default)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.commit()
+
+    def commit(self):
+        directory = os.path.dirname(self.file_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.file_path, "w") as f:
+            json.dump(dict(self), f, indent=2)
+
+
+_state = {}
+
+
+def _module(name, **attrs):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attrs)
+    sys.modules[name] = mod
+    return mod
+
+
+def install(base_dir=None, plugin_dir=PLUGIN_DIR):
+    # Registers the fake calibre modules and loads the plugin package from
+    # plugin_dir as calibre_plugins.lcplinput. Returns the plugin module.
+    # Config, cache and temporary files go to base_dir (a new temp dir by default).
+    if _installed is not None:
+        return _installed
+
+    install_calibre(base_dir)
+    return load_plugin(plugin_dir)
+
+
+def install_calibre(base_dir=None):
+    # Only registers the fake calibre modules.
+    if "calibre_plugins" in sys.modules:
+        return
+
+    if base_dir is None:
+        base_dir = tempfile.mkdtemp(prefix="lcplinput-")
+    _state["base_dir"] = base_dir
+    _state["config_dir"] = os.path.join(base_dir, "config")
+    _state["cache_dir"] = os.path.join(base_dir, "cache")
+    _state["tmp_dir"] = os.path.join(base_dir, "tmp")
+    for key in ("config_dir", "cache_dir", "tmp_dir"):
+        if not os.path.isdir(_state[key]):
+            os.makedirs(_state[key])
+
+    _module("calibre", __path__=[])
+    _module("calibre.customize", __path__=[], Plugin=_Plugin, FileTypePlugin=_FileTypePlugin)
+    _module("calibre.customize.ui",
+        _initialized_plugins=[],
+        is_disabled=lambda plugin: False,
+        config={"disabled_plugins": set(), "enabled_plugins": set()})
+    _module("calibre.utils", __path__=[])
+    _module("calibre.utils.config", JSONConfig=_JSONConfig)
+    _module("calibre.constants",
+        islinux=sys.platform.startswith("linux"),
+        isosx=sys.platform == "darwin",
+        iswindows=sys.platform.startswith("win"),
+        config_dir=_state["config_dir"],
+        cache_dir=lambda: _state["cache_dir"])
+    _module("calibre.ebooks", __path__=[], BOOK_EXTENSIONS=["epub", "pdf"])
+
+    _module("calibre_plugins", __path__=[])
+
+
+def load_plugin(plugin_dir=PLUGIN_DIR):
+    global _installed
+    if _installed is not None:
+        return _installed
+
+    try:
+        spec = importlib.util.spec_from_file_location(PLUGIN_PACKAGE, os.path.join(plugin_dir, "__init__.py"),
+            submodule_search_locations=[plugin_dir])
+        plugin_module = importlib.util.module_from_spec(spec)
+        sys.modules[PLUGIN_PACKAGE] = plugin_module
+        # The plugin's modules import "calibre_plugins.lcplinput.__init__" explicitly
+        sys.modules[PLUGIN_PACKAGE + ".__init__"] = plugin_module
+        spec.loader.exec_module(plugin_module)
+    except:
+        sys.modules.pop(PLUGIN_PACKAGE, None)
+        sys.modules.pop(PLUGIN_PACKAGE + ".__init__", None)
+        raise
+
+    _installed = plugin_module
+    return plugin_module
+
+
+def get_base_dir():
+    return _state.get("base_dir")
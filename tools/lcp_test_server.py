@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local HTTP stand-in for an LCP content server, for benchmarks and tests.
+#
+# It serves synthetic publications (EPUB or PDF, any size) from a work
+# directory and can simulate the things that make real content servers slow
+# or unreliable: latency before the response, limited bandwidth per connection,
+# missing Content-Length, no Range support and failures (error responses,
+# 429 above a request rate, connections that die halfway through the body or
+# that are reset after a number of bytes). Conditional requests
+# (If-None-Match / If-Modified-Since) are answered with 304.
+#
+# As a library:
+#   server = lcp_test_server.start_server(work_dir, options)
+#   pub = server.add_publication("book1", 10 * 1024 * 1024, "epub")
+#   lcpl_string = pub.make_lcpl(server.url_for(pub), license_id="...")
+#
+# Standalone: python3 tools/lcp_test_server.py --help
+
+import argparse
+import collections
+import email.utils
+import hashlib
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import zipfile
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    # Python < 3.7
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+
+CONTENT_TYPES = {
+    "epub": "application/epub+zip",
+    "pdf": "application/pdf",
+}
+
+_BLOCK_SIZE = 1024 * 1024
+
+
+class ServerOptions(object):
+    def __init__(self, latency=0.0, bandwidth=0, content_length=True, ranges=True,
+            error_rate=0.0, error_status=503, cut_rate=0.0, seed=None, request_limit=0,
+            reset_after=0):
+        self.latency = latency                  # seconds before the response headers are sent
+        self.bandwidth = bandwidth              # bytes per second and connection, 0 = unlimited
+        self.content_length = content_length    # send Content-Length (otherwise: close the connection at the end)
+        self.ranges = ranges                    # honor Range requests / send Accept-Ranges
+        self.error_rate = error_rate            # probability of answering with error_status instead
+        self.error_status = error_status
+        self.cut_rate = cut_rate                # probability of closing the connection halfway through the body
+        self.request_limit = request_limit      # requests per second, more get 429 (0 = unlimited)
+        self.reset_after = reset_after          # reset (RST) full responses after this many bytes (0 = never)
+        self.random = random.Random(seed)
+
+
+def parse_size(text):
+    # "512K", "10M", "2G" or plain bytes
+    text = text.strip().upper()
+    factor = 1
+    if text and text[-1] in "KMG":
+        factor = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[text[-1]]
+        text = text[:-1]
+    return int(float(text) * factor)
+
+
+def _filler(name, size):
+    # Deterministic, incompressible-looking data without keeping it in memory.
+    seed = hashlib.sha256(name.encode("utf-8")).digest()
+    block = b"".join(hashlib.sha256(seed + str(i).encode("ascii")).digest() for i in range(_BLOCK_SIZE // 32))
+    while size > 0:
+        chunk = block[:min(size, len(block))]
+        yield chunk
+        size -= len(chunk)
+
+
+class Publication(object):
+    def __init__(self, name, path, kind):
+        self.name = name
+        self.path = path
+        self.kind = kind
+        self.content_type = CONTENT_TYPES[kind]
+        self.size = os.path.getsize(path)
+        meta_path = path + ".sha256"
+        try:
+            with open(meta_path, "r") as f:
+                self.sha256 = f.read().strip()
+        except IOError:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(_BLOCK_SIZE), b""):
+                    digest.update(chunk)
+            self.sha256 = digest.hexdigest()
+            with open(meta_path, "w") as f:
+                f.write(self.sha256)
+        self.etag = '"{0}"'.format(self.sha256[:16])
+        self.last_modified = email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+
+    def make_lcpl(self, url, license_id, start="2000-01-01T00:00:00Z", end="2099-12-31T23:59:59Z", templated=False):
+        link = {
+            "rel": "publication",
+            "href": url,
+            "type": self.content_type,
+            "length": self.size,
+            "hash": self.sha256,
+        }
+        if templated:
+            link["templated"] = True
+        return json.dumps({
+            "id": license_id,
+            "provider": "http://localhost/lcp-test-server",
+            "issued": "2021-01-01T00:00:00Z",
+            "encryption": {"profile": "http://readium.org/lcp/basic-profile"},
+            "links": [link],
+            "rights": {"start": start, "end": end},
+        }, indent=2)
+
+
+def create_publication(path, name, size, kind):
+    # Writes a synthetic publication of roughly size bytes.
+    if kind == "epub":
+        # A valid (if useless) EPUB container with one big stored entry
+        payload = max(0, size - 400)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+            zf.writestr("mimetype", "application/epub+zip")
+            zf.writestr("META-INF/container.xml",
+                '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                '<rootfiles/></container>')
+            info = zipfile.ZipInfo("OEBPS/data.bin")
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = payload
+            with zf.open(info, "w", force_zip64=payload > 0x7fff0000) as out:
+                for chunk in _filler(name, payload):
+                    out.write(chunk)
+    else:
+        with open(path, "wb") as f:
+            f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+            for chunk in _filler(name, max(0, size - 32)):
+                f.write(chunk)
+            f.write(b"\n%%EOF\n")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def _send_empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _serve(self, head):
+        server = self.server
+        opts = server.options
+        server.count("requests")
+
+        if opts.latency > 0:
+            time.sleep(opts.latency)
+
+        pub = server.publications.get(self.path.split("?", 1)[0].lstrip("/"))
+        if pub is None:
+            server.count("not_found")
+            return self._send_empty(404)
+
+        if opts.request_limit > 0 and not server.allow_request(opts.request_limit):
+            server.count("throttled")
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if opts.error_rate > 0 and opts.random.random() < opts.error_rate:
+            server.count("errors")
+            self.send_response(opts.error_status)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        rng = self.headers.get("Range")
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if not rng and (if_none_match in (pub.etag, "*") or (not if_none_match and if_modified_since == pub.last_modified)):
+            server.count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", pub.etag)
+            self.send_header("Last-Modified", pub.last_modified)
+            self.end_headers()
+            return
+
+        start, end, status = 0, pub.size - 1, 200
+        if rng and opts.ranges:
+            try:
+                first, last = rng.split("=", 1)[1].split("-", 1)
+                start = int(first)
+                end = int(last) if last else pub.size - 1
+                end = min(end, pub.size - 1)
+                status = 206
+            except ValueError:
+                pass
+            if start >= pub.size:
+                server.count("range_errors")
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{0}".format(pub.size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if_range = self.headers.get("If-Range")
+            if if_range and if_range != pub.etag:
+                start, end, status = 0, pub.size - 1, 200
+
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header("Content-Type", pub.content_type)
+        self.send_header("ETag", pub.etag)
+        self.send_header("Last-Modified", pub.last_modified)
+        if opts.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, pub.size))
+        if opts.content_length:
+            self.send_header("Content-Length", str(length))
+        else:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+
+        if head:
+            return
+
+        cut_at = None
+        if opts.cut_rate > 0 and opts.random.random() < opts.cut_rate:
+            cut_at = opts.random.randint(0, max(0, length - 1))
+            server.count("cuts")
+        reset_at = None
+        if opts.reset_after > 0 and status == 200 and opts.reset_after < length:
+            reset_at = opts.reset_after
+            server.count("resets")
+
+        sent = 0
+        began = time.time()
+        try:
+            with open(pub.path, "rb") as f:
+                f.seek(start)
+                while sent < length:
+                    chunk = f.read(min(64 * 1024, length - sent))
+                    if not chunk:
+                        break
+                    if reset_at is not None and sent + len(chunk) > reset_at:
+                        self.wfile.write(chunk[:reset_at - sent])
+                        self.wfile.flush()
+                        sent = reset_at
+                        # Give the client time to read the data; an RST makes the
+                        # receiver drop whatever it hasn't read yet.
+                        time.sleep(0.2)
+                        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                        self.connection.close()
+                        self.close_connection = True
+                        return
+                    if cut_at is not None and sent + len(chunk) > cut_at:
+                        self.wfile.write(chunk[:cut_at - sent])
+                        self.wfile.flush()
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                        self.close_connection = True
+                        return
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    if opts.bandwidth > 0:
+                        ahead = sent / float(opts.bandwidth) - (time.time() - began)
+                        if ahead > 0:
+                            time.sleep(ahead)
+        except (socket.error, IOError):
+            # Client went away
+            self.close_connection = True
+        finally:
+            server.count("bytes_sent", sent)
+
+
+class LCPTestServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, work_dir, options=None, host="127.0.0.1", port=0, verbose=False):
+        ThreadingHTTPServer.__init__(self, (host, port), _Handler)
+        self.work_dir = work_dir
+        self.options = options or ServerOptions()
+        self.verbose = verbose
+        self.publications = {}
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+        self.recent_requests = collections.deque()
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def allow_request(self, limit):
+        # Sliding one second window
+        with self.stats_lock:
+            now = time.time()
+            while self.recent_requests and now - self.recent_requests[0] > 1.0:
+                self.recent_requests.popleft()
+            if len(self.recent_requests) >= limit:
+                return False
+            self.recent_requests.append(now)
+            return True
+
+    def add_publication(self, name, size, kind="epub"):
+        # Creates (or reuses) a synthetic publication and serves it as /<name>.<kind>
+        filename = "{0}-{1}.{2}".format(name, size, kind)
+        path = os.path.join(self.work_dir, filename)
+        if not os.path.exists(path):
+            create_publication(path + ".tmp", name, size, kind)
+            os.rename(path + ".tmp", path)
+        pub = Publication(filename, path, kind)
+        self.publications[filename] = pub
+        return pub
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    def url_for(self, pub):
+        return "{0}/{1}".format(self.base_url, pub.name)
+
+
+def start_server(work_dir, options=None, host="127.0.0.1", port=0, verbose=False):
+    # Starts the server on a background thread and returns it.
+    server = LCPTestServer(work_dir, options, host, port, verbose)
+    thread = threading.Thread(target=server.serve_forever, name="LCPTestServer")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response (default: 0)")
+    parser.add_argument("--bandwidth", type=parse_size, default=0, help="bytes/s per connection, e.g. 5M (default: unlimited)")
+    parser.add_argument("--no-content-length", action="store_true", help="don't send Content-Length")
+    parser.add_argument("--no-ranges", action="store_true", help="ignore Range requests")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of an error response (default: 0)")
+    parser.add_argument("--error-status", type=int, default=503, help="status code for injected errors (default: 503)")
+    parser.add_argument("--cut-rate", type=float, default=0.0, help="probability of cutting the connection mid-body (default: 0)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for injected failures")
+    parser.add_argument("--request-limit", type=float, default=0, help="requests per second, more are answered with 429 (default: unlimited)")
+    parser.add_argument("--reset-after", type=parse_size, default=0,
+        help="reset full (non-range) responses after this many bytes, e.g. 1M (default: never)")
+
+
+def options_from_arguments(args):
+    return ServerOptions(latency=args.latency, bandwidth=args.bandwidth,
+        content_length=not args.no_content_length, ranges=not args.no_ranges,
+        error_rate=args.error_rate, error_status=args.error_status, cut_rate=args.cut_rate, seed=args.seed,
+        request_limit=args.request_limit, reset_after=args.reset_after)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for an LCP content server.")
+    parser.add_argument("--work-dir", default="lcp-test-server", help="where the synthetic publications are stored")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--publication", action="append", default=[], metavar="SIZE[:KIND]",
+        help="add a publication, e.g. 10M or 1G:pdf (can be given multiple times)")
+    parser.add_argument("--lcpl-dir", default=None, help="write a matching LCPL file for every publication here")
+    parser.add_argument("--verbose", action="store_true")
+    add_server_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = LCPTestServer(args.work_dir, options_from_arguments(args), args.host, args.port, args.verbose)
+
+    for i, spec in enumerate(args.publication or ["1M"]):
+        size, _, kind = spec.partition(":")
+        pub = server.add_publication("pub{0}".format(i), parse_size(size), kind or "epub")
+        print("Serving {0} ({1} bytes) at {2}".format(pub.name, pub.size, server.url_for(pub)))
+        if args.lcpl_dir:
+            if not os.path.isdir(args.lcpl_dir):
+                os.makedirs(args.lcpl_dir)
+            with open(os.path.join(args.lcpl_dir, "pub{0}.lcpl".format(i)), "w") as f:
+                f.write(pub.make_lcpl(server.url_for(pub), "test-license-{0}".format(i)))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Standalone version of the plugin's headless batch fulfillment (calibre-plugin/cli.py),
+# for servers without Calibre. Uses the Calibre shims from this directory.
+#
+# Example:
+#   python3 tools/lcpl_fulfill.py --jobs 16 /srv/lcpl-drop -o /srv/books
+#
+# Settings, the publication cache and partial downloads are kept in --state-dir
+# (default: ~/.lcplinput), so interrupted runs can pick up where they stopped.
+# All other options are described in --help.
+
+import argparse
+import os
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS_DIR)
+
+import calibre_shims        # noqa: E402
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument("--state-dir", default=os.path.join(os.path.expanduser("~"), ".lcplinput"))
+    pre.add_argument("--plugin-dir", default=calibre_shims.PLUGIN_DIR)
+    known, rest = pre.parse_known_args(argv)
+
+    plugin_module = calibre_shims.install(known.state_dir, known.plugin_dir)
+    plugin = plugin_module.LCPLInput(known.plugin_dir)
+
+    import calibre_plugins.lcplinput.cli as cli     # type: ignore
+    return cli.main(plugin, rest, "lcpl_fulfill.py [--state-dir DIR]")
+
+
+if __name__ == "__main__":
+    sys.exit(main())